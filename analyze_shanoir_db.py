@@ -1,8 +1,12 @@
+import sys
 import time
+import tempfile
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 from datetime import datetime
 from pathlib import Path
 import logging
 import shutil
+import zipfile
 import requests
 import pydicom
 import pandas
@@ -10,6 +14,12 @@ import numpy as np
 import shanoir_downloader
 from py7zr import pack_7zarchive, unpack_7zarchive
 
+try:
+	import pyarrow
+	import pyarrow.parquet
+except ImportError:
+	pyarrow = None
+
 # register 7zip file format
 shutil.register_archive_format('7zip', pack_7zarchive, description='7zip archive')
 shutil.register_unpack_format('7zip', ['.7z'], unpack_7zarchive)
@@ -24,6 +34,11 @@ parser.add_argument('-ids', '--dataset_ids', required=True, help='Path to a csv
 parser.add_argument('-of', '--output_folder', required=True, help='The destination folder where files will be downloaded.')
 parser.add_argument('-mt', '--max_tries', type=int, default=10, help='The number of times to try a download before giving up.')
 parser.add_argument('-ue', '--unrecoverable_errors', default=['status_code_404', 'anonymization_error', 'zip_compression_error', 'encryption_error'], nargs='*', help='The errors which should not trigger a new download.')
+parser.add_argument('-vo', '--verify_only', action='store_true', help='Only verify the datasets: read the header of the first DICOM file of the archive on the server with HTTP range requests, without downloading the archive (which is downloaded when the server does not support range requests).')
+parser.add_argument('-a', '--audit', action='store_true', help='Audit the datasets in parallel: read the first DICOM header of each archive (with HTTP range requests when possible, see --verify_only) and write one row per dataset (name and description match flags, modality, manufacturer, number of instances, archive size, error) in a Parquet report, then summarize it. Requires pyarrow.')
+parser.add_argument('-ar', '--audit_report', default=None, help='Directory of the Parquet audit report (one file per run, a new run skips the datasets already audited without error). Defaults to "audit_report" in the output_folder.')
+parser.add_argument('-j', '--jobs', type=int, default=8, help='Number of datasets audited at the same time with --audit.')
+parser.add_argument('-rgs', '--row_group_size', type=int, default=1000, help='Number of datasets per row group of the Parquet audit report (the rows are written every row_group_size datasets).')
 parser.add_argument('-dids', '--downloaded_datasets', default=None, help='Path to a tsv file containing the already downloaded datasets (generated by this script). Creates the file "downloaded_datasets.tsv" in the given output_folder by default. If the file already exists, it will be taken into account and updated with the new downloads.')
 parser.add_argument('-mids', '--missing_datasets', default=None, help='Path to a tsv file containing the missing datasets (generated by this script). Creates the file "missings_datasets.tsv" in the given output_folder by default. If the file already exists, it will be taken into account and updated with the new errors.')
 
@@ -47,8 +62,8 @@ all_datasets.set_index('sequence_id', inplace=True)
 output_folder = Path(config['output_folder'])
 
 # Create missing_datasets and downloaded_datasets tsv files
-missing_datasets_path = output_folder / f'missing_datasets.tsv' if args.missing_datasets is None else Path(args.missing_datasets)
-downloaded_datasets_path = output_folder / f'downloaded_datasets.tsv' if args.downloaded_datasets is None else Path(args.downloaded_datasets)
+missing_datasets_path = output_folder / 'missing_datasets.tsv' if args.missing_datasets is None else Path(args.missing_datasets)
+downloaded_datasets_path = output_folder / 'downloaded_datasets.tsv' if args.downloaded_datasets is None else Path(args.downloaded_datasets)
 
 missing_datasets = pandas.DataFrame(columns=['sequence_id', 'reason', 'message', 'n_tries']) if not missing_datasets_path.exists() else pandas.read_csv(str(missing_datasets_path), sep='\t', dtype=missing_datasets_dtype)
 missing_datasets.set_index('sequence_id', inplace=True)
@@ -63,7 +78,7 @@ def add_missing_dataset(missing_datasets, sequence_id, reason, message, raw_fold
 		missing_datasets.loc[sequence_id, 'reason'] = reason
 		missing_datasets.loc[sequence_id, 'message'] = message
 	else:
-		missing_datasets = missing_datasets.append(pandas.Series({'reason': str(reason), 'message': str(message), 'n_tries': 1}, name=sequence_id))
+		missing_datasets = pandas.concat([missing_datasets, pandas.DataFrame({'reason': [str(reason)], 'message': [str(message)], 'n_tries': [1]}, index=pandas.Index([sequence_id], name=missing_datasets.index.name))])
 	missing_datasets.to_csv(str(missing_datasets_path), sep='\t')
 	if (raw_folder / sequence_id).exists() and reason not in args.unrecoverable_errors:
 		shutil.rmtree(raw_folder / sequence_id)
@@ -71,12 +86,156 @@ def add_missing_dataset(missing_datasets, sequence_id, reason, message, raw_fold
 
 def add_downloaded_dataset(downloaded_datasets, missing_datasets, sequence_id):
 	if sequence_id in downloaded_datasets.index: return
-	downloaded_datasets = downloaded_datasets.append(all_datasets.loc[sequence_id])
+	downloaded_datasets = pandas.concat([downloaded_datasets, all_datasets.loc[[sequence_id]]])
 	downloaded_datasets.to_csv(str(downloaded_datasets_path), sep='\t')
 	missing_datasets.drop(sequence_id, inplace=True, errors='ignore')
 	missing_datasets.to_csv(str(missing_datasets_path), sep='\t')
 	return downloaded_datasets
 
+def add_http_error(missing_datasets, sequence_id, e, raw_folder):
+	message = f'Response status code: {e.response.status_code}, reason: {e.response.reason}'
+	if hasattr(e.response, 'error') and e.response.error:
+		message += f', response error: {e.response.error}'
+	message += str(e)
+	return add_missing_dataset(missing_datasets, sequence_id, 'status_code_' + str(e.response.status_code), message, raw_folder)
+
+# Returns the reason and message of the error if the dicom does not correspond to the dataset, None otherwise
+def check_dicom(ds, shanoir_name, series_description):
+	if ds.PatientName != shanoir_name:
+		return 'content_shanoir_name', f'Shanoir name {shanoir_name} differs in dicom: {ds.PatientName}'
+	if ds.SeriesDescription != series_description: 	# or if ds[0x0008, 0x103E].value != series_description:
+		return 'content_series_description', f'Series description {series_description} differs in dicom: {ds.SeriesDescription}'
+	return None
+
+# Read the header of the first DICOM file of a zip archive (path or file), returns the header (None if there is no DICOM file) and the number of DICOM files
+def read_dicom_header(archive_file):
+	with zipfile.ZipFile(archive_file) as archive:
+		dicom_members = sorted([member for member in archive.infolist() if member.filename.endswith('.dcm') and '/' not in member.filename.rstrip('/')], key=lambda member: member.filename)
+		if len(dicom_members) == 0:
+			return None, 0
+		with archive.open(dicom_members[0]) as dicom_file:
+			return pydicom.dcmread(dicom_file, stop_before_pixels=True), len(dicom_members)
+
+# Read the header of the first DICOM file of the dataset archive on the server, only the zip central directory and this file are transferred
+# Returns None if the archive contains no DICOM file, raises shanoir_downloader.RangesNotSupported if the server does not support range requests
+def read_remote_dicom_header(config, sequence_id):
+	return read_dicom_header(shanoir_downloader.open_remote_dataset(config, sequence_id, 'dicom'))[0]
+
+if pyarrow is not None:
+	audit_schema = pyarrow.schema([
+		('sequence_id', pyarrow.string()),
+		('shanoir_name', pyarrow.string()),
+		('series_description', pyarrow.string()),
+		('dicom_patient_name', pyarrow.string()),
+		('dicom_series_description', pyarrow.string()),
+		('name_match', pyarrow.bool_()),
+		('description_match', pyarrow.bool_()),
+		('modality', pyarrow.string()),
+		('manufacturer', pyarrow.string()),
+		('n_instances', pyarrow.int64()),
+		('archive_size', pyarrow.int64()),
+		('remote', pyarrow.bool_()),
+		('error', pyarrow.string()),
+		('message', pyarrow.string()),
+		('duration', pyarrow.float64()),
+		('audited_at', pyarrow.timestamp('s')),
+	])
+
+# Audit one dataset (in a worker thread), returns its row of the audit report
+def audit_dataset(config, sequence_id, shanoir_name, series_description, temporary_folder):
+	start = time.perf_counter()
+	result = { 'sequence_id': str(sequence_id), 'shanoir_name': str(shanoir_name), 'series_description': str(series_description), 'remote': True }
+	try:
+		try:
+			archive_file = shanoir_downloader.open_remote_dataset(config, sequence_id, 'dicom')
+			result['archive_size'] = archive_file.size
+			ds, result['n_instances'] = read_dicom_header(archive_file)
+		except shanoir_downloader.RangesNotSupported:
+			result['remote'] = False
+			destination_folder = Path(temporary_folder) / str(sequence_id)
+			destination_folder.mkdir(parents=True, exist_ok=True)
+			try:
+				archive_path = Path(shanoir_downloader.get_client(config).download_dataset(sequence_id, 'dicom', destination_folder))
+				result['archive_size'] = archive_path.stat().st_size
+				ds, result['n_instances'] = read_dicom_header(archive_path)
+			finally:
+				shutil.rmtree(destination_folder, ignore_errors=True)
+		if ds is None:
+			result['error'] = 'nodicom'
+			result['message'] = 'No DICOM file was found in the archive.'
+		else:
+			result['dicom_patient_name'] = str(ds.get('PatientName', ''))
+			result['dicom_series_description'] = str(ds.get('SeriesDescription', ''))
+			result['name_match'] = ds.get('PatientName') == shanoir_name
+			result['description_match'] = ds.get('SeriesDescription') == series_description
+			result['modality'] = str(ds.get('Modality', ''))
+			result['manufacturer'] = str(ds.get('Manufacturer', ''))
+	except requests.HTTPError as e:
+		result['error'] = 'status_code_' + str(e.response.status_code)
+		result['message'] = str(e)
+	except Exception as e:
+		result['error'] = 'content_read'
+		result['message'] = str(e)
+	result['duration'] = time.perf_counter() - start
+	result['audited_at'] = datetime.now().replace(microsecond=0)
+	return result
+
+def write_row_group(writer, rows):
+	writer.write_table(pyarrow.Table.from_pylist(rows, schema=audit_schema))
+	rows.clear()
+
+# Audit the datasets with a pool of threads (sharing the client), the main thread writes the rows in the report by row groups
+def audit_datasets(config, datasets, report_path, jobs, row_group_size):
+	n_datasets = len(datasets)
+	items = iter(datasets.iterrows())
+	rows = []
+	n_done = 0
+	with tempfile.TemporaryDirectory(dir=str(output_folder)) as temporary_folder, ThreadPoolExecutor(max_workers=jobs) as executor, pyarrow.parquet.ParquetWriter(str(report_path), audit_schema) as writer:
+		# Keep a bounded number of datasets in flight
+		futures = set()
+		while True:
+			for sequence_id, row in items:
+				series_description = row['sequence_name'] if 'sequence_name' in row else row['series_description']
+				futures.add(executor.submit(audit_dataset, config, sequence_id, row['shanoir_name'], series_description, temporary_folder))
+				if len(futures) >= 4 * jobs: break
+			if len(futures) == 0: break
+			done, futures = wait(futures, return_when=FIRST_COMPLETED)
+			for future in done:
+				rows.append(future.result())
+				n_done += 1
+			if len(rows) >= row_group_size:
+				write_row_group(writer, rows)
+				logging.info(f'{n_done}/{n_datasets} datasets audited.')
+		if len(rows) > 0:
+			write_row_group(writer, rows)
+	return report_path
+
+def read_audit_report(report_folder):
+	parts = sorted(Path(report_folder).glob('*.parquet'))
+	if len(parts) == 0: return pandas.DataFrame(columns=audit_schema.names)
+	report = pandas.concat([pandas.read_parquet(str(part)) for part in parts], ignore_index=True)
+	# The last audit of each dataset
+	return report.sort_values('audited_at', kind='stable').drop_duplicates('sequence_id', keep='last')
+
+# Summaries of the audit computed on whole columns
+def summarize_audit(report):
+	report = report.assign(
+		failed=report['error'].notna(),
+		name_mismatch=report['name_match'].eq(False),
+		description_mismatch=report['description_match'].eq(False),
+	)
+	by_equipment = report.groupby(['modality', 'manufacturer'], dropna=False).agg(
+		n_datasets=('sequence_id', 'count'),
+		n_failed=('failed', 'sum'),
+		n_name_mismatches=('name_mismatch', 'sum'),
+		n_description_mismatches=('description_mismatch', 'sum'),
+		n_instances=('n_instances', 'sum'),
+		archive_bytes=('archive_size', 'sum'),
+		mean_duration=('duration', 'mean'),
+	)
+	errors = report['error'].value_counts()
+	return by_equipment, errors
+
 def rename_path(old_path, new_path):
 	new_path.parent.mkdir(exist_ok=True, parents=True)
 	old_path.rename(new_path)
@@ -84,6 +243,24 @@ def rename_path(old_path, new_path):
 
 datasets_to_download = all_datasets
 
+if args.audit:
+	if pyarrow is None:
+		sys.exit('pyarrow is required to audit the datasets (pip install pyarrow).')
+	report_folder = output_folder / 'audit_report' if args.audit_report is None else Path(args.audit_report)
+	report_folder.mkdir(parents=True, exist_ok=True)
+	# Skip the datasets already audited without error (or with an unrecoverable error)
+	report = read_audit_report(report_folder)
+	audited = report.loc[report['error'].isna() | report['error'].isin(args.unrecoverable_errors), 'sequence_id']
+	datasets_to_audit = all_datasets[~all_datasets.index.astype(str).isin(audited)]
+	logging.info(f'Auditing {len(datasets_to_audit)} datasets ({len(all_datasets) - len(datasets_to_audit)} already audited)...')
+	if len(datasets_to_audit) > 0:
+		audit_datasets(config, datasets_to_audit, report_folder / f'audit_{datetime.now():%Y%m%d_%H%M%S}.parquet', args.jobs, args.row_group_size)
+	by_equipment, errors = summarize_audit(read_audit_report(report_folder))
+	by_equipment.to_csv(str(output_folder / 'audit_summary.tsv'), sep='\t')
+	print(by_equipment.to_string())
+	print(errors.to_string())
+	sys.exit(0)
+
 raw_folder = output_folder / 'raw'
 
 def replace_with_sequence_id(sequence_id, dataset, tag):
@@ -117,6 +294,28 @@ while len(datasets_to_download) > 0:
 
 		logging.info(f'Downloading dataset {sequence_id}, shanoir name: {shanoir_name}, series description: {series_description}')
 
+		# Verify the dataset from the archive on the server (the archive is downloaded if it cannot be read remotely)
+		if args.verify_only:
+			try:
+				ds = read_remote_dicom_header(config, sequence_id)
+				if ds is None:
+					missing_datasets = add_missing_dataset(missing_datasets, sequence_id, 'nodicom', f'No DICOM file was found in the archive of dataset {sequence_id}.', raw_folder)
+					continue
+				error = check_dicom(ds, shanoir_name, series_description)
+				if error is not None:
+					missing_datasets = add_missing_dataset(missing_datasets, sequence_id, error[0], error[1], raw_folder)
+					continue
+				downloaded_datasets = add_downloaded_dataset(downloaded_datasets, missing_datasets, sequence_id)
+				continue
+			except shanoir_downloader.RangesNotSupported as e:
+				logging.info(f'    Cannot read the archive on the server ({e}), downloading it...')
+			except requests.HTTPError as e:
+				missing_datasets = add_http_error(missing_datasets, sequence_id, e, raw_folder)
+				continue
+			except Exception as e:
+				missing_datasets = add_missing_dataset(missing_datasets, sequence_id, 'content_read', f'Error while reading the remote DICOM: {e}', raw_folder)
+				continue
+
 		# Create the destination folder for this dataset
 		destination_folder = raw_folder / sequence_id / 'downloaded_archive'
 		destination_folder.mkdir(exist_ok=True, parents=True)
@@ -126,11 +325,7 @@ while len(datasets_to_download) > 0:
 		try:
 			shanoir_downloader.download_dataset(config, sequence_id, 'dicom')
 		except requests.HTTPError as e:
-			message = f'Response status code: {e.response.status_code}, reason: {e.response.reason}'
-			if hasattr(e.response, 'error') and e.response.error:
-				message += f', response error: {e.response.error}'
-			message += str(e)
-			missing_datasets = add_missing_dataset(missing_datasets, sequence_id, 'status_code_' + str(e.response.status_code), message, raw_folder)
+			missing_datasets = add_http_error(missing_datasets, sequence_id, e, raw_folder)
 			continue
 		except Exception as e:
 			missing_datasets = add_missing_dataset(missing_datasets, sequence_id, 'unknown_http_error', str(e), raw_folder)
@@ -140,7 +335,7 @@ while len(datasets_to_download) > 0:
 		zip_files = list(destination_folder.glob('*.zip'))
 
 		if len(zip_files) != 1:
-			message = f'No zip file was found' if len(zip_files) == 0 else f'{len(zip_files)} zip files were found'
+			message = 'No zip file was found' if len(zip_files) == 0 else f'{len(zip_files)} zip files were found'
 			message += f' in the output directory {destination_folder}.'
 			message += f' Downloaded files: { destination_folder.ls() }'
 			missing_datasets = add_missing_dataset(missing_datasets, sequence_id, 'zip', message, raw_folder)
@@ -169,12 +364,9 @@ while len(datasets_to_download) > 0:
 		try:
 			ds = pydicom.dcmread(str(dicom_file))
 
-			if ds.PatientName != shanoir_name:
-				missing_datasets = add_missing_dataset(missing_datasets, sequence_id, 'content_shanoir_name', f'Shanoir name {shanoir_name} differs in dicom: {ds.PatientName}', raw_folder)
-				continue
-
-			if ds.SeriesDescription != series_description: 	# or if ds[0x0008, 0x103E].value != series_description:
-				missing_datasets = add_missing_dataset(missing_datasets, sequence_id, 'content_series_description', f'Series description {series_description} differs in dicom: {ds.SeriesDescription}', raw_folder)
+			error = check_dicom(ds, shanoir_name, series_description)
+			if error is not None:
+				missing_datasets = add_missing_dataset(missing_datasets, sequence_id, error[0], error[1], raw_folder)
 				continue
 		except Exception as e:
 			missing_datasets = add_missing_dataset(missing_datasets, sequence_id, 'content_read', f'Error while reading DICOM: {e}', raw_folder)
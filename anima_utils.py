@@ -58,9 +58,10 @@ def get_registration_options_from_image(refImage):
     return pyramid_options
 
 # Calls a command, if there are errors: outputs them and exit
-def call(command, stdout=subprocess.DEVNULL):
+# (the command is killed and subprocess.TimeoutExpired is raised if it does not finish in timeout seconds)
+def call(command, stdout=subprocess.DEVNULL, timeout=None):
     command = [str(arg) for arg in command]
-    status = subprocess.call(command, stdout=stdout)
+    status = subprocess.call(command, stdout=stdout, timeout=timeout)
     if status != 0:
         print(' '.join(command) + '\n')
         raise Exception('Command exited with status: ' + str(status), status)
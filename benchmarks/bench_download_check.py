@@ -0,0 +1,178 @@
+import os
+import sys
+import logging
+import shutil
+import argparse
+import tempfile
+import subprocess
+from pathlib import Path
+import pandas
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+import shanoir_downloader
+import shanoir_downloader_check
+import shanoir_mock_server
+import synthetic_dicom
+import benchmark_utils
+
+# Benchmarks of shanoir_downloader_check.py, offline (the downloads use the mock server of shanoir_mock_server.py):
+# - state: cost of the bookkeeping (downloaded_datasets.tsv and missing_datasets.tsv) for a given number of datasets
+# - anonymization: throughput of anonymize_fields on a synthetic series
+# - compression: 7z compression of the anonymized series, and gpg encryption (with a temporary key) when gpg is installed
+# - end_to_end: datasets per minute of download_datasets (download, extraction, verification, anonymization, compression, encryption)
+# Usage: python benchmarks/bench_download_check.py [-ss 1000 10000] [-o results.json] [-ubl]
+
+BENCHMARKS = ['state', 'anonymization', 'compression', 'end_to_end']
+
+def get_anonymization_fields():
+    return pandas.read_csv(str(Path(shanoir_downloader_check.__file__).parent / 'anonymization_fields.tsv'), sep='\t')
+
+def create_datasets(n_datasets):
+    sequence_ids = [str(10000 + i) for i in range(n_datasets)]
+    return pandas.DataFrame({ 'sequence_id': sequence_ids, 'shanoir_name': [f'{i % 1000:05d}' for i in range(n_datasets)], 'series_description': 't1_mprage' }).set_index('sequence_id')
+
+def bench_state(n_datasets, n_operations, folder):
+    # State of a download of n_datasets datasets (all downloaded, 10% of them failed before), then n_operations new downloads and failures
+    all_datasets = create_datasets(n_datasets + 2 * n_operations)
+    downloaded_datasets = all_datasets.iloc[:n_datasets].copy()
+    downloaded_datasets['patient_name_in_dicom'] = downloaded_datasets['shanoir_name']
+    downloaded_datasets['series_description_in_dicom'] = downloaded_datasets['series_description']
+    downloaded_datasets['verified'] = None
+    missing_datasets = pandas.DataFrame({ 'sequence_id': all_datasets.index[:n_datasets // 10], 'reason': 'status_code_503', 'message': 'Service unavailable', 'n_tries': 1 }).set_index('sequence_id')
+    missing_datasets_path, downloaded_datasets_path = folder / 'missing_datasets.tsv', folder / 'downloaded_datasets.tsv'
+    downloaded_datasets.to_csv(str(downloaded_datasets_path), sep='\t')
+    missing_datasets.to_csv(str(missing_datasets_path), sep='\t')
+
+    state = {}
+    load_duration = benchmark_utils.timed(lambda: state.update(zip(['missing', 'downloaded'], shanoir_downloader_check.load_state(missing_datasets_path, downloaded_datasets_path))))[0]
+    missing_datasets, downloaded_datasets = state['missing'], state['downloaded']
+    to_download_duration = benchmark_utils.timed(lambda: shanoir_downloader_check.get_datasets_to_download(all_datasets, downloaded_datasets, missing_datasets, 10, ['status_code_404']))[0]
+
+    new_ids = list(all_datasets.index[n_datasets:])
+    raw_folder = folder / 'raw'
+    missing_durations = []
+    for sequence_id in new_ids[:n_operations]:
+        missing_durations += benchmark_utils.timed(lambda: state.update(missing=shanoir_downloader_check.add_missing_dataset(state['missing'], sequence_id, 'status_code_503', 'Service unavailable', raw_folder, [], missing_datasets_path)))
+    downloaded_durations = []
+    for sequence_id in new_ids[n_operations:]:
+        downloaded_durations += benchmark_utils.timed(lambda: state.update(downloaded=shanoir_downloader_check.add_downloaded_dataset(all_datasets, state['downloaded'], state['missing'], sequence_id, 'name', 't1_mprage', None, downloaded_datasets_path, missing_datasets_path)))
+    return {
+        'n_datasets': n_datasets,
+        'load_state_seconds': load_duration,
+        'get_datasets_to_download_seconds': to_download_duration,
+        'add_missing_dataset_ms': 1000 * benchmark_utils.median(missing_durations),
+        'add_downloaded_dataset_ms': 1000 * benchmark_utils.median(downloaded_durations),
+    }
+
+def write_series(folder, n_files, slice_size, shanoir_name='01001'):
+    folder.mkdir(parents=True, exist_ok=True)
+    datasets = synthetic_dicom.create_series(n_files, slice_size, slice_size, patient_name=shanoir_name)
+    for i, dataset in enumerate(datasets):
+        dataset.save_as(str(folder / f'{shanoir_name}_{i:04d}.dcm'), write_like_original=False)
+    return sorted(folder.glob('*.dcm'))
+
+def get_size(folder):
+    return sum(path.stat().st_size for path in Path(folder).rglob('*') if path.is_file())
+
+def bench_anonymization(n_files, slice_size, repeats, folder):
+    dicom_files = write_series(folder / 'dicom', n_files, slice_size)
+    anonymization_fields = get_anonymization_fields()
+    output_folder = folder / 'anonymized'
+    def anonymize():
+        shutil.rmtree(output_folder, ignore_errors=True)
+        output_folder.mkdir()
+        shanoir_downloader_check.anonymize_fields(anonymization_fields, dicom_files, output_folder, '10000', '10000', '01001')
+    duration = benchmark_utils.median(benchmark_utils.timed(anonymize, repeats))
+    size = get_size(folder / 'dicom')
+    return { 'n_files': n_files, 'anonymization_seconds': duration, 'files_per_second': n_files / duration, 'megabytes_per_second': size / duration / 1e6 }
+
+# A temporary gpg home with a key without passphrase, returns the recipient (None if gpg is not installed)
+def create_gpg_key(gpg_home):
+    if shutil.which('gpg') is None:
+        return None
+    gpg_home.mkdir(mode=0o700, parents=True, exist_ok=True)
+    os.environ['GNUPGHOME'] = str(gpg_home)
+    recipient = 'benchmark@example.org'
+    subprocess.run(['gpg', '--batch', '--passphrase', '', '--quick-generate-key', recipient, 'default', 'default', 'never'], check=True, capture_output=True)
+    return recipient
+
+def bench_compression(n_files, slice_size, repeats, folder, gpg_recipient):
+    dicom_folder = folder / 'dicom'
+    write_series(dicom_folder, n_files, slice_size)
+    size = get_size(dicom_folder)
+    archive = folder / 'dicom.7z'
+    # As in download_datasets()
+    compression_duration = benchmark_utils.median(benchmark_utils.timed(lambda: shutil.make_archive(str(dicom_folder), '7zip', str(dicom_folder)), repeats))
+    result = { 'n_files': n_files, 'compression_seconds': compression_duration, 'compression_megabytes_per_second': size / compression_duration / 1e6, 'compression_ratio': size / archive.stat().st_size }
+    if gpg_recipient is not None:
+        encrypted = folder / 'dicom.7z.gpg'
+        command = ['gpg', '--batch', '--yes', '--output', str(encrypted), '--encrypt', '--recipient', gpg_recipient, '--trust-model', 'always', str(archive)]
+        encryption_duration = benchmark_utils.median(benchmark_utils.timed(lambda: subprocess.run(command, check=True, capture_output=True), repeats))
+        result.update({ 'encryption_seconds': encryption_duration, 'encryption_megabytes_per_second': archive.stat().st_size / encryption_duration / 1e6 })
+    return result
+
+def bench_end_to_end(n_datasets, n_slices, slice_size, latency, bandwidth, folder, gpg_recipient):
+    database = shanoir_mock_server.MockDatabase(n_subjects=n_datasets, sequences=['t1_mprage'], n_slices=n_slices, rows=slice_size, columns=slice_size, cache_size=n_datasets)
+    # The archives are generated before the measure: a real server does not generate them
+    for dataset_id in database.datasets:
+        database.get_archive(dataset_id, 'dcm')
+    datasets = pandas.DataFrame([{ 'sequence_id': item['datasetId'], 'shanoir_name': item['subjectName'], 'series_description': item['datasetName'] } for item in database.get_items()])
+    dataset_ids_path = folder / 'datasets.tsv'
+    datasets.to_csv(str(dataset_ids_path), sep='\t', index=False)
+    output_folder = folder / 'output'
+
+    os.environ.setdefault('shanoir_password', 'benchmark')
+    os.environ.setdefault('shanoir_otp', '000000')
+    with shanoir_mock_server.MockShanoirServer(database=database, settings=shanoir_mock_server.MockSettings(latency=latency, bandwidth=bandwidth)) as server:
+        arguments = ['-u', 'benchmark', '-d', server.url, '-of', str(output_folder), '-ids', str(dataset_ids_path)]
+        arguments += ['-gpgr', gpg_recipient] if gpg_recipient is not None else ['-se']
+        args = shanoir_downloader_check.create_arg_parser().parse_args(arguments)
+        config = { 'domain': server.url, 'username': 'benchmark', 'verify': True, 'proxies': None, 'output_folder': output_folder, 'timeout': args.timeout }
+        config['client'] = shanoir_downloader.ShanoirClient.from_config(config)
+        duration = benchmark_utils.timed(lambda: shanoir_downloader_check.download_datasets(args, config))[0]
+        n_bytes = server.get_counts().get('bytes_sent', 0)
+    downloaded_datasets = pandas.read_csv(str(output_folder / 'downloaded_datasets.tsv'), sep='\t') if (output_folder / 'downloaded_datasets.tsv').exists() else []
+    return { 'n_datasets': n_datasets, 'n_downloaded': len(downloaded_datasets), 'encryption': gpg_recipient is not None, 'end_to_end_seconds': duration, 'datasets_per_minute': 60 * len(downloaded_datasets) / duration, 'downloaded_megabytes': n_bytes / 1e6 }
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Benchmark the download and check pipeline (shanoir_downloader_check.py) offline', formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('-be', '--benchmarks', nargs='+', choices=BENCHMARKS, default=BENCHMARKS, help='The benchmarks to run.')
+    parser.add_argument('-ss', '--state_sizes', type=int, nargs='+', default=[1000, 10000, 100000], help='Numbers of datasets of the state benchmarks.')
+    parser.add_argument('-no', '--n_operations', type=int, default=20, help='Number of downloads and failures recorded by the state benchmarks.')
+    parser.add_argument('-nf', '--n_files', type=int, default=100, help='Number of dicom files of the anonymization and compression benchmarks.')
+    parser.add_argument('-sz', '--slice_size', type=int, default=256, help='Number of rows and columns of the synthetic dicom files.')
+    parser.add_argument('-r', '--repeats', type=int, default=3, help='Number of repetitions of the anonymization, compression and encryption.')
+    parser.add_argument('-nd', '--n_datasets', type=int, default=20, help='Number of datasets downloaded by the end to end benchmark.')
+    parser.add_argument('-ns', '--n_slices', type=int, default=32, help='Number of slices of the datasets downloaded by the end to end benchmark.')
+    parser.add_argument('-l', '--latency', type=float, default=0.05, help='Latency of the mock server in seconds.')
+    parser.add_argument('-bw', '--bandwidth', type=float, default=None, help='Bandwidth of the mock server in bytes per second (no limit by default).')
+    parser.add_argument('-ne', '--no_encryption', default=False, action='store_true', help='Do not measure the gpg encryption (even if gpg is installed).')
+    benchmark_utils.add_baseline_arguments(parser, 'download_check.json')
+    args = parser.parse_args()
+    # The errors logged by the pipeline (the failures recorded by the state benchmarks) are not shown
+    logging.basicConfig(level=logging.CRITICAL)
+
+    results = {}
+    with tempfile.TemporaryDirectory() as temporary_folder:
+        temporary_folder = Path(temporary_folder)
+        gpg_recipient = None if args.no_encryption or not set(['compression', 'end_to_end']) & set(args.benchmarks) else create_gpg_key(temporary_folder / 'gnupg')
+        if 'state' in args.benchmarks:
+            for n_datasets in args.state_sizes:
+                folder = temporary_folder / f'state_{n_datasets}'
+                folder.mkdir()
+                results[f'state_{n_datasets}'] = bench_state(n_datasets, args.n_operations, folder)
+                print(f'state_{n_datasets}', results[f'state_{n_datasets}'])
+        benchmarks = {
+            'anonymization': lambda folder: bench_anonymization(args.n_files, args.slice_size, args.repeats, folder),
+            'compression': lambda folder: bench_compression(args.n_files, args.slice_size, args.repeats, folder, gpg_recipient),
+            'end_to_end': lambda folder: bench_end_to_end(args.n_datasets, args.n_slices, args.slice_size, args.latency, args.bandwidth, folder, gpg_recipient),
+        }
+        for name, benchmark in benchmarks.items():
+            if name not in args.benchmarks: continue
+            folder = temporary_folder / name
+            folder.mkdir()
+            results[name] = benchmark(folder)
+            print(name, results[name])
+
+    sys.exit(benchmark_utils.finish(args, results))
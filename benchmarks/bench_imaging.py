@@ -0,0 +1,176 @@
+import sys
+import shutil
+import zipfile
+import argparse
+import tempfile
+from pathlib import Path
+import pandas
+import pydicom
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+import convert_dicoms_to_niftis
+import create_previews
+import fast_dicom_conversion
+import shanoir_downloader_check
+import synthetic_dicom
+import benchmark_utils
+
+# Benchmarks of the imaging side, offline, on synthetic series (see synthetic_dicom.py):
+# - conversion: each converter of the fallback chain of convert_dicoms_to_niftis.py (and the fast path) on each type of series,
+#   and on the zipped series given with --zips (e.g. real series)
+# - previews: create_previews.py on niftis of several sizes and spacings
+# - dicom_io: pydicom reading (headers only, and with the pixels) and writing of each type of series
+# - anonymization: anonymize_fields of shanoir_downloader_check.py on each type of series
+# Each measure runs in a new process and reports its wall time and its peak resident memory (peak RSS)
+# Usage: python benchmarks/bench_imaging.py [-be conversion previews] [-z series1.zip series2.zip ...] [-o results.json] [-ubl]
+
+BENCHMARKS = ['conversion', 'previews', 'dicom_io', 'anonymization']
+SERIES = ['single_frame', 'multi_frame', 'fmri', 'anisotropic']
+
+def create_series(name, args):
+    if name == 'single_frame':
+        return synthetic_dicom.create_series(args.n_slices, args.slice_size, args.slice_size)
+    if name == 'multi_frame':
+        return synthetic_dicom.create_enhanced_series(args.n_slices, args.slice_size, args.slice_size)
+    if name == 'fmri':
+        return synthetic_dicom.create_fmri_series(args.n_volumes)
+    if name == 'anisotropic':
+        return synthetic_dicom.create_series(args.n_slices // 2, args.slice_size, args.slice_size * 3 // 4, slice_spacing=5.0, pixel_spacing=(0.45, 0.6))
+    raise ValueError(f'Unknown series {name}')
+
+# Volume sizes are given as XxYxZ or XxYxZ@SXxSYxSZ (spacing in mm, 1 mm by default)
+def parse_volume(volume):
+    size, _, spacing = volume.partition('@')
+    return [int(s) for s in size.split('x')], [float(s) for s in spacing.split('x')] if spacing else [1.0, 1.0, 1.0]
+
+# The measured functions (run in separate processes by benchmark_utils.measure)
+
+# Nothing: the peak RSS of a process which only imports the modules (included in all the measures)
+def do_nothing():
+    pass
+
+def convert_with_tool(tool, dicom_directory, output_folder):
+    output_folder.mkdir(parents=True, exist_ok=True)
+    if tool == 'fast_path':
+        fast_dicom_conversion.convert_zip(dicom_directory.parent / 'dicom.zip', output_folder / f'{dicom_directory.name}.nii.gz')
+    else:
+        convert_dicoms_to_niftis.run_converter(tool, dicom_directory, output_folder)
+    if convert_dicoms_to_niftis.image_is_readable(convert_dicoms_to_niftis.get_first_nifti(output_folder)) is None:
+        raise Exception(f'{tool} did not produce a readable nifti')
+
+def preview_nifti(nifti_path, destination_directory, options):
+    destination_directory.mkdir(parents=True, exist_ok=True)
+    create_previews.setOptions(options)
+    create_previews.createPreviews(nifti_path, destination_directory)
+
+def read_dicoms(paths, stop_before_pixels):
+    for path in paths:
+        dataset = pydicom.dcmread(str(path), stop_before_pixels=stop_before_pixels)
+        if not stop_before_pixels:
+            dataset.pixel_array
+
+def write_dicoms(datasets, folder):
+    synthetic_dicom.write_series(folder, datasets)
+
+def anonymize_dicoms(paths, output_folder):
+    output_folder.mkdir(parents=True, exist_ok=True)
+    anonymization_fields = pandas.read_csv(str(Path(shanoir_downloader_check.__file__).parent / 'anonymization_fields.tsv'), sep='\t')
+    shanoir_downloader_check.anonymize_fields(anonymization_fields, paths, output_folder, '10000', '10000', 'synthetic')
+
+def get_converters(converters):
+    # animaConvertImage only repairs the niftis of the other converters
+    available_tools = ['fast_path'] + [tool for tool in convert_dicoms_to_niftis.get_available_tools() if tool != 'animaConvertImage']
+    return [tool for tool in available_tools if converters is None or tool in converters]
+
+def add_throughput(result, n_bytes):
+    if result.get('wall_seconds'):
+        result['megabytes_per_second'] = n_bytes / result['wall_seconds'] / 1e6
+    return result
+
+def bench_conversion(name, args, converters, dicom_directory, results):
+    for tool in converters:
+        output_folder = dicom_directory.parent / f'nifti_{tool}'
+        result = benchmark_utils.measure(convert_with_tool, (tool, dicom_directory, output_folder), args.conversion_repeats)
+        results[f'convert_{name}_{tool}'] = dict(result, converted='error' not in result)
+        shutil.rmtree(output_folder, ignore_errors=True)
+        print(f'convert_{name}_{tool}', results[f'convert_{name}_{tool}'])
+
+def bench_series(name, args, converters, folder, results):
+    datasets = create_series(name, args)
+    dicom_directory = folder / 'dicom'
+    paths = synthetic_dicom.write_series(dicom_directory, datasets)
+    synthetic_dicom.write_series_zip(str(folder / 'dicom.zip'), datasets)
+    n_bytes = sum(path.stat().st_size for path in paths)
+    print(f'Series {name}: {len(paths)} files, {n_bytes / 1e6:.1f} MB')
+
+    if 'conversion' in args.benchmarks:
+        bench_conversion(name, args, converters, dicom_directory, results)
+
+    if 'dicom_io' in args.benchmarks:
+        results[f'dicom_read_headers_{name}'] = benchmark_utils.measure(read_dicoms, (paths, True), args.repeats)
+        results[f'dicom_read_{name}'] = add_throughput(benchmark_utils.measure(read_dicoms, (paths, False), args.repeats), n_bytes)
+        results[f'dicom_write_{name}'] = add_throughput(benchmark_utils.measure(write_dicoms, (datasets, folder / 'written'), args.repeats), n_bytes)
+        shutil.rmtree(folder / 'written', ignore_errors=True)
+        for kind in ['dicom_read_headers', 'dicom_read', 'dicom_write']:
+            print(f'{kind}_{name}', results[f'{kind}_{name}'])
+
+    if 'anonymization' in args.benchmarks:
+        results[f'anonymize_{name}'] = add_throughput(benchmark_utils.measure(anonymize_dicoms, (paths, folder / 'anonymized'), args.repeats), n_bytes)
+        shutil.rmtree(folder / 'anonymized', ignore_errors=True)
+        print(f'anonymize_{name}', results[f'anonymize_{name}'])
+
+# A zipped series (the fast path converts the zip, the other converters its extracted files)
+def bench_zip(dicom_zip, args, converters, folder, results):
+    dicom_directory = folder / 'dicom'
+    with zipfile.ZipFile(str(dicom_zip), 'r') as zip_ref:
+        zip_ref.extractall(str(dicom_directory))
+    shutil.copyfile(str(dicom_zip), str(folder / 'dicom.zip'))
+    print(f'Series {dicom_zip.name}: {dicom_zip.stat().st_size / 1e6:.1f} MB zipped')
+    bench_conversion('zip_' + dicom_zip.stem, args, converters, dicom_directory, results)
+
+def bench_previews(volume, args, folder, results):
+    size, spacing = parse_volume(volume)
+    nifti_path = synthetic_dicom.create_nifti(folder / 'volume.nii.gz', size, spacing)
+    options = { 'slice_spacing': 5, 'bounding_box_size': 200, 'mosaic_spacing': 5, 'intensity_window': args.intensity_window, 'output_mode': args.output_mode }
+    name = 'previews_' + volume.replace('@', '_').replace('.', 'p')
+    results[name] = benchmark_utils.measure(preview_nifti, (nifti_path, folder / 'previews', options), args.repeats)
+    print(name, results[name])
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Benchmark the conversions, the previews and the dicom reading, writing and anonymization on synthetic data', formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('-be', '--benchmarks', nargs='+', choices=BENCHMARKS, default=BENCHMARKS, help='The benchmarks to run.')
+    parser.add_argument('-se', '--series', nargs='+', choices=SERIES, default=SERIES, help='The types of synthetic series: single-frame 2D slices, enhanced multi-frame, fMRI (single-frame slices of several volumes), anisotropic voxels.')
+    parser.add_argument('-z', '--zips', nargs='+', default=[], help='Zipped dicom series (e.g. real series downloaded from Shanoir) to convert with each converter, in addition to the synthetic series.')
+    parser.add_argument('-c', '--converters', nargs='+', default=None, help='The converters to measure (fast_path and the available converters of convert_dicoms_to_niftis.py by default).')
+    parser.add_argument('-ns', '--n_slices', type=int, default=60, help='Number of slices of the series.')
+    parser.add_argument('-sz', '--slice_size', type=int, default=256, help='Number of rows and columns of the slices (the fMRI series have 64x64 slices).')
+    parser.add_argument('-nv', '--n_volumes', type=int, default=100, help='Number of volumes of the fMRI series (of 36 slices).')
+    parser.add_argument('-vs', '--volume_sizes', nargs='+', default=['128x128x96', '256x256x180', '256x256x40@0.9x0.9x4', '384x384x240@0.7x0.7x0.7'], help='Sizes of the niftis of the previews benchmarks, as XxYxZ or XxYxZ@SXxSYxSZ (spacing in mm).')
+    parser.add_argument('-iw', '--intensity_window', default='minmax', choices=['minmax', 'histogram'], help='The intensity window of the previews.')
+    parser.add_argument('-om', '--output_mode', default='png', choices=['png', 'sprite'], help='The output mode of the previews.')
+    parser.add_argument('-r', '--repeats', type=int, default=3, help='Number of repetitions of the previews, dicom and anonymization measures.')
+    parser.add_argument('-cr', '--conversion_repeats', type=int, default=1, help='Number of repetitions of each conversion.')
+    benchmark_utils.add_baseline_arguments(parser, 'imaging.json')
+    args = parser.parse_args()
+
+    results = { 'process_baseline': benchmark_utils.measure(do_nothing) }
+    print('process_baseline', results['process_baseline'])
+    with tempfile.TemporaryDirectory() as temporary_folder:
+        temporary_folder = Path(temporary_folder)
+        if set(['conversion', 'dicom_io', 'anonymization']) & set(args.benchmarks):
+            converters = get_converters(args.converters) if 'conversion' in args.benchmarks else []
+            for name in args.series:
+                bench_series(name, args, converters, temporary_folder / name, results)
+                shutil.rmtree(temporary_folder / name)
+            for i, dicom_zip in enumerate(args.zips if 'conversion' in args.benchmarks else []):
+                folder = temporary_folder / f'zip_{i}'
+                bench_zip(Path(dicom_zip), args, converters, folder, results)
+                shutil.rmtree(folder)
+        if 'previews' in args.benchmarks:
+            for volume in args.volume_sizes:
+                folder = temporary_folder / f'previews_{len(results)}'
+                bench_previews(volume, args, folder, results)
+                shutil.rmtree(folder)
+
+    sys.exit(benchmark_utils.finish(args, results))
@@ -0,0 +1,144 @@
+import sys
+import json
+import time
+import platform
+import subprocess
+import multiprocessing
+from datetime import datetime
+from pathlib import Path
+from queue import Empty
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+# Results of the benchmarks and comparison with a baseline (the results of a previous run, e.g. the last release):
+# results are written as { metadata, results: { benchmark: { metric: value } } } ; the metrics are compared according to their suffix
+
+BENCHMARKS_FOLDER = Path(__file__).resolve().parent
+BASELINES_FOLDER = BENCHMARKS_FOLDER / 'baselines'
+
+LOWER_IS_BETTER = ('_seconds', '_ms', '_mb')
+HIGHER_IS_BETTER = ('_per_second', '_per_minute', '_ratio')
+
+def add_baseline_arguments(parser, default_baseline):
+    parser.add_argument('-o', '--output', help='Path of the json file where the results are written.')
+    parser.add_argument('-bl', '--baseline', default=str(BASELINES_FOLDER / default_baseline), help='Path of the baseline results (a results file of a previous run) to compare with. The baselines are machine specific and not versioned: when the file does not exist, a warning is printed and the results are not compared (record one with --update_baseline).')
+    parser.add_argument('-ubl', '--update_baseline', default=False, action='store_true', help='Write the results as the new baseline.')
+    parser.add_argument('-tol', '--tolerance', type=float, default=0.2, help='Relative difference with the baseline above which a metric is reported as a regression.')
+    return parser
+
+def timed(function, repeats=1):
+    durations = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        function()
+        durations.append(time.perf_counter() - start)
+    return durations
+
+# Peak resident memory in MB of the current process or of its largest child process (external converters), None where it is not available (Windows).
+# On Linux, VmHWM is used for the current process: its ru_maxrss includes the memory of the parent process when it was created
+def get_peak_rss_mb():
+    if resource is None: return None
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    status_path = Path('/proc/self/status')
+    if status_path.exists():
+        peak_rss = next((int(line.split()[1]) for line in status_path.read_text().splitlines() if line.startswith('VmHWM:')), peak_rss)
+    peak_rss = max(peak_rss, resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+    # kilobytes on Linux, bytes on macOS
+    return peak_rss / (1024 * 1024) if sys.platform == 'darwin' else peak_rss / 1024
+
+def run_measured(queue, function, args):
+    try:
+        start = time.perf_counter()
+        function(*args)
+        queue.put((time.perf_counter() - start, get_peak_rss_mb(), None))
+    except Exception as e:
+        queue.put((None, get_peak_rss_mb(), f'{type(e).__name__}: {e}'))
+
+# Run function(*args) in a new process (spawned, so that the peak memory of the process only includes the imports and the function), repeats times,
+# returns the median wall time, the maximum peak RSS, and the error if the function failed (the function must be importable: defined at the top level of a module)
+def measure(function, args=(), repeats=1):
+    context = multiprocessing.get_context('spawn')
+    durations, peak_rss, error = [], [], None
+    for _ in range(repeats):
+        queue = context.Queue()
+        process = context.Process(target=run_measured, args=(queue, function, args))
+        process.start()
+        while True:
+            try:
+                duration, rss, error = queue.get(timeout=1)
+                break
+            except Empty:
+                # Killed (e.g. out of memory) or crashed
+                if not process.is_alive():
+                    duration, rss, error = None, None, f'the process exited with code {process.exitcode}'
+                    break
+        process.join()
+        if rss is not None: peak_rss.append(rss)
+        if error is not None: break
+        durations.append(duration)
+    result = { 'wall_seconds': median(durations) if len(durations) > 0 else None, 'peak_rss_mb': max(peak_rss) if len(peak_rss) > 0 else None }
+    if error is not None:
+        result['error'] = error
+    return result
+
+def median(values):
+    values = sorted(values)
+    middle = len(values) // 2
+    return values[middle] if len(values) % 2 == 1 else (values[middle - 1] + values[middle]) / 2
+
+def get_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=str(BENCHMARKS_FOLDER), capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def get_metadata():
+    return { 'date': datetime.now().isoformat(timespec='seconds'), 'commit': get_commit(), 'python': platform.python_version(), 'platform': platform.platform(), 'machine': platform.machine(), 'command': ' '.join(sys.argv) }
+
+def write_results(path, results):
+    path = Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    with open(path, 'w') as file:
+        json.dump({ 'metadata': get_metadata(), 'results': results }, file, indent=4)
+    return path
+
+def get_direction(metric):
+    if metric.endswith(HIGHER_IS_BETTER): return 1
+    if metric.endswith(LOWER_IS_BETTER): return -1
+    return 0
+
+# Returns the metrics which are worse than the baseline by more than tolerance: [(benchmark, metric, baseline value, value)]
+def compare_to_baseline(results, baseline, tolerance=0.2):
+    regressions = []
+    for benchmark, metrics in results.items():
+        for metric, value in metrics.items():
+            baseline_value = baseline.get(benchmark, {}).get(metric)
+            direction = get_direction(metric)
+            if direction == 0 or not isinstance(value, (int, float)) or not isinstance(baseline_value, (int, float)) or baseline_value == 0:
+                continue
+            change = (value - baseline_value) / abs(baseline_value)
+            if change * direction < -tolerance:
+                regressions.append((benchmark, metric, baseline_value, value))
+    return regressions
+
+# Write the results, compare them with the baseline and update the baseline if asked ; returns the exit code (1 if there are regressions)
+def finish(args, results):
+    if args.output:
+        print(f'Results written in {write_results(args.output, results)}')
+    regressions = []
+    baseline_path = Path(args.baseline)
+    if baseline_path.exists():
+        with open(baseline_path) as file:
+            baseline = json.load(file)
+        regressions = compare_to_baseline(results, baseline['results'], args.tolerance)
+        print(f'Compared with the baseline {baseline_path} (commit {baseline["metadata"].get("commit")}, {baseline["metadata"].get("date")}): {len(regressions)} regressions.')
+        for benchmark, metric, baseline_value, value in regressions:
+            print(f'    Regression: {benchmark} {metric}: {value:.4g} (baseline: {baseline_value:.4g})')
+    else:
+        print(f'Warning: no baseline found in {baseline_path}, the results are NOT compared (run with --update_baseline to record one).', file=sys.stderr)
+    if args.update_baseline:
+        print(f'Baseline written in {write_results(baseline_path, results)}')
+    return 1 if len(regressions) > 0 else 0
@@ -0,0 +1,191 @@
+import os
+import json
+import time
+import logging
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from pathlib import Path
+
+import shanoir_util
+import delete_datasets
+
+# Run a campaign of CARMIN executions on Shanoir: the executions of a manifest are submitted with a bounded number of running executions,
+# all the running executions are polled together (less often while nothing changes), and their identifiers and states are saved
+# after each change so that an interrupted campaign can be resumed
+
+# Terminal statuses of a CARMIN execution
+FINISHED = 'Finished'
+FAILED_STATUSES = ['InitializationFailed', 'ExecutionFailed', 'Killed']
+TERMINAL_STATUSES = [FINISHED] + FAILED_STATUSES
+# Status of the executions which could not be created
+SUBMISSION_FAILED = 'SubmissionFailed'
+
+def add_manager_arguments(parser):
+    parser.add_argument('-m', '--manifest', required=True, help='Path to a json file containing the list of the executions to run (CARMIN executions: name, pipelineIdentifier, inputValues..., optionally studyIdentifier and exportFormat). The names must be unique, they identify the executions in the state file.')
+    parser.add_argument('-sf', '--state_file', default=None, help='Path to the json file where the identifiers and the statuses of the executions are saved (the executions already submitted are not submitted again). Defaults to the manifest with the .state.json extension.')
+    parser.add_argument('-st', '--study_identifier', type=int, default=17, help='The study of the executions (when not given in the manifest).')
+    parser.add_argument('-ef', '--export_format', default='dcm', choices=['dcm', 'nii'], help='The format of the datasets given to the executions (when not given in the manifest).')
+    parser.add_argument('-mr', '--max_running', type=int, default=10, help='Maximum number of executions running at the same time.')
+    parser.add_argument('-j', '--jobs', type=int, default=4, help='Number of requests (creations and status requests) sent at the same time.')
+    parser.add_argument('-pi', '--poll_interval', type=float, default=10, help='Initial interval in seconds between two polls of the running executions.')
+    parser.add_argument('-mpi', '--max_poll_interval', type=float, default=300, help='Maximum interval between two polls (the interval grows while no execution changes).')
+    parser.add_argument('-rf', '--retry_failed', default=False, action='store_true', help='Submit again the executions which failed in a previous run.')
+    return parser
+
+class ExecutionState:
+    """
+    Identifiers and statuses of the executions of a campaign: { name: { identifier, status, submitted_at, finished_at, error } }, saved in a json file
+    """
+
+    def __init__(self, path):
+        self.path = Path(path)
+        self.executions = {}
+        if self.path.exists():
+            with open(self.path) as file:
+                self.executions = json.load(file)
+
+    def get(self, name):
+        return self.executions.get(name, {})
+
+    def update(self, name, **values):
+        self.executions.setdefault(name, {}).update(values)
+
+    def save(self):
+        temporary_path = self.path.with_suffix('.json.tmp')
+        with open(temporary_path, 'w') as file:
+            json.dump(self.executions, file, indent=4)
+        os.replace(temporary_path, self.path)
+
+def now():
+    return datetime.now().isoformat(timespec='seconds')
+
+def submit_execution(config, execution, study_identifier, export_format):
+    execution = dict(execution)
+    study_identifier = execution.pop('studyIdentifier', study_identifier)
+    export_format = execution.pop('exportFormat', export_format)
+    result = shanoir_util.createExecution(config, execution, study_identifier=study_identifier, export_format=export_format)
+    if not isinstance(result, dict) or not result.get('identifier'):
+        raise Exception(f'Execution could not be created: {result}')
+    return result['identifier']
+
+def get_status(config, identifier):
+    return json.loads(shanoir_util.getExecutionStatus(config, identifier))['status']
+
+class ExecutionManager:
+
+    def __init__(self, config, executions, state, study_identifier=17, export_format='dcm', max_running=10, jobs=4, poll_interval=10, max_poll_interval=300):
+        self.config = config
+        self.executions = { execution['name']: execution for execution in executions }
+        self.state = state
+        self.study_identifier = study_identifier
+        self.export_format = export_format
+        self.max_running = max_running
+        self.jobs = jobs
+        self.poll_interval = poll_interval
+        self.max_poll_interval = max_poll_interval
+
+    def get_names(self, retry_failed=False):
+        to_submit, running = [], []
+        for name in self.executions:
+            execution_state = self.state.get(name)
+            status = execution_state.get('status')
+            if execution_state.get('identifier') and status not in TERMINAL_STATUSES + [SUBMISSION_FAILED]:
+                running.append(name)
+            elif status is None or retry_failed and status != FINISHED:
+                to_submit.append(name)
+        return to_submit, running
+
+    def submit(self, executor, names):
+        def submit_one(name):
+            try:
+                return name, submit_execution(self.config, self.executions[name], self.study_identifier, self.export_format), None
+            except Exception as e:
+                return name, None, str(e)
+        for name, identifier, error in executor.map(submit_one, names):
+            if identifier is None:
+                logging.error(f'Execution {name} could not be created: {error}')
+                self.state.update(name, identifier=None, status=SUBMISSION_FAILED, error=error, finished_at=now())
+            else:
+                logging.info(f'Execution {name} created: {identifier}')
+                self.state.update(name, identifier=identifier, status='Initializing', error=None, submitted_at=now(), finished_at=None)
+            # Saved after each creation: a created execution is never submitted again
+            self.state.save()
+
+    # Poll all the running executions, returns the names of those which changed status
+    def poll(self, executor, names):
+        def poll_one(name):
+            try:
+                return name, get_status(self.config, self.state.get(name)['identifier']), None
+            except Exception as e:
+                return name, None, str(e)
+        changed = []
+        for name, status, error in executor.map(poll_one, names):
+            if status is None:
+                logging.warning(f'Could not get the status of execution {name}: {error}')
+                continue
+            if status != self.state.get(name).get('status'):
+                changed.append(name)
+                self.state.update(name, status=status)
+                if status in TERMINAL_STATUSES:
+                    self.state.update(name, finished_at=now())
+                    (logging.info if status == FINISHED else logging.error)(f'Execution {name} {status}.')
+        if len(changed) > 0:
+            self.state.save()
+        return changed
+
+    def run(self, retry_failed=False):
+        to_submit, running = self.get_names(retry_failed)
+        logging.info(f'{len(to_submit)} executions to submit, {len(running)} running.')
+        start = time.perf_counter()
+        n_finished = 0
+        interval = self.poll_interval
+        with ThreadPoolExecutor(max_workers=self.jobs) as executor:
+            while len(to_submit) > 0 or len(running) > 0:
+                n_free = self.max_running - len(running)
+                if n_free > 0 and len(to_submit) > 0:
+                    names, to_submit = to_submit[:n_free], to_submit[n_free:]
+                    self.submit(executor, names)
+                    running += [name for name in names if self.state.get(name).get('status') != SUBMISSION_FAILED]
+                if len(running) == 0: continue
+                time.sleep(interval)
+                changed = self.poll(executor, running)
+                finished = [name for name in running if self.state.get(name).get('status') in TERMINAL_STATUSES]
+                n_finished += len(finished)
+                running = [name for name in running if name not in finished]
+                # Poll less often while nothing changes
+                interval = self.poll_interval if len(changed) > 0 else min(interval * 1.5, self.max_poll_interval)
+                elapsed = time.perf_counter() - start
+                logging.info(f'{n_finished} executions finished in {elapsed:.0f} seconds ({3600 * n_finished / elapsed:.1f} per hour), {len(running)} running, {len(to_submit)} to submit.')
+        return self.summary()
+
+    def summary(self):
+        statuses = {}
+        for name in self.executions:
+            status = self.state.get(name).get('status')
+            statuses[status] = statuses.get(status, 0) + 1
+        return statuses
+
+if __name__ == '__main__':
+    parser = delete_datasets.create_arg_parser('Run CARMIN executions on Shanoir')
+    delete_datasets.add_common_arguments(parser)
+    add_manager_arguments(parser)
+    delete_datasets.add_configuration_arguments(parser)
+    args = parser.parse_args()
+    config = shanoir_util.initialize(args)
+
+    with open(args.manifest) as file:
+        executions = json.load(file)
+    names = [execution['name'] for execution in executions]
+    if len(names) != len(set(names)):
+        sys.exit('Error: the names of the executions of the manifest must be unique.')
+
+    state = ExecutionState(args.state_file if args.state_file else Path(args.manifest).with_suffix('.state.json'))
+    manager = ExecutionManager(config, executions, state, args.study_identifier, args.export_format, args.max_running, args.jobs, args.poll_interval, args.max_poll_interval)
+    try:
+        statuses = manager.run(args.retry_failed)
+    except ConnectionError as e:
+        sys.exit(f'Error: {e}')
+    logging.info(f'Executions: {statuses}')
+
+#python3 ./carmin_executions.py -lf /tmp/test.log -u XXXX -d shanoir-ng-nginx -m ./executions.json -mr 20
@@ -1,18 +1,229 @@
+import sys
+import json
+import sqlite3
 import zipfile
 import logging
 import shutil
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from contextlib import contextmanager
 from pathlib import Path
 import pandas
+import pydicom
 import dicom2nifti
 import SimpleITK as sitk
 import shanoir_downloader
+import fast_dicom_conversion
 from anima_utils import *
 
+MRICRON_DCM2NIIX = '/data/amasson/apps/dcm2nii/mricron/dcm2niix'
+
+# Converters in their default order (used when there is no conversion history for a type of series)
+CONVERTERS = ['dcm2niix', 'dicom2nifti', 'simple_itk', 'mcverter', 'mricronDcm2niix']
+
+# Header attributes identifying a type of series in the conversion history (recorded in conversion_info.tsv)
+SERIES_ATTRIBUTES = ['Manufacturer', 'Modality', 'SOPClassUID', 'multiframe']
+
+# Default maximum number of simultaneous conversions for the heavier converters (which load whole series in memory), with --jobs
+DEFAULT_TOOL_LIMITS = {'dicom2nifti': 2, 'simple_itk': 2}
+
+# Default maximum duration (in seconds) of a conversion attempt
+DEFAULT_TOOL_TIMEOUT = 600
+
+# Semaphores limiting the number of simultaneous conversions per tool, set in each worker process by init_worker()
+tool_semaphores = {}
+# Converters found on this machine (see get_available_tools()), None to try them all
+available_tools = None
+# Timeout of each tool in seconds
+tool_timeouts = {}
+
+def init_worker(semaphores, tools=None, timeouts={}):
+    global tool_semaphores, available_tools, tool_timeouts
+    tool_semaphores = semaphores
+    available_tools = tools
+    tool_timeouts = timeouts
+
+# Detect the converters once (instead of failing on each dataset)
+def get_available_tools():
+    tools = []
+    for tool in CONVERTERS:
+        if tool in ['dcm2niix', 'mcverter'] and shutil.which(tool) is None: continue
+        if tool == 'mricronDcm2niix' and not Path(MRICRON_DCM2NIIX).exists(): continue
+        tools.append(tool)
+    if Path(animaConvertImage).exists():
+        tools.append('animaConvertImage')
+    missing_tools = [tool for tool in CONVERTERS + ['animaConvertImage'] if tool not in tools]
+    if len(missing_tools) > 0:
+        print(f'Converters not found (they will not be used): {missing_tools}')
+    return tools
+
+def parse_tool_timeouts(tool_timeouts, default_timeout=DEFAULT_TOOL_TIMEOUT):
+    timeouts = { tool: default_timeout for tool in CONVERTERS + ['animaConvertImage'] }
+    for tool_timeout in tool_timeouts or []:
+        tool, timeout = tool_timeout.split('=')
+        timeouts[tool] = float(timeout)
+    return timeouts
+
+# Header attributes of the first dicom of the series (see SERIES_ATTRIBUTES)
+def get_series_attributes(dicom_directory):
+    attributes = { attribute: '' for attribute in SERIES_ATTRIBUTES }
+    for dicom_file in Path(dicom_directory).glob('**/*'):
+        if not dicom_file.is_file(): continue
+        try:
+            dataset = pydicom.dcmread(str(dicom_file), stop_before_pixels=True)
+        except Exception:
+            continue
+        return get_dataset_attributes(dataset)
+    return attributes
+
+def get_dataset_attributes(dataset):
+    attributes = { attribute: str(dataset.get(attribute, '')) for attribute in ['Manufacturer', 'Modality', 'SOPClassUID'] }
+    attributes['multiframe'] = str(int(dataset.get('NumberOfFrames', 1) or 1) > 1)
+    return attributes
+
+def get_series_key(attributes):
+    return tuple('' if pandas.isna(attributes.get(attribute, '')) else str(attributes.get(attribute, '')) for attribute in SERIES_ATTRIBUTES)
+
+# Number of successes and failures of each converter by type of series: { series_key: { tool: [n_successes, n_failures] } }
+def get_converter_history(conversion_info):
+    history = {}
+    for info in conversion_info:
+        update_converter_history(history, info)
+    return history
+
+def update_converter_history(history, info):
+    if not all(attribute in info for attribute in SERIES_ATTRIBUTES): return history
+    tools_history = history.setdefault(get_series_key(info), {})
+    failed_tools = info.get('failed_tools', '')
+    for tool in ([] if pandas.isna(failed_tools) else str(failed_tools).split(',')):
+        if tool == '': continue
+        tools_history.setdefault(tool, [0, 0])[1] += 1
+    if info['converted'] in [True, 'True'] and not pandas.isna(info['conversion_tool']):
+        tools_history.setdefault(info['conversion_tool'], [0, 0])[0] += 1
+    return history
+
+# Order the available converters by success rate on this type of series (the default order breaks ties)
+def get_converter_order(series_key, history):
+    tools_history = history.get(series_key, {})
+    tools = [tool for tool in CONVERTERS if available_tools is None or tool in available_tools]
+    def success_rate(tool):
+        n_successes, n_failures = tools_history.get(tool, [0, 0])
+        # Laplace smoothing: an untried converter has a success rate of 0.5
+        return (n_successes + 1) / (n_successes + n_failures + 2)
+    return sorted(tools, key=lambda tool: -success_rate(tool))
+
+# Run a python converter of this module in a new interpreter (the arguments are paths), for the processes which cannot have
+# child processes (daemonic processes): the command is killed and subprocess.TimeoutExpired is raised after timeout seconds
+def run_in_interpreter(function, args, timeout):
+    code = f'import sys; from pathlib import Path; sys.path.insert(0, {str(Path(__file__).resolve().parent)!r}); '
+    code += f'import {Path(__file__).stem} as module; module.{function.__name__}(*[Path(arg) for arg in sys.argv[1:]])'
+    call([sys.executable, '-c', code] + [str(arg) for arg in args], stdout=None, timeout=timeout)
+
+# Run a python converter in a separate process to be able to stop it after timeout seconds
+def run_with_timeout(function, args, timeout):
+    if timeout is None:
+        return function(*args)
+    if multiprocessing.current_process().daemon:
+        return run_in_interpreter(function, args, timeout)
+    process = multiprocessing.Process(target=function, args=args)
+    process.start()
+    process.join(timeout)
+    if process.is_alive():
+        process.terminate()
+        process.join()
+        raise TimeoutError(f'{function.__name__} did not finish in {timeout} seconds')
+    if process.exitcode != 0:
+        raise Exception(f'{function.__name__} exited with code {process.exitcode}')
+
+def run_converter(tool, dicom_directory, output_folder):
+    timeout = tool_timeouts.get(tool)
+    if tool == 'dcm2niix':
+        call(['dcm2niix', '-z', 'y', '-o', output_folder, dicom_directory], timeout=timeout)
+    elif tool == 'dicom2nifti':
+        run_with_timeout(convert_with_dicom2nifti, (dicom_directory, output_folder), timeout)
+    elif tool == 'simple_itk':
+        run_with_timeout(simple_itk_conversion, (dicom_directory, output_folder), timeout)
+    elif tool == 'mcverter':
+        call(['mcverter', '-o', output_folder, '-f', 'nifti', '-n', dicom_directory], timeout=timeout)
+    elif tool == 'mricronDcm2niix':
+        call([MRICRON_DCM2NIIX, '-z', 'y', '-w', '1', '-o', output_folder, dicom_directory], timeout=timeout)
+
+@contextmanager
+def tool_slot(tool_name):
+    semaphore = tool_semaphores.get(tool_name)
+    if semaphore is None:
+        yield
+        return
+    with semaphore:
+        yield
+
 def save_conversion_tools(conversion_info_path, conversion_info):
     df = pandas.DataFrame.from_records(conversion_info)
     df.to_csv(conversion_info_path, sep='\t', index=False)
     return
 
+class ConversionStore:
+    """
+    Conversion records (the rows of conversion_info.tsv) in a SQLite database, keyed by the path of the dicom directory:
+    lookups do not scan all the records, and each record is committed when it is added (crash safe) instead of rewriting the tsv.
+    The tsv is exported with export_tsv(); an existing tsv is imported when the database is created.
+    """
+
+    def __init__(self, database_path, conversion_info_path=None):
+        self.database_path = Path(database_path)
+        self.connection = sqlite3.connect(str(self.database_path))
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('CREATE TABLE IF NOT EXISTS conversions (path TEXT PRIMARY KEY, fingerprint TEXT, record TEXT NOT NULL)')
+        self.connection.commit()
+        if conversion_info_path is not None and Path(conversion_info_path).exists() and len(self) == 0:
+            self.import_tsv(conversion_info_path)
+
+    def __len__(self):
+        return self.connection.execute('SELECT COUNT(*) FROM conversions').fetchone()[0]
+
+    def get(self, path):
+        row = self.connection.execute('SELECT record FROM conversions WHERE path = ?', (str(path),)).fetchone()
+        return json.loads(row[0]) if row is not None else None
+
+    # A dataset is converted if it has a record with the same input fingerprint (records imported from a tsv have no fingerprint)
+    def is_converted(self, path, fingerprint=None):
+        row = self.connection.execute('SELECT fingerprint FROM conversions WHERE path = ?', (str(path),)).fetchone()
+        return row is not None and (row[0] is None or fingerprint is None or row[0] == fingerprint)
+
+    def add(self, record, commit=True):
+        record = { key: None if not isinstance(value, (list, dict)) and pandas.isna(value) else value for key, value in record.items() }
+        self.connection.execute('INSERT OR REPLACE INTO conversions (path, fingerprint, record) VALUES (?, ?, ?)', (str(record['path']), record.get('fingerprint'), json.dumps(record, default=str)))
+        if commit:
+            self.connection.commit()
+
+    def records(self):
+        return [json.loads(row[0]) for row in self.connection.execute('SELECT record FROM conversions ORDER BY rowid')]
+
+    def import_tsv(self, conversion_info_path):
+        df = pandas.read_csv(conversion_info_path, sep='\t', index_col=False)
+        for record in df.to_dict('records'):
+            self.add(record, commit=False)
+        self.connection.commit()
+
+    def export_tsv(self, conversion_info_path):
+        save_conversion_tools(conversion_info_path, self.records())
+
+    def close(self):
+        self.connection.close()
+
+# Fingerprint of the input of a conversion (zip archive or dicom directory): changes when the input files change
+def get_input_fingerprint(input_path):
+    input_path = Path(input_path)
+    if not input_path.exists(): return None
+    files = [input_path] if input_path.is_file() else sorted(path for path in input_path.glob('**/*') if path.is_file())
+    n_bytes = 0
+    last_modification = 0
+    for path in files:
+        stat = path.stat()
+        n_bytes += stat.st_size
+        last_modification = max(last_modification, stat.st_mtime_ns)
+    return f'{len(files)}-{n_bytes}-{last_modification}'
+
 def get_first_nifti(path):
     niftis = list(Path(path).glob('**/*.nii.gz'))
     return niftis[0] if len(niftis) > 0 else None
@@ -30,67 +241,64 @@ def image_is_readable(image_path):
         pass
     return None
 
+def convert_with_dicom2nifti(dicom_directory, output_folder):
+    dicom2nifti.convert_directory(str(dicom_directory), str(output_folder), compression=True, reorient=True)
+
 def simple_itk_conversion(folder_path, output_path):
     reader = sitk.ImageSeriesReader()
     reader.SetMetaDataDictionaryArrayUpdate(True)
     reader.SetFileNames(reader.GetGDCMSeriesFileNames(str(folder_path)))
     image = reader.Execute()
-    sitk.WriteImage(image, output_path / f'{output_path.name}.nii.gz')
+    sitk.WriteImage(image, str(output_path / f'{output_path.name}.nii.gz'))
     return
 
-def convert_dicom_to_nifti(dicom_directory, output_folder):
+def convert_dicom_to_nifti(dicom_directory, output_folder, commandNames=CONVERTERS):
     output_folder.mkdir(parents=True, exist_ok=True)
 
-    image_converted = False
-    
-    simple_itk_command = lambda: simple_itk_conversion(dicom_folder, output_folder)
-    dicom2nifti_command = lambda: dicom2nifti.convert_directory(dicom_directory, output_folder, compression=True, reorient=True)
-    mricron_dcm2niix_command = lambda: call(['/data/amasson/apps/dcm2nii/mricron/dcm2niix', '-z', 'y', '-w', '1', '-o', output_folder, dicom_directory])
-    dcm2niix_command = lambda: call(['dcm2niix', '-z', 'y', '-o', output_folder, dicom_directory])
-    mcverter_command = lambda: call(['mcverter', '-o', output_folder, '-f', 'nifti', '-n', dicom_directory])
-
-    # commands = [mcverter_command]
-    commands = [dcm2niix_command, dicom2nifti_command, simple_itk_command, mcverter_command, mricron_dcm2niix_command]
-    commandNames = ['dcm2niix', 'dicom2nifti', 'simple_itk', 'mcverter', 'mricronDcm2niix']
-    # commands = [dicom2nifti_command, mricron_dcm2niix_command, dcm2niix_command, mcverter_command]
-    # commandNames = ['dicom2nifti', 'mcverter', 'dcm2niix', 'mricronDcm2niix']
-
     conversion_tool = None
     reconverted = None
     image_converted = None
+    failed_tools = []
 
-    for i, command in enumerate(commands):
-        conversion_tool = commandNames[i]
+    for conversion_tool in commandNames:
         print(f'Convert using {conversion_tool}...')
         reconverted = False
         try:
-            command()
-        except:
-            pass
+            with tool_slot(conversion_tool):
+                run_converter(conversion_tool, dicom_directory, output_folder)
+        except Exception as e:
+            print(f'{conversion_tool} failed: {e}')
         image_path = get_first_nifti(output_folder)
-        if image_path is None: continue
-        image_converted = image_is_readable(image_path)
-        if image_converted is not None: break
-        print(f'Image could not be opened, trying animaConvertImage...')
-        call([animaConvertImage, '-i', image_path, '-o', image_path])
-        reconverted = True
-        image_converted = image_is_readable(image_path)
-        if image_converted is not None: break
-        print(f'Image could not be opened, even after animaConvertImage...')
+        if image_path is not None:
+            image_converted = image_is_readable(image_path)
+            if image_converted is not None: break
+            if available_tools is None or 'animaConvertImage' in available_tools:
+                print('Image could not be opened, trying animaConvertImage...')
+                try:
+                    with tool_slot('animaConvertImage'):
+                        call([animaConvertImage, '-i', image_path, '-o', image_path], timeout=tool_timeouts.get('animaConvertImage'))
+                    reconverted = True
+                    image_converted = image_is_readable(image_path)
+                except Exception as e:
+                    print(f'animaConvertImage failed: {e}')
+                if image_converted is not None: break
+                print('Image could not be opened, even after animaConvertImage...')
+        failed_tools.append(conversion_tool)
     
     if image_converted is not None:
         print(f'Image was successfully converted by {conversion_tool} {"and" if reconverted else "without"} animaConvertImage...')
     else:
         print(f'Image could not be converted by any converter {commandNames}...')
 
-    return conversion_tool, reconverted, image_converted
+    return conversion_tool, reconverted, image_converted, failed_tools
 
-def convert_dicom_to_nifti_if_needed(dicom_directory, output_folder, keep_dicom, conversion_info_path, conversion_info):
+# Convert a dicom directory (trying first the converters which succeeded on the same type of series according to the history)
+# and remove it if the conversion succeeded (and keep_dicom is False), returns the conversion info
+def convert_dicom_directory(dicom_directory, output_folder, keep_dicom, converter_history={}):
 
-    if str(dicom_directory) in [ci['path'] for ci in conversion_info]:
-        return output_folder, None
-    
-    conversion_tool, reconverted, image_converted = convert_dicom_to_nifti(dicom_directory, output_folder)
+    series_attributes = get_series_attributes(dicom_directory)
+    converters = get_converter_order(get_series_key(series_attributes), converter_history)
+    conversion_tool, reconverted, image_converted, failed_tools = convert_dicom_to_nifti(dicom_directory, output_folder, converters)
 
     if not keep_dicom:
         if image_converted is not None:
@@ -98,11 +306,115 @@ def convert_dicom_to_nifti_if_needed(dicom_directory, output_folder, keep_dicom,
         else:
             print('ERROR: dicom could not be converted!', dicom_directory)
 
-    conversion_info.append({'path': str(dicom_directory), 'conversion_tool': conversion_tool, 'reconverted': reconverted, 'converted': image_converted is not None})
-    save_conversion_tools(conversion_info_path, conversion_info)
+    info = {'path': str(dicom_directory), 'conversion_tool': conversion_tool, 'reconverted': reconverted, 'converted': image_converted is not None}
+    info.update(series_attributes)
+    info['failed_tools'] = ','.join(failed_tools)
+    return info, image_converted
+
+def convert_dicom_to_nifti_if_needed(dicom_directory, output_folder, keep_dicom, conversion_store, converter_history=None, fingerprint=None):
+
+    if conversion_store.is_converted(dicom_directory, fingerprint):
+        return output_folder, None
+    
+    if converter_history is None:
+        converter_history = get_converter_history(conversion_store.records())
+    info, image_converted = convert_dicom_directory(dicom_directory, output_folder, keep_dicom, converter_history)
+    info['fingerprint'] = fingerprint
+
+    conversion_store.add(info)
+    update_converter_history(converter_history, info)
 
     return output_folder, image_converted
 
+# Fast path: convert a standard series (single-frame 2D MR slices) directly from its zip archive in the current process (see fast_dicom_conversion.py)
+# Returns the conversion info, or None if the series is not supported (it is then extracted and converted with the converters)
+def convert_dicom_zip_with_fast_path(dicom_zip, dicom_directory, output_folder):
+    nifti_path = output_folder / f'{dicom_directory.name}.nii.gz'
+    try:
+        dataset = fast_dicom_conversion.convert_zip(dicom_zip, nifti_path)
+    except fast_dicom_conversion.UnsupportedSeries as e:
+        print(f'Series not supported by fast_path ({e}), using the converters...')
+        return None, None
+    except Exception as e:
+        print(f'fast_path failed: {e}')
+        dataset = None
+    image_converted = image_is_readable(nifti_path) if dataset is not None else None
+    if image_converted is None:
+        if nifti_path.exists(): nifti_path.unlink()
+        return None, None
+    print('Image was successfully converted by fast_path...')
+    info = {'path': str(dicom_directory), 'conversion_tool': 'fast_path', 'reconverted': False, 'converted': True}
+    info.update(get_dataset_attributes(dataset))
+    info['failed_tools'] = ''
+    return info, image_converted
+
+def extract_dicom_zip(dicom_zip):
+    logging.info(f'    Extracting {dicom_zip}...')
+    dicom_folder = dicom_zip.parent / dicom_zip.stem
+    dicom_folder.mkdir(exist_ok=True)
+    with zipfile.ZipFile(str(dicom_zip), 'r') as zip_ref:
+        zip_ref.extractall(str(dicom_folder))
+    return dicom_folder
+
+# List the conversions to do: (dicom zip or None, dicom directory, output folder, input fingerprint)
+def get_conversion_tasks(dicoms, from_folders, output_folder, overwrite):
+    tasks = []
+    for dicom in sorted(list(dicoms.iterdir())):
+        if from_folders:
+            if dicom.suffix == '.zip' or not dicom.is_dir(): continue
+            tasks.append((None, dicom, Path(output_folder) / f'{dicom.name}', get_input_fingerprint(dicom)))
+        else:
+            if not dicom.is_dir(): continue
+            nifti = get_first_nifti(dicom)
+            if not overwrite and nifti is not None: continue
+            for dicom_zip in dicom.glob('**/*.zip'):
+                tasks.append((dicom_zip, dicom_zip.parent / dicom_zip.stem, dicom_zip.parent, get_input_fingerprint(dicom_zip)))
+    return tasks
+
+# Worker: extract (if needed), convert and validate one dataset
+def run_conversion_task(task, keep_dicom, converter_history, fast_path=False):
+    dicom_zip, dicom_directory, output_folder, fingerprint = task
+    info = None
+    if dicom_zip is not None:
+        print(dicom_zip)
+        if fast_path:
+            info, image_converted = convert_dicom_zip_with_fast_path(dicom_zip, dicom_directory, output_folder)
+        if info is None:
+            dicom_directory = extract_dicom_zip(dicom_zip)
+    else:
+        print('Converting', dicom_directory)
+    if info is None:
+        info, image_converted = convert_dicom_directory(dicom_directory, output_folder, keep_dicom, converter_history)
+    info['fingerprint'] = fingerprint
+    return info, image_converted
+
+def parse_tool_limits(tool_limits):
+    limits = dict(DEFAULT_TOOL_LIMITS)
+    for tool_limit in tool_limits or []:
+        tool, limit = tool_limit.split('=')
+        limits[tool] = int(limit)
+    return limits
+
+def convert_in_parallel(tasks, keep_dicom, conversion_store, jobs, tool_limits, tools=None, timeouts={}, fast_path=False):
+    # Skip the datasets already converted from the same input (the directory path identifies the dataset)
+    tasks = [task for task in tasks if not conversion_store.is_converted(task[1], task[3])]
+    print(f'Converting {len(tasks)} datasets with {jobs} processes...')
+    semaphores = { tool: multiprocessing.BoundedSemaphore(limit) for tool, limit in tool_limits.items() if limit < jobs }
+    converter_history = get_converter_history(conversion_store.records())
+    with ProcessPoolExecutor(max_workers=jobs, initializer=init_worker, initargs=(semaphores, tools, timeouts)) as executor:
+        futures = { executor.submit(run_conversion_task, task, keep_dicom, converter_history, fast_path): task for task in tasks }
+        # Single writer: only the main process adds the conversion records
+        for n, future in enumerate(as_completed(futures)):
+            task = futures[future]
+            try:
+                info, image_converted = future.result()
+            except Exception as e:
+                logging.error(f'Conversion of {task[1]} failed: {e}')
+                continue
+            conversion_store.add(info)
+            print(f'[{n+1}/{len(tasks)}] {info["path"]} converted: {info["converted"]}')
+    return conversion_store
+
 if __name__ == "__main__":
     
     parser = shanoir_downloader.create_arg_parser("Convert DICOMs to Niftis")
@@ -112,34 +424,45 @@ if __name__ == "__main__":
     parser.add_argument('-of', '--output_folder', required=False, help='Path to the output folder (only used when using --from_folders).')
     parser.add_argument('-kd', '--keep_dicom', default=False, action='store_true', help='Keep dicoms after conversion.')
     parser.add_argument('-ow', '--overwrite', default=False, action='store_true', help='Overwrite the nifti if it exists.')
+    parser.add_argument('-j', '--jobs', type=int, default=1, help='Number of datasets converted in parallel (in separate processes). Each process extracts, converts and validates a dataset; the main process records the conversions.')
+    parser.add_argument('-tt', '--tool_timeout', action='append', help=f'Maximum duration in seconds of a conversion attempt with a tool, in the format tool=seconds (for example dicom2nifti=300). Can be repeated. Default: {DEFAULT_TOOL_TIMEOUT} seconds for all tools.')
+    parser.add_argument('-fp', '--fast_path', default=False, action='store_true', help='Convert the standard series (single-frame 2D MR slices) directly from the zip archives, without extracting them nor calling a converter. The other series are converted with the converters. Ignored with --from_folders.')
+    parser.add_argument('-tl', '--tool_limit', action='append', help=f'Maximum number of simultaneous conversions of a tool with --jobs, in the format tool=N (for example mcverter=2). Can be repeated. Default: {DEFAULT_TOOL_LIMITS}.')
 
     args = parser.parse_args()
 
     dicoms = Path(args.dicoms)
 
-    conversion_info = []
     conversion_info_path = dicoms / 'conversion_info.tsv'
+    # The records are stored in conversion_info.sqlite, conversion_info.tsv is exported at the end (and imported by the first run)
+    conversion_store = ConversionStore(dicoms / 'conversion_info.sqlite', conversion_info_path)
 
-    if conversion_info_path.exists():
-        df = pandas.read_csv(conversion_info_path, sep='\t', index_col=False)
-        conversion_info = df.to_dict('records')
+    tasks = get_conversion_tasks(dicoms, args.from_folders, args.output_folder, args.overwrite)
 
-    for dicom in sorted(list(dicoms.iterdir())):
-        if args.from_folders:
-            if dicom.suffix == '.zip': continue
-            print('Converting', dicom)
-            convert_dicom_to_nifti_if_needed(dicom, Path(args.output_folder) / f'{dicom.name}', args.keep_dicom, conversion_info_path, conversion_info)
+    # Detect the converters once
+    init_worker({}, get_available_tools(), parse_tool_timeouts(args.tool_timeout))
+
+    try:
+        if args.jobs > 1:
+            convert_in_parallel(tasks, args.keep_dicom, conversion_store, args.jobs, parse_tool_limits(args.tool_limit), available_tools, tool_timeouts, args.fast_path)
         else:
-            # Extract the zip file
-            nifti = get_first_nifti(dicom)
-            if not args.overwrite and nifti is not None: continue
-            zip_files = list(dicom.glob('**/*.zip'))
-            for dicom_zip in zip_files:
-                print(dicom_zip)
-                logging.info(f'    Extracting {dicom_zip}...')
-                dicom_folder = dicom_zip.parent / dicom_zip.stem
-                dicom_folder.mkdir(exist_ok=True)
-                with zipfile.ZipFile(str(dicom_zip), 'r') as zip_ref:
-                    zip_ref.extractall(str(dicom_folder))
-                convert_dicom_to_nifti_if_needed(dicom_folder, dicom_folder.parent, args.keep_dicom, conversion_info_path, conversion_info)
-    
\ No newline at end of file
+            converter_history = get_converter_history(conversion_store.records())
+            for dicom_zip, dicom_directory, output_folder, fingerprint in tasks:
+                if conversion_store.is_converted(dicom_directory, fingerprint): continue
+                if dicom_zip is not None:
+                    print(dicom_zip)
+                    if args.fast_path:
+                        info, image_converted = convert_dicom_zip_with_fast_path(dicom_zip, dicom_directory, output_folder)
+                        if info is not None:
+                            info['fingerprint'] = fingerprint
+                            conversion_store.add(info)
+                            update_converter_history(converter_history, info)
+                            continue
+                    # Extract the zip file
+                    dicom_directory = extract_dicom_zip(dicom_zip)
+                else:
+                    print('Converting', dicom_directory)
+                convert_dicom_to_nifti_if_needed(dicom_directory, output_folder, args.keep_dicom, conversion_store, converter_history, fingerprint)
+    finally:
+        conversion_store.export_tsv(conversion_info_path)
+        conversion_store.close()
@@ -1,136 +1,376 @@
 import SimpleITK as sitk
 import numpy as np
+import os
+import json
+import hashlib
 import argparse
+from datetime import datetime
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from PIL import Image
 from pathlib import Path
 Path.ls = lambda x: sorted(list(x.iterdir()))
 
-parser = argparse.ArgumentParser(
-    prog=__file__,
-    formatter_class=argparse.RawDescriptionHelpFormatter,
-    description="""Create nifti previews""")
+# Preview options (set by setOptions(), in each worker process with --jobs)
+sliceSpacing = 5
+boundingBoxSize = 200
+mosaicSpacing = 4
+intensityWindow = 'minmax'
+outputMode = 'png'
 
-parser.add_argument('-d', '--data', required=True, help='Path to the directory containing the niftis.')
-parser.add_argument('-o', '--output', default=None, help='Path to the destination directory. Defaults to the same directory as the input directory.')
-parser.add_argument('-s', '--slice_spacing', default=5, help='The number of slices per preview image (default = 5, meaning it will save 1 slice every 5 slices).')
-parser.add_argument('-n', '--bounding_box_size', default=200, help='Number of frames to consider for the preview bounding box (images are resampled on 0.5x0.5x0.5 mm).')
-parser.add_argument('-m', '--mosaic_spacing', default=5, help='Number of preview images in mosaic.')
+# Maximum number of voxels used to compute the histogram (the image is subsampled regularly)
+histogramSampleSize = 1000000
 
-args = parser.parse_args()
+# Maximum number of voxels resampled at once to compute the minimum and maximum of the resampled image
+minmaxChunkSize = 16000000
 
-niftis = Path(args.data)
-destinationDirectory = Path(args.data) if args.output is None else Path(args.output)
-destinationDirectory.mkdir(parents=True, exist_ok=True)
-sliceSpacing = int(args.slice_spacing)
-boundingBoxSize = int(args.bounding_box_size)
-mosaicSpacing = int(args.mosaic_spacing) - 1
+# Name of the manifest (in the destination directory) recording the niftis previewed: { nifti path: { mtime_ns, size, hash, options } }
+manifestName = 'previews_manifest.json'
+
+# With --output_mode sprite: index of the sprite sheets { nifti path: { sprite, tiles: { tile name: [x, y, width, height] } } } and viewer, in the destination directory
+indexName = 'previews_index.json'
+viewerName = 'previews_index.html'
+
+viewerHtml = '''<!DOCTYPE html>
+<html>
+<head>
+<meta charset="utf-8">
+<title>Nifti previews</title>
+<style>
+body { font-family: sans-serif; }
+.tile { display: inline-block; margin: 2px; vertical-align: top; }
+.tile div { background-repeat: no-repeat; }
+</style>
+</head>
+<body>
+<select id="niftis"></select>
+<div id="tiles"></div>
+<script>
+fetch('previews_index.json').then(response => response.json()).then(index => {
+    const select = document.getElementById('niftis');
+    for (const nifti of Object.keys(index).sort()) {
+        select.add(new Option(nifti, nifti));
+    }
+    // Each tile is a view of the sprite sheet of the nifti: one fetch per nifti
+    function show(nifti) {
+        const tiles = document.getElementById('tiles');
+        tiles.innerHTML = '';
+        const entry = index[nifti];
+        for (const [name, [x, y, width, height]] of Object.entries(entry.tiles)) {
+            const tile = document.createElement('div');
+            tile.className = 'tile';
+            tile.title = name;
+            const view = document.createElement('div');
+            view.style.width = width + 'px';
+            view.style.height = height + 'px';
+            view.style.backgroundImage = `url("${encodeURI(entry.sprite)}")`;
+            view.style.backgroundPosition = `-${x}px -${y}px`;
+            tile.appendChild(view);
+            tiles.appendChild(tile);
+        }
+    }
+    select.addEventListener('change', () => show(select.value));
+    if (select.options.length > 0) show(select.value);
+});
+</script>
+</body>
+</html>
+'''
+
+def setOptions(options):
+    global sliceSpacing, boundingBoxSize, mosaicSpacing, intensityWindow, outputMode
+    sliceSpacing = options['slice_spacing']
+    boundingBoxSize = options['bounding_box_size']
+    mosaicSpacing = options['mosaic_spacing'] - 1
+    intensityWindow = options['intensity_window']
+    outputMode = options['output_mode']
 
 planeNames = ['axial', 'coronal', 'sagittal']
 
-def saveImage(image, path, flipX=False, flipY=False):
-    pillowImage = Image.fromarray( image.astype(np.uint8) )
+def toPreviewImage(image, flipX=False, flipY=False):
+    image = image.astype(np.uint8)
     if flipX:
-        pillowImage = pillowImage.transpose(Image.FLIP_LEFT_RIGHT)
+        image = image[:, ::-1]
     if flipY:
-        pillowImage = pillowImage.transpose(Image.FLIP_TOP_BOTTOM)
-    # print('save image ', path, ' of size ', pillowImage.size)
-    pillowImage.save(path, format='png')
+        image = image[::-1, :]
+    return np.ascontiguousarray(image)
+
+# Save the preview image (as created by toPreviewImage()) in png
+def saveImage(image, path):
+    Image.fromarray(image).save(path, format='png')
     return path
 
-def saveSlicesAt(imageToDisplay, path, n, sizes=None, prefix=''):
-    shape = imageToDisplay.shape
+# getSlice(axis, index) returns the slice at index along the given axis of the (resampled) image of the given shape
+def saveSlicesAt(getSlice, shape, path, n, sizes=None, prefix=''):
     center = [shape[0] // 2, shape[1] // 2, shape[2] // 2]
     halfBoundingBoxSize = boundingBoxSize//2
-    image1 = imageToDisplay[max(0, min(center[0] + n, shape[0]-1)), :, :]
-    image2 = imageToDisplay[:, max(0, min(center[1] + n, shape[1]-1)), :]
-    image3 = imageToDisplay[:, :, max(0, min(center[2] + n, shape[2]-1))]
+    images = [getSlice(axis, max(0, min(center[axis] + n, shape[axis]-1))) for axis in range(3)]
     flips = [(False, True), (False, True), (True, True)]
     paths = []
-    for i, image in enumerate([image1, image2, image3]):
+    previewImages = []
+    for i, image in enumerate(images):
         imagePath = path / (prefix + planeNames[i] + '_' + str(n + halfBoundingBoxSize) + '.png')
         paths.append(imagePath)
-        saveImage(image, str(imagePath), flips[i][0], flips[i][1])
-    return paths
+        previewImages.append(toPreviewImage(image, flips[i][0], flips[i][1]))
+        if outputMode == 'png':
+            saveImage(previewImages[-1], str(imagePath))
+    return paths, previewImages
 
-def saveSlices(imageToDisplay, path, sizes=None, prefix=''):
+# Returns the paths of the saved slices and the slices (preview images), grouped by offset: [[axial, coronal, sagittal], ...]
+def saveSlices(getSlice, shape, path, sizes=None, prefix=''):
     halfBoundingBoxSize = boundingBoxSize//2
     paths = []
-    if sliceSpacing > 0:
-        for n in range(-halfBoundingBoxSize, halfBoundingBoxSize+1, sliceSpacing):
-            paths.append(saveSlicesAt(imageToDisplay, path, n, sizes, prefix))
-    paths.append(saveSlicesAt(imageToDisplay, path, 0, sizes, f'{prefix}center_'))
-    return paths
-
-def createMosaic(imagePaths, previewPath, prefix=''):
-    mosaicV = None
-    mosaicH = None
-    topV = 0
-    leftH = 0
-
-    for i in range(0, len(imagePaths), len(imagePaths) // mosaicSpacing):
-        slicePaths = imagePaths[i]
-        leftV = 0
-        topH = 0
-        for path in slicePaths:
-            image = Image.open(str(path))
-            if mosaicV is None:
-                mosaicV = image
-                mosaicH = image
-            else:
-                mosaicVWidth = mosaicV.size[0] + image.size[0] if topV == 0 else mosaicV.size[0]
-                mosaicVHeight = mosaicV.size[1] + image.size[1] if leftV == 0 else mosaicV.size[1]
-                newMosaicV = Image.new('L', (mosaicVWidth, mosaicVHeight))
-                newMosaicV.paste(mosaicV, (0, 0, mosaicV.size[0], mosaicV.size[1]))
-                box = (leftV, topV, leftV + image.size[0], topV + image.size[1])
-                newMosaicV.paste(image, box)
-                mosaicV = newMosaicV
-
-                mosaicHWidth = mosaicH.size[0] + image.size[0] if topH == 0 else max(mosaicH.size[0], leftH + image.size[0])
-                mosaicHHeight = mosaicH.size[1] + image.size[1] if leftH == 0 else mosaicH.size[1]
-                newMosaicH = Image.new('L', (mosaicHWidth, mosaicHHeight))
-                newMosaicH.paste(mosaicH, (0, 0, mosaicH.size[0], mosaicH.size[1]))
-                box = (leftH, topH, leftH + image.size[0], topH + image.size[1])
-                newMosaicH.paste(image, box)
-                mosaicH = newMosaicH
-
-            leftV += image.size[0]
-            topH += image.size[1]
-        topV = mosaicV.size[1]
-        leftH = mosaicH.size[0]
-    mosaicV.save(str(previewPath / f'{prefix}mosaicV.png'), format='png')
-    mosaicH.save(str(previewPath / f'{prefix}mosaicH.png'), format='png')
-    return
+    previewImages = []
+    offsets = list(range(-halfBoundingBoxSize, halfBoundingBoxSize+1, sliceSpacing)) if sliceSpacing > 0 else []
+    for n in offsets:
+        slicePaths, sliceImages = saveSlicesAt(getSlice, shape, path, n, sizes, prefix)
+        paths.append(slicePaths)
+        previewImages.append(sliceImages)
+    slicePaths, sliceImages = saveSlicesAt(getSlice, shape, path, 0, sizes, f'{prefix}center_')
+    paths.append(slicePaths)
+    previewImages.append(sliceImages)
+    return paths, previewImages
+
+# Copy the tile in the canvas at (top, left), cropped to the canvas (and to bottom)
+def pasteTile(canvas, tile, top, left, bottom=None):
+    bottom = canvas.shape[0] if bottom is None else bottom
+    height = max(0, min(tile.shape[0], bottom - top))
+    width = max(0, min(tile.shape[1], canvas.shape[1] - left))
+    canvas[top:top+height, left:left+width] = tile[:height, :width]
+
+# The vertical mosaic has one row of slices per selected offset, the horizontal mosaic one column
+# Both are allocated at their final size: the rows of mosaicV are as high as their first slice (and as wide as the first row),
+# the columns of mosaicH are as wide as their widest slice (and as high as the first column), larger slices are cropped
+def createMosaic(previewImages, previewPath, prefix=''):
+    groups = [previewImages[i] for i in range(0, len(previewImages), max(1, len(previewImages) // mosaicSpacing))]
+
+    rowTops = np.cumsum([0] + [group[0].shape[0] for group in groups])
+    mosaicV = np.zeros((rowTops[-1], sum(image.shape[1] for image in groups[0])), dtype=np.uint8)
+    for group, top, bottom in zip(groups, rowTops[:-1], rowTops[1:]):
+        left = 0
+        for image in group:
+            pasteTile(mosaicV, image, top, left, bottom)
+            left += image.shape[1]
+
+    columnLefts = np.cumsum([0] + [max(image.shape[1] for image in group) for group in groups])
+    mosaicH = np.zeros((sum(image.shape[0] for image in groups[0]), columnLefts[-1]), dtype=np.uint8)
+    for group, left in zip(groups, columnLefts[:-1]):
+        top = 0
+        for image in group:
+            pasteTile(mosaicH, image, top, left)
+            top += image.shape[0]
+
+    if outputMode == 'png':
+        saveImage(mosaicV, str(previewPath / f'{prefix}mosaicV.png'))
+        saveImage(mosaicH, str(previewPath / f'{prefix}mosaicH.png'))
+    return mosaicV, mosaicH
+
+# Pack all the previews of a nifti in a single png: one row of slices (axial, coronal, sagittal) per offset, then the mosaics
+# Returns the name of the sprite sheet and the position of each preview in it: { tile name: [x, y, width, height] }
+def saveSpriteSheet(tiles, previewPath, prefix=''):
+    rows = tiles
+    columnWidths = [max(row[i][1].shape[1] for row in rows if i < len(row)) for i in range(max(len(row) for row in rows))]
+    rowTops = np.cumsum([0] + [max(image.shape[0] for name, image in row) for row in rows])
+    width = max(sum(columnWidths[:len(row)]) for row in rows)
+    sprite = np.zeros((rowTops[-1], width), dtype=np.uint8)
+    positions = {}
+    for row, top in zip(rows, rowTops[:-1]):
+        left = 0
+        for i, (name, image) in enumerate(row):
+            pasteTile(sprite, image, top, left)
+            positions[name] = [int(left), int(top), int(image.shape[1]), int(image.shape[0])]
+            left += columnWidths[i]
+    spriteName = f'{prefix}sprite.png'
+    saveImage(sprite, str(previewPath / spriteName))
+    return spriteName, positions
 
 newSpacing = (0.5, 0.5, 0.5)
 
-for patientPath in niftis.ls():
-    
-    if not patientPath.is_dir(): continue
-
-    print(patientPath.name)
-
-    niftiPaths = sorted(list(patientPath.glob('**/*.nii.gz')))
-
-    for niftiPath in niftiPaths:
-        
-        nifti = sitk.ReadImage(str(niftiPath))
-        
-        size = nifti.GetSize()
-        spacing = nifti.GetSpacing()
-        resampler = sitk.ResampleImageFilter()
-        resampler.SetSize([ int(size[0] * spacing[0] / newSpacing[0]), int(size[1] * spacing[1] / newSpacing[1]), int(size[2] * spacing[2] / newSpacing[2]) ])
-        resampler.SetOutputSpacing(newSpacing)
-        resampler.SetOutputOrigin(nifti.GetOrigin())
-        resampler.SetOutputDirection(nifti.GetDirection())
-        resampler.SetInterpolator(sitk.sitkLinear)
-        result = resampler.Execute(nifti)
-
-        niftiData = sitk.GetArrayFromImage(result)
-        minValue = np.min(niftiData)
-        maxValue = np.max(niftiData)
-        if maxValue > minValue:
-            niftiData = (255.0 * (niftiData - minValue)) / float(maxValue - minValue)
-        imagePaths = saveSlices(niftiData, destinationDirectory, prefix = niftiPath.parent.name + niftiPath.name)
-
-        if mosaicSpacing > 0:
-            createMosaic(imagePaths, destinationDirectory, prefix = niftiPath.parent.name + niftiPath.name)
+def getResampledSize(nifti):
+    size = nifti.GetSize()
+    spacing = nifti.GetSpacing()
+    return [ int(size[i] * spacing[i] / newSpacing[i]) for i in range(3) ]
+
+# Resample only the slices [start, start+count) along axis (axis of the numpy array, 0 is z) of the image resampled on newSpacing:
+# the output grid is the corresponding part of the grid of the whole resampled image, so the values are the same
+# for any spacing (not only the multiples of newSpacing) and direction, see tests/test_create_previews.py
+def resampleSlab(nifti, resampledSize, axis, start, count):
+    itkAxis = 2 - axis
+    size = list(resampledSize)
+    size[itkAxis] = count
+    direction = np.array(nifti.GetDirection()).reshape(3, 3)
+    origin = np.array(nifti.GetOrigin()) + direction[:, itkAxis] * start * newSpacing[itkAxis]
+    resampler = sitk.ResampleImageFilter()
+    resampler.SetSize(size)
+    resampler.SetOutputSpacing(newSpacing)
+    resampler.SetOutputOrigin([float(o) for o in origin])
+    resampler.SetOutputDirection(nifti.GetDirection())
+    resampler.SetInterpolator(sitk.sitkLinear)
+    return sitk.GetArrayFromImage(resampler.Execute(nifti))
+
+def resampleSlice(nifti, resampledSize, axis, index):
+    return np.take(resampleSlab(nifti, resampledSize, axis, index, 1), 0, axis=axis)
+
+# Intensities mapped to 0 and 255: the percentiles of the original image (histogram),
+# or the minimum and maximum of the resampled image, computed slab by slab (without resampling the whole image at once)
+def getIntensityWindow(nifti, resampledSize, method='minmax'):
+    if method == 'histogram':
+        data = sitk.GetArrayViewFromImage(nifti)
+        step = max(1, int(np.ceil((data.size / histogramSampleSize) ** (1 / 3))))
+        minValue, maxValue = np.percentile(data[::step, ::step, ::step], [0.5, 99.5])
+        return minValue, maxValue
+    minValue = maxValue = None
+    count = max(1, minmaxChunkSize // max(1, resampledSize[0] * resampledSize[1]))
+    for start in range(0, resampledSize[2], count):
+        slab = resampleSlab(nifti, resampledSize, 0, start, min(count, resampledSize[2] - start))
+        minValue = np.min(slab) if minValue is None else min(minValue, np.min(slab))
+        maxValue = np.max(slab) if maxValue is None else max(maxValue, np.max(slab))
+    return minValue, maxValue
+
+def getSliceGetter(nifti, resampledSize, minValue, maxValue, clip=False):
+    slices = {}
+    def getSlice(axis, index):
+        if (axis, index) not in slices:
+            sliceData = resampleSlice(nifti, resampledSize, axis, index)
+            if maxValue > minValue:
+                sliceData = (255.0 * (sliceData - minValue)) / float(maxValue - minValue)
+            slices[(axis, index)] = np.clip(sliceData, 0, 255) if clip else sliceData
+        return slices[(axis, index)]
+    return getSlice
+
+def createPreviews(niftiPath, destinationDirectory):
+    nifti = sitk.ReadImage(str(niftiPath))
+
+    # Only the previewed slices are resampled (instead of the whole image)
+    resampledSize = getResampledSize(nifti)
+    minValue, maxValue = getIntensityWindow(nifti, resampledSize, intensityWindow)
+    getSlice = getSliceGetter(nifti, resampledSize, minValue, maxValue, clip=intensityWindow == 'histogram')
+    imagePaths, previewImages = saveSlices(getSlice, resampledSize[::-1], destinationDirectory, prefix = niftiPath.parent.name + niftiPath.name)
+
+    mosaics = []
+    if mosaicSpacing > 0:
+        mosaics = createMosaic(previewImages, destinationDirectory, prefix = niftiPath.parent.name + niftiPath.name)
+    if outputMode == 'sprite':
+        prefix = niftiPath.parent.name + niftiPath.name
+        # Tiles are named as the png they replace (without the prefix)
+        tiles = [[(path.name[len(prefix):-len('.png')], image) for path, image in zip(paths, images)] for paths, images in zip(imagePaths, previewImages)]
+        tiles += [[(name, mosaic)] for name, mosaic in zip(['mosaicV', 'mosaicH'], mosaics)]
+        spriteName, positions = saveSpriteSheet(tiles, destinationDirectory, prefix)
+        return { 'sprite': spriteName, 'tiles': positions }
+    return imagePaths
+
+def getFileHash(path):
+    fileHash = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            fileHash.update(chunk)
+    return fileHash.hexdigest()
+
+def getFileState(path):
+    stat = os.stat(path)
+    return { 'mtime_ns': stat.st_mtime_ns, 'size': stat.st_size }
+
+def loadManifest(manifestPath):
+    if not manifestPath.exists(): return {}
+    with open(manifestPath, 'r') as f:
+        return json.load(f)
+
+def saveManifest(manifestPath, manifest):
+    temporaryPath = manifestPath.with_suffix('.json.tmp')
+    with open(temporaryPath, 'w') as f:
+        json.dump(manifest, f, indent=1)
+    os.replace(temporaryPath, manifestPath)
+
+# The previews of a nifti are up to date if it was previewed with the same options and has not changed since
+# (its hash is only computed when its modification time changed but not its size)
+def isUpToDate(niftiPath, entry, options):
+    # Manifests written before --output_mode previewed in png
+    if entry is None or dict({ 'output_mode': 'png' }, **entry.get('options', {})) != options: return False
+    state = getFileState(niftiPath)
+    if state['size'] != entry['size']: return False
+    if state['mtime_ns'] == entry['mtime_ns']: return True
+    if getFileHash(niftiPath) != entry['hash']: return False
+    entry.update(state)
+    return True
+
+# Worker: create the previews of a nifti, returns its manifest entry
+def previewNifti(niftiPath, destinationDirectory, options):
+    state = getFileState(niftiPath)
+    previews = createPreviews(niftiPath, destinationDirectory)
+    entry = dict(state, hash=getFileHash(niftiPath), options=options)
+    if options['output_mode'] == 'sprite':
+        entry['previews'] = previews
+    return entry
+
+# Write the index of the sprite sheets (from the manifest, which also lists the niftis previewed by previous runs) and its html viewer
+def saveIndex(destinationDirectory, manifest):
+    index = { niftiPath: entry['previews'] for niftiPath, entry in manifest.items() if 'previews' in entry }
+    if len(index) == 0: return
+    with open(destinationDirectory / indexName, 'w') as f:
+        json.dump(index, f)
+    with open(destinationDirectory / viewerName, 'w') as f:
+        f.write(viewerHtml)
+
+def getNiftiPaths(niftis, since=None):
+    niftiPaths = []
+    for patientPath in niftis.ls():
+        if not patientPath.is_dir(): continue
+        for niftiPath in sorted(list(patientPath.glob('**/*.nii.gz'))):
+            if since is not None and niftiPath.stat().st_mtime < since.timestamp(): continue
+            niftiPaths.append(niftiPath)
+    return niftiPaths
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(
+        prog=__file__,
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+        description="""Create nifti previews""")
+
+    parser.add_argument('-d', '--data', required=True, help='Path to the directory containing the niftis.')
+    parser.add_argument('-o', '--output', default=None, help='Path to the destination directory. Defaults to the same directory as the input directory.')
+    parser.add_argument('-s', '--slice_spacing', default=5, help='The number of slices per preview image (default = 5, meaning it will save 1 slice every 5 slices).')
+    parser.add_argument('-n', '--bounding_box_size', default=200, help='Number of frames to consider for the preview bounding box (images are resampled on 0.5x0.5x0.5 mm).')
+    parser.add_argument('-m', '--mosaic_spacing', default=5, help='Number of preview images in mosaic.')
+    parser.add_argument('-iw', '--intensity_window', default='minmax', choices=['minmax', 'histogram'], help='Intensities mapped to black and white: the minimum and maximum of the image (default), or the 0.5 and 99.5 percentiles of a subsample of the image (robust to outliers).')
+    parser.add_argument('-om', '--output_mode', default='png', choices=['png', 'sprite'], help=f'png: save each preview in its own png file. sprite: pack all the previews of a nifti in a single png (sprite sheet) and write their positions in {indexName}, which can be browsed with {viewerName} (from a web server, the html fetches the json).')
+    parser.add_argument('-j', '--jobs', type=int, default=1, help='Number of niftis previewed in parallel (in separate processes).')
+    parser.add_argument('-sn', '--since', default=None, help='Only preview the niftis modified since this date (ISO format, for example 2024-05-31 or 2024-05-31T20:00).')
+    parser.add_argument('-f', '--force', default=False, action='store_true', help=f'Recreate the previews of all the niftis, even those which did not change since their previews were created (according to {manifestName} in the destination directory).')
+
+    args = parser.parse_args()
+
+    niftis = Path(args.data)
+    destinationDirectory = Path(args.data) if args.output is None else Path(args.output)
+    destinationDirectory.mkdir(parents=True, exist_ok=True)
+    options = { 'slice_spacing': int(args.slice_spacing), 'bounding_box_size': int(args.bounding_box_size), 'mosaic_spacing': int(args.mosaic_spacing), 'intensity_window': args.intensity_window, 'output_mode': args.output_mode }
+    setOptions(options)
+
+    manifestPath = destinationDirectory / manifestName
+    manifest = loadManifest(manifestPath)
+
+    since = datetime.fromisoformat(args.since) if args.since else None
+    niftiPaths = [niftiPath for niftiPath in getNiftiPaths(niftis, since) if args.force or not isUpToDate(niftiPath, manifest.get(str(niftiPath.relative_to(niftis))), options)]
+    print(f'Creating the previews of {len(niftiPaths)} niftis...')
+
+    # Single writer: only the main process updates the manifest
+    try:
+        if args.jobs > 1:
+            with ProcessPoolExecutor(max_workers=args.jobs, initializer=setOptions, initargs=(options,)) as executor:
+                futures = { executor.submit(previewNifti, niftiPath, destinationDirectory, options): niftiPath for niftiPath in niftiPaths }
+                for n, future in enumerate(as_completed(futures)):
+                    niftiPath = futures[future]
+                    try:
+                        manifest[str(niftiPath.relative_to(niftis))] = future.result()
+                    except Exception as e:
+                        print(f'Previews of {niftiPath} failed: {e}')
+                        continue
+                    print(f'[{n+1}/{len(niftiPaths)}] {niftiPath}')
+                    if (n + 1) % 100 == 0: saveManifest(manifestPath, manifest)
+        else:
+            for n, niftiPath in enumerate(niftiPaths):
+                print(f'[{n+1}/{len(niftiPaths)}] {niftiPath}')
+                manifest[str(niftiPath.relative_to(niftis))] = previewNifti(niftiPath, destinationDirectory, options)
+                if (n + 1) % 100 == 0: saveManifest(manifestPath, manifest)
+    finally:
+        saveManifest(manifestPath, manifest)
+        saveIndex(destinationDirectory, manifest)
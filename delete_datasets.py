@@ -1,12 +1,10 @@
 import json
 import argparse
-import logging
 import os
-import time
 import sys
-from datetime import datetime
 
 import shanoir_util
+import shanoir_deletion
 from pathlib import Path
 Path.ls = lambda x: sorted(list(x.iterdir()))
 
@@ -41,32 +39,21 @@ if __name__ == '__main__':
     parser = create_arg_parser()
     add_common_arguments(parser)
     add_deletion_arguments(parser)
+    shanoir_deletion.add_engine_arguments(parser)
     add_configuration_arguments(parser)
     args = parser.parse_args()
     config = shanoir_util.initialize(args)
 
-    SHANOIR_SHUTDOWN_HOUR = 2
-    SHANOIR_AVAILABLE_HOUR = 5
-
     # Get dataset Ids file
     dataset_ids = Path(args.dataset_ids) if args.dataset_ids else None
     if args.dataset_ids and not dataset_ids.exists():
         sys.exit('Error: given file does not exist: ' + str(dataset_ids))
 
     if dataset_ids:
-        with open(dataset_ids) as file:
-            dataset_id_list = [dataset_id.strip() for dataset_id in file]
-
-            for dataset_id in dataset_id_list:
-                now = datetime.now()
-                if now.hour >= SHANOIR_SHUTDOWN_HOUR and now.hour < SHANOIR_AVAILABLE_HOUR:
-                    future = datetime(now.year, now.month, now.day, SHANOIR_AVAILABLE_HOUR, 0)
-                    time.sleep((future-now).total_seconds())
-                result = shanoir_util.deleteDataset(config, dataset_id)
-                if result == 204:
-                    logging.info("Dataset " + dataset_id + " deleted with success.")
-                else:
-                    logging.error("Dataset " + dataset_id + ": Error during deletion " + str(result))
-                time.sleep(1)
+        journal = shanoir_deletion.get_journal_path(dataset_ids, args.journal)
+        try:
+            shanoir_deletion.delete_ids(config, 'dataset', shanoir_deletion.read_ids(dataset_ids), journal, args.jobs, args.rate, args.max_retries, args.retry_failed)
+        except ConnectionError as e:
+            sys.exit(f'Error: {e}')
 
 #python3 ./delete_datasets.py -lf /tmp/test.log -u XXXX -d shanoir-ng-nginx -dids ./datasets.txt
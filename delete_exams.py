@@ -1,12 +1,10 @@
 import json
 import argparse
-import logging
 import os
-import time
 import sys
-from datetime import datetime
 
 import shanoir_util
+import shanoir_deletion
 from pathlib import Path
 Path.ls = lambda x: sorted(list(x.iterdir()))
 
@@ -41,32 +39,21 @@ if __name__ == '__main__':
     parser = create_arg_parser()
     add_common_arguments(parser)
     add_deletion_arguments(parser)
+    shanoir_deletion.add_engine_arguments(parser)
     add_configuration_arguments(parser)
     args = parser.parse_args()
     config = shanoir_util.initialize(args)
 
-    SHANOIR_SHUTDOWN_HOUR = 2
-    SHANOIR_AVAILABLE_HOUR = 5
-
     # Get examination Ids file
     examination_ids = Path(args.examination_ids) if args.examination_ids else None
     if args.examination_ids and not examination_ids.exists():
         sys.exit('Error: given file does not exist: ' + str(examination_ids))
 
     if examination_ids:
-        with open(examination_ids) as file:
-            examination_id_list = [examination_id.strip() for examination_id in file]
-
-            for examination_id in examination_id_list: 
-                now = datetime.now()
-                if now.hour >= SHANOIR_SHUTDOWN_HOUR and now.hour < SHANOIR_AVAILABLE_HOUR:
-                    future = datetime(now.year, now.month, now.day, SHANOIR_AVAILABLE_HOUR, 0)
-                    time.sleep((future-now).total_seconds())
-                result = shanoir_util.deleteExamination(config, examination_id)
-                if result == 204:
-                    logging.info("Examination " + examination_id + " deleted with success.")
-                else:
-                    logging.error("Examination " + examination_id + ": Error during deletion " + str(result))
-                time.sleep(1)
+        journal = shanoir_deletion.get_journal_path(examination_ids, args.journal)
+        try:
+            shanoir_deletion.delete_ids(config, 'examination', shanoir_deletion.read_ids(examination_ids), journal, args.jobs, args.rate, args.max_retries, args.retry_failed)
+        except ConnectionError as e:
+            sys.exit(f'Error: {e}')
 
 #python3 ./delete_exams.py -lf /tmp/test.log -u XXXX -d shanoir-ng-nginx -eids ./exams.txt
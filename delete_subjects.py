@@ -1,12 +1,10 @@
 import json
 import argparse
-import logging
 import os
-import time
 import sys
-from datetime import datetime
 
 import shanoir_util
+import shanoir_deletion
 from pathlib import Path
 Path.ls = lambda x: sorted(list(x.iterdir()))
 
@@ -45,6 +43,7 @@ if __name__ == '__main__':
     add_common_arguments(parser)
     add_service_argument(parser)
     add_deletion_arguments(parser)
+    shanoir_deletion.add_engine_arguments(parser)
     add_configuration_arguments(parser)
     args = parser.parse_args()
     config = shanoir_util.initialize(args)
@@ -55,15 +54,10 @@ if __name__ == '__main__':
         sys.exit('Error: given file does not exist: ' + str(subject_ids))
 
     if subject_ids:
-        with open(subject_ids) as file:
-            subject_id_list = [subject_id.strip() for subject_id in file]
-
-            for subject_id in subject_id_list: 
-                result = shanoir_util.deleteSubject(config, subject_id)
-                if result == 204:
-                    logging.error("Subject " + subject_id + " deleted with success.")
-                else:
-                    logging.error("Subject " + subject_id + ": Error during deletion " + str(result))
-                time.sleep(1)
+        journal = shanoir_deletion.get_journal_path(subject_ids, args.journal)
+        try:
+            shanoir_deletion.delete_ids(config, 'subject', shanoir_deletion.read_ids(subject_ids), journal, args.jobs, args.rate, args.max_retries, args.retry_failed, service=args.service)
+        except ConnectionError as e:
+            sys.exit(f'Error: {e}')
 
 #python3 ./delete_subject.py -lf /tmp/test.log -u XXXX -d shanoir-ng-nginx -s datasets -sids ./subjects.txt
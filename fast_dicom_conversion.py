@@ -0,0 +1,109 @@
+import io
+import zipfile
+from pathlib import Path
+import numpy as np
+import pydicom
+import SimpleITK as sitk
+
+# In-process conversion of standard series (single-frame 2D MR slices) from a zip archive to nifti, without extracting the archive
+# nor spawning a converter. Any unusual series raises UnsupportedSeries: the caller then falls back to the external converters.
+
+# Relative tolerance on the spacing between consecutive slices
+SLICE_SPACING_TOLERANCE = 0.01
+
+class UnsupportedSeries(Exception):
+    pass
+
+def read_zip_series(zip_path):
+    datasets = []
+    with zipfile.ZipFile(str(zip_path), 'r') as zip_ref:
+        for member in zip_ref.infolist():
+            if member.is_dir(): continue
+            try:
+                datasets.append(pydicom.dcmread(io.BytesIO(zip_ref.read(member))))
+            except pydicom.errors.InvalidDicomError:
+                # Not a dicom (DICOMDIR are dicoms but have no pixel data, they are rejected below)
+                continue
+    return datasets
+
+def get_values(datasets, attribute):
+    return [dataset.get(attribute) for dataset in datasets]
+
+# Check that the series is a stack of single-frame 2D MR slices with the same geometry, and return the slices sorted along the slice normal
+def sort_standard_2d_series(datasets):
+    if len(datasets) < 2:
+        raise UnsupportedSeries(f'{len(datasets)} slice(s)')
+    datasets = [dataset for dataset in datasets if 'PixelData' in dataset]
+    for attribute in ['Modality', 'SeriesInstanceUID', 'Rows', 'Columns', 'SamplesPerPixel', 'BitsAllocated', 'PixelRepresentation']:
+        values = get_values(datasets, attribute)
+        if None in values or len(set(values)) != 1:
+            raise UnsupportedSeries(f'missing or different {attribute}')
+    if datasets[0].Modality != 'MR' or datasets[0].SamplesPerPixel != 1:
+        raise UnsupportedSeries(f'{datasets[0].Modality} with {datasets[0].SamplesPerPixel} sample(s) per pixel')
+    if any(int(dataset.get('NumberOfFrames', 1) or 1) > 1 for dataset in datasets):
+        raise UnsupportedSeries('multi-frame')
+    for attribute in ['ImageOrientationPatient', 'PixelSpacing', 'ImagePositionPatient']:
+        if None in get_values(datasets, attribute):
+            raise UnsupportedSeries(f'missing {attribute}')
+    orientations = np.array([[float(v) for v in dataset.ImageOrientationPatient] for dataset in datasets])
+    pixel_spacings = np.array([[float(v) for v in dataset.PixelSpacing] for dataset in datasets])
+    if not np.allclose(orientations, orientations[0], atol=1e-4) or not np.allclose(pixel_spacings, pixel_spacings[0], atol=1e-4):
+        raise UnsupportedSeries('different orientations or pixel spacings')
+
+    row_cosines, column_cosines = orientations[0][:3], orientations[0][3:]
+    normal = np.cross(row_cosines, column_cosines)
+    positions = np.array([[float(v) for v in dataset.ImagePositionPatient] for dataset in datasets])
+    distances = positions @ normal
+    order = np.argsort(distances)
+    spacings = np.diff(distances[order])
+    # Several slices at the same position (multi-echo, time series...) or irregular slices (gaps, localizers)
+    if np.any(spacings < 1e-3) or np.ptp(spacings) > SLICE_SPACING_TOLERANCE * np.mean(spacings):
+        raise UnsupportedSeries('duplicated or irregularly spaced slices')
+    return [datasets[i] for i in order], row_cosines, column_cosines, normal, float(np.mean(spacings))
+
+# Affine of the volume (voxel indices (column, row, slice) to patient coordinates, in the LPS dicom convention)
+def get_affine(first_dataset, row_cosines, column_cosines, normal, slice_spacing):
+    row_spacing, column_spacing = [float(v) for v in first_dataset.PixelSpacing]
+    affine = np.eye(4)
+    affine[:3, 0] = row_cosines * column_spacing
+    affine[:3, 1] = column_cosines * row_spacing
+    affine[:3, 2] = normal * slice_spacing
+    affine[:3, 3] = [float(v) for v in first_dataset.ImagePositionPatient]
+    return affine
+
+def stack_slices(datasets):
+    slopes = [float(dataset.get('RescaleSlope', 1) or 1) for dataset in datasets]
+    intercepts = [float(dataset.get('RescaleIntercept', 0) or 0) for dataset in datasets]
+    rescaled = any(slope != 1 for slope in slopes) or any(intercept != 0 for intercept in intercepts)
+    first_pixels = datasets[0].pixel_array
+    volume = np.empty((len(datasets),) + first_pixels.shape, dtype=np.float32 if rescaled else first_pixels.dtype)
+    for i, dataset in enumerate(datasets):
+        pixels = first_pixels if i == 0 else dataset.pixel_array
+        if pixels.shape != first_pixels.shape:
+            raise UnsupportedSeries('different slice shapes')
+        volume[i] = pixels * slopes[i] + intercepts[i] if rescaled else pixels
+    return volume
+
+# Convert the series of a zip archive, returns the first dicom dataset (for its header attributes)
+def convert_zip(zip_path, output_path):
+    datasets = read_zip_series(zip_path)
+    datasets, row_cosines, column_cosines, normal, slice_spacing = sort_standard_2d_series(datasets)
+    try:
+        volume = stack_slices(datasets)
+    except UnsupportedSeries:
+        raise
+    except Exception as e:
+        # Compressed transfer syntax without decoder...
+        raise UnsupportedSeries(f'could not read the pixel data: {e}')
+    affine = get_affine(datasets[0], row_cosines, column_cosines, normal, slice_spacing)
+    spacing = np.linalg.norm(affine[:3, :3], axis=0)
+
+    image = sitk.GetImageFromArray(volume)
+    image.SetSpacing([float(s) for s in spacing])
+    image.SetOrigin([float(o) for o in affine[:3, 3]])
+    # SimpleITK (like dicom) uses LPS coordinates, the nifti writer converts them to RAS
+    image.SetDirection([float(d) for d in (affine[:3, :3] / spacing).flatten()])
+    output_path = Path(output_path)
+    output_path.parent.mkdir(parents=True, exist_ok=True)
+    sitk.WriteImage(image, str(output_path), True)
+    return datasets[0]
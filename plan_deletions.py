@@ -0,0 +1,145 @@
+import json
+import logging
+import sys
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+import shanoir_util
+import shanoir_deletion
+import delete_datasets
+
+# Plan the deletion of subjects, examinations and datasets: fetch the subject -> examination -> dataset hierarchy once,
+# remove the deletions of the children of deleted parents (deleting a subject deletes its examinations, deleting an examination deletes its datasets),
+# then delete the remaining ids stage by stage (datasets, examinations, subjects), each stage in parallel with the deletion engine
+
+STAGES = ['dataset', 'examination', 'subject']
+
+def add_planner_arguments(parser):
+    parser.add_argument('-sids', '--subject_ids', default='', help='Path to a file containing the subject ids to delete (a .txt file containing one subject id per line).')
+    parser.add_argument('-eids', '--examination_ids', default='', help='Path to a file containing the examination ids to delete (a .txt file containing one examination id per line).')
+    parser.add_argument('-dids', '--dataset_ids', default='', help='Path to a file containing the dataset ids to delete (a .txt file containing one dataset id per line).')
+    parser.add_argument('-st', '--study_id', default=None, help='The study of the subjects (required to find the examinations of the subjects).')
+    parser.add_argument('-s', '--service', nargs='+', default=['studies'], help='The services in which the subjects are deleted (studies and/or datasets).')
+    parser.add_argument('-nc', '--no_cascade', default=False, action='store_true', help='Do not rely on the server to delete the children of a deleted parent: delete explicitly all the examinations of the subjects and all the datasets of the examinations (before their parents).')
+    parser.add_argument('-dr', '--dry_run', default=False, action='store_true', help='Only fetch the hierarchy and report the planned requests and the estimated duration, without deleting anything.')
+    parser.add_argument('-p', '--plan', default='deletion_plan.json', help='Path of the json file where the plan (the ids deleted at each stage) is written. The journal of the deletions is written next to it (see --journal).')
+    return parser
+
+def read_ids_file(path):
+    if not path: return []
+    if not Path(path).exists():
+        sys.exit('Error: given file does not exist: ' + str(path))
+    return shanoir_deletion.read_ids(path)
+
+class HierarchyFetcher:
+    """
+    Fetches the examinations of the subjects and the datasets of the examinations in parallel, and measures the duration of the requests
+    """
+
+    def __init__(self, client, jobs):
+        self.client = client
+        self.jobs = jobs
+        self.durations = []
+        self.lock = threading.Lock()
+
+    def timed(self, function, *args):
+        start = time.perf_counter()
+        result = function(*args)
+        with self.lock:
+            self.durations.append(time.perf_counter() - start)
+        return result
+
+    def get_examination_ids(self, subject_ids, study_id):
+        with ThreadPoolExecutor(max_workers=self.jobs) as executor:
+            examinations = executor.map(lambda subject_id: self.timed(self.client.get_subject_examinations, subject_id, study_id), subject_ids)
+            return { subject_id: [str(examination['id']) for examination in subject_examinations] for subject_id, subject_examinations in zip(subject_ids, examinations) }
+
+    def get_dataset_ids(self, examination_ids):
+        with ThreadPoolExecutor(max_workers=self.jobs) as executor:
+            acquisitions = executor.map(lambda examination_id: self.timed(self.client.get_examination_acquisitions, examination_id), examination_ids)
+            return { examination_id: [str(dataset['id']) for acquisition in examination_acquisitions for dataset in acquisition.get('datasets') or []] for examination_id, examination_acquisitions in zip(examination_ids, acquisitions) }
+
+    def mean_duration(self):
+        return sum(self.durations) / len(self.durations) if len(self.durations) > 0 else None
+
+# Returns the ids to delete at each stage, and the number of redundant deletions removed
+def plan_deletions(fetcher, subject_ids, examination_ids, dataset_ids, study_id=None, cascade=True):
+    subject_ids = list(dict.fromkeys(subject_ids))
+    examination_ids = list(dict.fromkeys(examination_ids))
+    dataset_ids = list(dict.fromkeys(dataset_ids))
+
+    subject_examinations = fetcher.get_examination_ids(subject_ids, study_id) if len(subject_ids) > 0 else {}
+    examinations_of_subjects = list(dict.fromkeys(examination_id for ids in subject_examinations.values() for examination_id in ids))
+    # The datasets of all the examinations deleted (explicitly or with their subject)
+    all_examination_ids = list(dict.fromkeys(examinations_of_subjects + examination_ids))
+    examination_datasets = fetcher.get_dataset_ids(all_examination_ids) if len(all_examination_ids) > 0 and (len(dataset_ids) > 0 or not cascade) else {}
+    datasets_of_examinations = set(dataset_id for ids in examination_datasets.values() for dataset_id in ids)
+    deleted_examinations_of_subjects = set(examinations_of_subjects)
+
+    if cascade:
+        plan = {
+            'subject': subject_ids,
+            'examination': [examination_id for examination_id in examination_ids if examination_id not in deleted_examinations_of_subjects],
+            'dataset': [dataset_id for dataset_id in dataset_ids if dataset_id not in datasets_of_examinations],
+        }
+    else:
+        plan = {
+            'subject': subject_ids,
+            'examination': all_examination_ids,
+            'dataset': list(dict.fromkeys(dataset_ids + [dataset_id for ids in examination_datasets.values() for dataset_id in ids])),
+        }
+    n_redundant = len(examination_ids) + len(dataset_ids) - len(plan['examination']) - len(plan['dataset']) if cascade else 0
+    return plan, n_redundant
+
+def estimate_duration(n_requests, jobs, rate, request_duration):
+    if n_requests == 0: return 0
+    throughput = jobs / request_duration if request_duration else float('inf')
+    if rate and rate > 0:
+        throughput = min(throughput, rate)
+    return n_requests / throughput if throughput != float('inf') else None
+
+def report_plan(plan, n_redundant, services, jobs, rate, request_duration):
+    n_requests = { stage: len(plan[stage]) * (len(services) if stage == 'subject' else 1) for stage in STAGES }
+    total = sum(n_requests.values())
+    for stage in STAGES:
+        duration = estimate_duration(n_requests[stage], jobs, rate, request_duration)
+        logging.info(f'{stage}s: {len(plan[stage])} to delete, {n_requests[stage]} requests, estimated duration: {"unknown" if duration is None else f"{duration:.0f} seconds"}')
+    duration = sum(estimate_duration(n_requests[stage], jobs, rate, request_duration) or 0 for stage in STAGES)
+    logging.info(f'Total: {total} deletion requests ({n_redundant} redundant deletions removed), estimated duration: {duration:.0f} seconds with {jobs} jobs at {rate} requests per second (mean request duration: {"unknown" if request_duration is None else f"{request_duration:.2f} seconds"}).')
+    return total, duration
+
+if __name__ == '__main__':
+    parser = delete_datasets.create_arg_parser('Plan and run the deletion of subjects, examinations and datasets')
+    delete_datasets.add_common_arguments(parser)
+    add_planner_arguments(parser)
+    shanoir_deletion.add_engine_arguments(parser)
+    delete_datasets.add_configuration_arguments(parser)
+    args = parser.parse_args()
+    config = shanoir_util.initialize(args)
+
+    subject_ids = read_ids_file(args.subject_ids)
+    if len(subject_ids) > 0 and args.study_id is None:
+        sys.exit('Error: --study_id is required to delete subjects.')
+
+    try:
+        fetcher = HierarchyFetcher(shanoir_util.get_client(config), args.jobs)
+        plan, n_redundant = plan_deletions(fetcher, subject_ids, read_ids_file(args.examination_ids), read_ids_file(args.dataset_ids), args.study_id, not args.no_cascade)
+
+        with open(args.plan, 'w') as file:
+            json.dump(plan, file, indent=4)
+        report_plan(plan, n_redundant, args.service, args.jobs, args.rate, fetcher.mean_duration())
+
+        if not args.dry_run:
+            journal = shanoir_deletion.get_journal_path(args.plan, args.journal)
+            # The children first: a parent is deleted after its remaining children
+            for stage in STAGES:
+                if len(plan[stage]) == 0: continue
+                services = args.service if stage == 'subject' else [None]
+                for service in services:
+                    shanoir_deletion.delete_ids(config, stage, plan[stage], journal, args.jobs, args.rate, args.max_retries, args.retry_failed, service=service)
+    except ConnectionError as e:
+        sys.exit(f'Error: {e}')
+
+#python3 ./plan_deletions.py -lf /tmp/test.log -u XXXX -d shanoir-ng-nginx -st 17 -sids ./subjects.txt -dids ./datasets.txt --dry_run
@@ -9,7 +9,6 @@ shanoir2bids.py is a script that allows to download a Shanoir dataset and organi
 import os
 from os.path import join as opj, splitext as ops, exists as ope, dirname as opd
 import re
-from glob import glob
 import sys
 from pathlib import Path
 from time import time
@@ -18,10 +17,15 @@ import datetime
 import tempfile
 from dateutil import parser
 import json
+import csv
+import hashlib
 import logging
 import shutil
+import subprocess
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
 
 import shanoir_downloader
+import shanoir_metrics
 from dotenv import load_dotenv
 from heudiconv.main import workflow
 from heudiconv.bids import sanitize_label
@@ -72,6 +76,11 @@ K_BIDS_NAME = "bidsName"
 K_BIDS_DIR = "bidsDir"
 K_BIDS_SES = "bidsSession"
 K_DS_NAME = "datasetName"
+# Key added to the solr search items: the configured session whose search found the dataset
+K_ITEM_SESSION = "shanoir2bidsSession"
+
+# Number of solr searches (one per sequence and session) sent at the same time for a subject
+SEARCH_JOBS = 8
 
 # Define Extensions that are dealt so far by (#todo : think of other possible extensions ?)
 NIFTI = ".nii"
@@ -81,6 +90,19 @@ BVAL = ".bval"
 BVEC = ".bvec"
 DCM = ".dcm"
 
+# Manifest of the converted datasets, in the BIDS directory: maps each Shanoir datasetId to the BIDS files it produced
+# and to the fingerprint of its conversion, so that re-runs only convert new or changed datasets
+MANIFEST_FILENAME = ".shanoir2bids_manifest.json"
+# Fields of the solr search results which identify a version of a dataset
+FINGERPRINT_DATASET_KEYS = [
+    "datasetName",
+    "datasetCreationDate",
+    "examinationDate",
+    "examinationComment",
+    "subjectName",
+    "studyName",
+]
+
 # Shanoir parameters
 SHANOIR_FILE_TYPE_NIFTI = "nifti"
 SHANOIR_FILE_TYPE_DICOM = "dicom"
@@ -103,6 +125,196 @@ def create_tmp_directory(path_temporary_directory):
     pass
 
 
+def extract_dicoms(archive, extraction_dir):
+    """
+    Extract the DICOM files of a downloaded archive member by member (streamed to the disk, the archive is not
+    loaded in memory)
+    :param archive: str, path of the zip archive
+    :param extraction_dir: str, destination directory of the series
+    :return: list of the extracted DICOM files
+    """
+    dicom_files = []
+    with shanoir_metrics.stage("extract"), zipfile.ZipFile(archive, "r") as zip_ref:
+        for member in zip_ref.infolist():
+            if member.is_dir() or not member.filename.lower().endswith(".dcm"):
+                continue
+            dicom_files.append(zip_ref.extract(member, extraction_dir))
+    return dicom_files
+
+
+def escape_solr_special_characters(s):
+    # List of Solr special characters
+    special_characters = r'\+\-\!\(\)\{\}\[\]\^"~\?:\\'
+    # remove \* from special characters to be able to use wildcards in solr
+    # Add more if needed
+    escape_pattern = re.compile(r'([{}])'.format(special_characters))
+    return escape_pattern.sub(r'\\\1', s)
+
+
+def get_heudiconv_command():
+    """
+    Command line of heudiconv: the installed script, or the module run with the current python
+    """
+    heudiconv = shutil.which("heudiconv")
+    return [heudiconv] if heudiconv is not None else [sys.executable, "-m", "heudiconv.cli.run"]
+
+
+def move_tree(src_dir, dst_dir):
+    """
+    Move all files of src_dir into dst_dir, merging the sub-directories and overwriting existing files
+    """
+    src_dir, dst_dir = Path(src_dir), Path(dst_dir)
+    for src in sorted(src_dir.rglob("*")):
+        if src.is_dir():
+            continue
+        dst = dst_dir / src.relative_to(src_dir)
+        dst.parent.mkdir(parents=True, exist_ok=True)
+        if src.name.endswith("_scans.tsv") and dst.exists():
+            merge_tsv(src, dst, "filename")
+        else:
+            os.replace(src, dst)
+    shutil.rmtree(src_dir, ignore_errors=True)
+
+
+def merge_tsv(src_file, dst_file, key):
+    """
+    Merge the rows of the tsv file src_file into dst_file (rows are identified by their key column)
+    """
+    fieldnames = []
+    rows = {}
+    for path in [dst_file, src_file]:
+        with open(path, newline="", encoding="utf-8") as file:
+            reader = csv.DictReader(file, delimiter="\t")
+            fieldnames += [name for name in reader.fieldnames or [] if name not in fieldnames]
+            for row in reader:
+                rows[row[key]] = row
+    with open(dst_file, "w", newline="", encoding="utf-8") as file:
+        writer = csv.DictWriter(file, fieldnames=fieldnames, delimiter="\t", restval="n/a", lineterminator="\n")
+        writer.writeheader()
+        for row_key in sorted(rows):
+            writer.writerow(rows[row_key])
+
+
+def merge_bids_directory(src_dir, dst_dir):
+    """
+    Merge a BIDS directory converted in isolation (by a worker process) into the main BIDS directory.
+    Must only be called by a single writer: directories (sub-*, .heudiconv) are merged, participants.tsv and *_scans.tsv rows are merged
+    and the other top level files (dataset_description.json, README, CHANGES...) are only copied if they do not exist yet.
+    :param src_dir: str, path of the isolated BIDS directory (removed once merged)
+    :param dst_dir: str, path of the main BIDS directory
+    """
+    src_dir, dst_dir = Path(src_dir), Path(dst_dir)
+    if not src_dir.exists():
+        return
+    for src in sorted(src_dir.iterdir()):
+        dst = dst_dir / src.name
+        if src.is_dir():
+            move_tree(src, dst)
+        elif src.name == "participants.tsv" and dst.exists():
+            merge_tsv(src, dst, "participant_id")
+        elif not dst.exists():
+            shutil.move(str(src), str(dst))
+    shutil.rmtree(src_dir, ignore_errors=True)
+
+
+def read_manifest(manifest_path):
+    if not ope(manifest_path):
+        return {}
+    with open(manifest_path, encoding="utf-8") as file:
+        return json.load(file)["datasets"]
+
+
+def write_manifest(manifest_path, manifest):
+    # Write in a temporary file first so that an interruption never leaves a truncated manifest
+    tmp_path = manifest_path + ".tmp"
+    with open(tmp_path, "w", encoding="utf-8") as file:
+        json.dump({"version": 1, "datasets": manifest}, file, indent=2, sort_keys=True)
+    os.replace(tmp_path, manifest_path)
+
+
+def list_subject_files(bids_dir, bids_subject_id):
+    """
+    List the files of a subject in a BIDS directory (including sourcedata)
+    :return: dict, modification time of each file path (relative to bids_dir)
+    """
+    subject_dir = "sub-" + sanitize_label(bids_subject_id)
+    files = {}
+    for root in [Path(bids_dir) / subject_dir, Path(bids_dir) / "sourcedata" / subject_dir]:
+        for path in root.rglob("*"):
+            if path.is_file():
+                files[str(path.relative_to(bids_dir))] = path.stat().st_mtime_ns
+    return files
+
+
+def match_bids_files(files, bids_dir_name, bids_name, bids_session=None):
+    """
+    Select the files of a BIDS key: the entries of a bids_dir_name folder (files, or key folders such as the DICOM
+    folders heudiconv writes in sourcedata) whose entities are those of bids_name (except the run which is added by
+    the heuristic) and of the session if any. The files inside a matched key folder are selected.
+    """
+    entities = set(entity for entity in bids_name.split("_") if not entity.startswith("run-"))
+    if bids_session is not None:
+        entities.add("ses-" + sanitize_label(bids_session))
+    matched_files = []
+    for f in files:
+        parts = Path(f).parts
+        for i, part in enumerate(parts[:-1]):
+            if part != bids_dir_name:
+                continue
+            entry_entities = set(
+                entity for entity in parts[i + 1].split(".")[0].split("_") if not entity.startswith(("sub-", "run-"))
+            )
+            if entry_entities == entities:
+                matched_files.append(f)
+                break
+    return sorted(matched_files)
+
+
+def remove_bids_files(bids_dir, files):
+    """
+    Remove files of a BIDS directory (the files of a previous conversion), their rows in the *_scans.tsv files,
+    and the folders left empty
+    :param files: list of file paths relative to bids_dir
+    """
+    bids_dir = Path(bids_dir)
+    scans_rows = {}
+    for f in files:
+        path = bids_dir / f
+        if path.is_file() or path.is_symlink():
+            path.unlink()
+        # The *_scans.tsv file of the session (or subject) lists the files relative to its folder, e.g. anat/sub-01_T1w.nii.gz
+        parts = Path(f).parts
+        if len(parts) >= 3 and parts[0].startswith("sub-"):
+            session_dir = bids_dir / parts[0] / parts[1] if parts[1].startswith("ses-") else bids_dir / parts[0]
+            scans_rows.setdefault(session_dir, set()).add(path.relative_to(session_dir).as_posix())
+        for parent in path.parents:
+            if parent == bids_dir:
+                break
+            try:
+                parent.rmdir()
+            except OSError:
+                break
+    for session_dir, filenames in scans_rows.items():
+        for scans_file in session_dir.glob("*_scans.tsv"):
+            with open(scans_file, newline="", encoding="utf-8") as file:
+                reader = csv.DictReader(file, delimiter="\t")
+                fieldnames = reader.fieldnames or []
+                rows = [row for row in reader if row.get("filename") not in filenames]
+            with open(scans_file, "w", newline="", encoding="utf-8") as file:
+                writer = csv.DictWriter(file, fieldnames=fieldnames, delimiter="\t", restval="n/a", lineterminator="\n")
+                writer.writeheader()
+                writer.writerows(rows)
+
+
+def datalad_save(bids_dir, message):
+    """
+    Save the BIDS directory as a datalad dataset (as heudiconv does after each subject conversion)
+    """
+    from heudiconv.external.dlad import add_to_datalad
+
+    add_to_datalad(str(bids_dir), str(bids_dir), message, True)
+
+
 def check_date_format(date_to_format):
     # TRUE FORMAT should be: date_format = 'Y-m-dTH:M:SZ'
     try:
@@ -289,7 +501,8 @@ class DownloadShanoirDatasetToBIDS:
         )
         self.shanoir_username = None  # Shanoir username
         self.shanoir_study_id = None  # Shanoir study ID
-        self.shanoir_session_id = None  # Shanoir study ID
+        self.shanoir_session_id = None  # Shanoir session (examination comment)
+        self.shanoir_sessions = None  # Sessions downloaded in a single pass: list of {"session": ..., "bidsSession": ...}
         self.shanoir_file_type = SHANOIR_FILE_TYPE_DICOM  # Download File Type (DICOM)
         self.output_file_type = (
             DEFAULT_SHANOIR_FILE_TYPE  # Default Export File Type (NIFTI)
@@ -298,6 +511,7 @@ class DownloadShanoirDatasetToBIDS:
         self.list_fars = []  # List of substrings to edit in subjects names
         self.dl_dir = None  # download directory, where data will be stored
         self.parser = None  # Shanoir Downloader Parser
+        self.client = None  # Shanoir client (http session and tokens), built once by get_shanoir_client()
         self.n_seq = 0  # Number of sequences in the shanoir2bids_dict
         self.log_fn = None
         self.dcm2niix_path = None  # Path to the dcm2niix the user wants to use
@@ -312,6 +526,18 @@ class DownloadShanoirDatasetToBIDS:
         self.add_sns = False  # Add series number suffix to filename
         self.debug_mode = False  # No debug mode by default
         self.datalad = True     # Activate datalad save by default
+        self.datalad_batch_size = 1  # Number of subjects per datalad save (0: a single save at the end)
+        self.unsaved_subjects = []  # Converted subjects waiting for the next datalad save
+        self.jobs = 1  # Number of subjects processed in parallel (in separate processes)
+        self.convert_jobs = 1  # Number of BIDS keys of a subject converted in parallel (1: a single heudiconv call per subject)
+        self.incremental = True  # Skip the datasets already converted (see MANIFEST_FILENAME)
+        self.manifest = {}  # Converted datasets: manifest entries by Shanoir dataset id
+
+    def __getstate__(self):
+        # The argparse parser cannot be pickled: it is configured again in the worker processes
+        state = self.__dict__.copy()
+        state["parser"] = None
+        return state
 
     def set_json_config_file(self, json_file):
         """
@@ -360,7 +586,21 @@ class DownloadShanoirDatasetToBIDS:
         self.shanoir_subjects = subjects
 
     def set_shanoir_session_id(self, session_id):
-        self.shanoir_session_id = session_id
+        """
+        :param session_id: str, Shanoir session (examination comment, may contain wildcards),
+                           or list of sessions (str or dict {"session": ..., "bidsSession": ...}), or "all"
+        """
+        if session_id == "all" or isinstance(session_id, list):
+            sessions = ["*"] if session_id == "all" else session_id
+            self.shanoir_sessions = [
+                session if isinstance(session, dict) else {K_JSON_SESSION: session} for session in sessions
+            ]
+            self.shanoir_session_id = None
+            # one ses-* folder per session
+            self.longitudinal = True
+        else:
+            self.shanoir_sessions = None
+            self.shanoir_session_id = session_id
 
     def set_shanoir_list_find_and_replace(self, list_fars):
         self.list_fars = list_fars
@@ -418,6 +658,38 @@ class DownloadShanoirDatasetToBIDS:
             Path(dir_log).mkdir(parents=True, exist_ok=True)
         self.log_fn = opj(self.dl_dir, 'shanoir_downloader_logs', basename)
 
+    def set_datalad_batch_size(self, datalad_batch_size):
+        self.datalad_batch_size = max(0, datalad_batch_size)
+
+    def is_saved_by_heudiconv(self, bids_dir=None):
+        # heudiconv saves each subject itself when subjects are converted sequentially in the BIDS directory, one save per subject
+        return self.datalad and bids_dir is None and self.datalad_batch_size == 1
+
+    def add_to_datalad_batch(self, subject_to_search):
+        """
+        Add a converted subject to the current datalad batch, save the batch once it contains self.datalad_batch_size subjects
+        """
+        self.unsaved_subjects.append(subject_to_search)
+        if 0 < self.datalad_batch_size <= len(self.unsaved_subjects):
+            self.save_datalad_batch()
+
+    def save_datalad_batch(self):
+        """
+        Save all the subjects converted since the last save with a single datalad save (one annex add and one commit)
+        """
+        if not self.datalad or len(self.unsaved_subjects) == 0:
+            return
+        with shanoir_metrics.stage("datalad_save"):
+            datalad_save(self.dl_dir, "Converted subjects " + ", ".join(self.unsaved_subjects))
+        self.unsaved_subjects = []
+
+    def set_jobs(self, jobs):
+        self.jobs = max(1, jobs)
+
+    def set_convert_jobs(self, convert_jobs):
+        # 0 means one conversion per CPU
+        self.convert_jobs = convert_jobs if convert_jobs > 0 else os.cpu_count() or 1
+
     def toggle_longitudinal_version(self):
         self.longitudinal = True
 
@@ -468,51 +740,35 @@ class DownloadShanoirDatasetToBIDS:
         else:
             normalised_subjects = subjects
 
-        sessions = list(
-            set(
-                [d["bidsSession"] for d in self.shanoir2bids_dict if "bidsSession" in d]
-            )
-        )
+        if self.shanoir_sessions is not None:
+            # Several sessions: the bidsSession of the sequences is not used (see get_bids_session), the sessions
+            # without bidsSession are named after the examination comments, only known once the datasets are found
+            sessions = [session[K_BIDS_SES] for session in self.shanoir_sessions if session.get(K_BIDS_SES)]
+            map_sessions = lambda map: sessions if len(sessions) > 0 else [None]
+        elif any(K_BIDS_SES in d for d in self.shanoir2bids_dict):
+            map_sessions = lambda map: [map[K_BIDS_SES]]
+        else:
+            map_sessions = lambda map: [None]
         extension = ".nii.gz"
 
-        if not sessions:
-            paths = (
-                "/"
-                + "sub-"
-                + sanitize_label(subject)
-                + "/"
-                + map["bidsDir"]
-                + "/"
-                + "sub-"
-                + sanitize_label(subject)
-                + "_"
-                + map["bidsName"]
-                + extension
-                for subject in normalised_subjects
-                for map in self.shanoir2bids_dict
-            )
-        else:
-            paths = (
-                "/"
-                + "sub-"
-                + sanitize_label(subject)
-                + "/"
-                + "ses-"
-                + sanitize_label(map["bidsSession"])
-                + "/"
-                + map["bidsDir"]
-                + "/"
-                + "sub-"
-                + sanitize_label(subject)
-                + "_"
-                + "ses-"
-                + sanitize_label(map["bidsSession"])
-                + "_"
-                + map["bidsName"]
-                + extension
-                for subject in normalised_subjects
-                for map in self.shanoir2bids_dict
-            )
+        paths = (
+            "/"
+            + "sub-"
+            + sanitize_label(subject)
+            + "/"
+            + ("ses-" + sanitize_label(session) + "/" if session is not None else "")
+            + map["bidsDir"]
+            + "/"
+            + "sub-"
+            + sanitize_label(subject)
+            + "_"
+            + ("ses-" + sanitize_label(session) + "_" if session is not None else "")
+            + map["bidsName"]
+            + extension
+            for subject in normalised_subjects
+            for map in self.shanoir2bids_dict
+            for session in map_sessions(map)
+        )
 
         bids_errors = [p for p in paths if not validator.is_bids(p)]
 
@@ -521,15 +777,264 @@ class DownloadShanoirDatasetToBIDS:
         else:
             return False, bids_errors
 
-    def download_subject(self, subject_to_search):
+    def get_shanoir_config(self, output_folder, search_txt=""):
+        """
+        Parse the shanoir_downloader arguments and initialize its configuration
+        (reads the proxy settings and configures the logging: use get_shanoir_client() instead of calling it repeatedly)
+        :param output_folder: str, folder where the archives are downloaded
+        :param search_txt: str, solr search text
+        :return: args, config
+        """
+        args = self.parser.parse_args(
+            [
+                "-u",
+                self.shanoir_username,
+                "-d",
+                self.shanoir_domaine,
+                "-of",
+                str(output_folder),
+                "-em",
+                "-st",
+                search_txt,
+                "-s",
+                "200",
+                "-f",
+                self.shanoir_file_type,
+                "-so",
+                "id,ASC",
+                "-t",
+                "500",
+                "-lf",
+                opj(self.dl_dir, "shanoir_downloader_logs", "downloads.log"),
+            ]
+        )  # Increase time out for heavy files
+        return args, shanoir_downloader.initialize(args)
+
+    def get_shanoir_client(self):
+        """
+        Shanoir client shared by all the searches and downloads of the process, built on first use
+        :return: shanoir_downloader.ShanoirClient
+        """
+        if self.client is None:
+            if self.parser is None:
+                self.configure_parser()
+            self.client = self.get_shanoir_config(self.dl_dir)[1]["client"]
+        return self.client
+
+    def get_search_text(self, subject_to_search, dataset_name, session):
+        """
+        Solr search text of the datasets of a subject with the given name and examination comment (may contain wildcards)
+        """
+        return (
+            "studyName:"
+            + escape_solr_special_characters(self.shanoir_study_id).replace(" ", "?")
+            + " AND datasetName:"
+            + escape_solr_special_characters(dataset_name).replace(" ", "?")
+            + " AND subjectName:"
+            + escape_solr_special_characters(subject_to_search).replace(" ", "?")
+            + " AND examinationComment:"
+            + escape_solr_special_characters(session).replace(" ", "*")
+            + " AND examinationDate:["
+            + self.date_from
+            + " TO "
+            + self.date_to
+            + "]"
+        )
+
+    def search_all_pages(self, search_txt):
+        """
+        :return: status code of the last response, list of the solr search items of all the pages
+        """
+        items = []
+        page_size = 500
+        page = 0
+        while True:
+            response = self.get_shanoir_client().search(
+                search_txt, expert_mode=True, page=page, size=page_size, sort="id,ASC"
+            )
+            if response.status_code != 200:
+                return response.status_code, items
+            content = response.json()["content"]
+            items += content
+            if len(content) < page_size:
+                return response.status_code, items
+            page += 1
+
+    def search_subject_datasets(self, subject_to_search, fp):
+        """
+        Search the Shanoir datasets of a subject for each sequence (and each session) defined in the configuration.
+        There is one solr search per sequence and session, sent in parallel: solr matches the dataset names and
+        the examination comments, and each result is assigned to the sequence and session of its search
+        (a dataset found for several sessions is assigned to the first one)
+        :param subject_to_search: str, Shanoir subject name
+        :param fp: log file
+        :return: list of (sequence dictionary of the configuration, solr search item)
+        """
+        sessions = (
+            self.shanoir_sessions
+            if self.shanoir_sessions is not None
+            else [{K_JSON_SESSION: self.shanoir_session_id}]
+        )
+        searches = [(seq_dict, session) for seq_dict in self.shanoir2bids_dict for session in sessions]
+        search_texts = [
+            self.get_search_text(subject_to_search, seq_dict[K_DS_NAME], session[K_JSON_SESSION])
+            for seq_dict, session in searches
+        ]
+        # No sequence (data_to_bids) or no session in the configuration: nothing to search
+        if len(search_texts) == 0:
+            return []
+        with ThreadPoolExecutor(max_workers=min(len(search_texts), SEARCH_JOBS)) as executor:
+            results = list(executor.map(self.search_all_pages, search_texts))
+
+        found_datasets = []
+        for seq, seq_dict in enumerate(self.shanoir2bids_dict):
+            found_ids = set()
+            for (search_seq_dict, session), search_txt, (status_code, items) in zip(searches, search_texts, results):
+                if search_seq_dict is not seq_dict:
+                    continue
+                print(search_txt)
+                if status_code == 204 or (status_code == 200 and len(items) == 0):
+                    warn_msg = """WARNING ! The Shanoir request returned 0 result. Make sure the following search text returns 
+a result on the website.
+Search Text : "{}" \n""".format(
+                        search_txt
+                    )
+                    print(warn_msg)
+                    fp.write(warn_msg)
+                elif status_code != 200:
+                    banner_msg("ERROR : Returned by the request: status of the response = " + str(status_code))
+                    fp.write("  >> ERROR : Returned by the request: status of the response = " + str(status_code) + "\n")
+                for item in items:
+                    if item["datasetId"] in found_ids:
+                        continue
+                    if self.shanoir_sessions is not None:
+                        item[K_ITEM_SESSION] = session
+                        if self.get_bids_session(seq_dict, item) is None:
+                            warn_msg = "  >> WARNING : dataset {} ({}) is ignored: its examination has no comment, set the bidsSession of the session {} in the configuration\n".format(
+                                item["datasetId"], item["datasetName"], session[K_JSON_SESSION]
+                            )
+                            print(warn_msg)
+                            fp.write(warn_msg)
+                            continue
+                    found_ids.add(item["datasetId"])
+                    found_datasets.append((seq_dict, item))
+            # Print the datasets found for each sequence
+            print(
+                "\t-",
+                seq_dict[K_BIDS_NAME],
+                subject_to_search,
+                "[" + str(seq + 1) + "/" + str(self.n_seq) + "]:",
+                len(found_ids),
+                "dataset(s)",
+            )
+        return found_datasets
+
+    def get_bids_session(self, seq_dict, item):
+        """
+        BIDS session of a dataset: the bidsSession of the configured session which found it (or its sanitized
+        examination comment, None if the comment is empty) when several sessions are downloaded,
+        the bidsSession of the sequence otherwise
+        """
+        if not self.longitudinal:
+            return None
+        if self.shanoir_sessions is None:
+            return seq_dict[K_BIDS_SES]
+        session = item.get(K_ITEM_SESSION) or {}
+        return session.get(K_BIDS_SES) or sanitize_label(item.get("examinationComment") or "") or None
+
+    def get_bids_key(self, seq_dict, item):
+        return seq_dict[K_BIDS_DIR], seq_dict[K_BIDS_NAME], self.get_bids_session(seq_dict, item)
+
+    def get_fingerprint(self, bids_subject_id, seq_dict, item):
+        """
+        Fingerprint of the conversion of a dataset: changes when the dataset or its conversion configuration change
+        """
+        content = {
+            "bids_subject_id": bids_subject_id,
+            "bids_key": self.get_bids_key(seq_dict, item),
+            "dataset_name": seq_dict[K_DS_NAME],
+            "output_type": self.output_file_type,
+            "dcm2niix_options": self.dcm2niix_opts,
+            "dataset": {key: item.get(key) for key in FINGERPRINT_DATASET_KEYS},
+        }
+        return hashlib.sha1(json.dumps(content, sort_keys=True, default=str).encode("utf-8")).hexdigest()
+
+    def is_converted(self, bids_subject_id, seq_dict, item):
+        entry = self.manifest.get(str(item["datasetId"]))
+        return (
+            entry is not None
+            and entry["fingerprint"] == self.get_fingerprint(bids_subject_id, seq_dict, item)
+            and len(entry["files"]) > 0
+            and all(ope(opj(self.dl_dir, f)) for f in entry["files"])
+        )
+
+    def get_datasets_to_convert(self, bids_subject_id, found_datasets):
+        """
+        Select the found datasets which must be (re)converted: all the datasets of a BIDS key (bidsDir, bidsName, session)
+        are converted together (to keep the run numbers consistent) when one of them is new, changed or was removed
+        :param bids_subject_id: str, BIDS subject id
+        :param found_datasets: list of (sequence dictionary, solr search item)
+        :return: list of (sequence dictionary, solr search item)
+        """
+        if not self.incremental:
+            return found_datasets
+        groups = {}
+        for seq_dict, item in found_datasets:
+            groups.setdefault(self.get_bids_key(seq_dict, item), []).append((seq_dict, item))
+        datasets_to_convert = []
+        for bids_key, datasets in groups.items():
+            dataset_ids = set(str(item["datasetId"]) for _, item in datasets)
+            removed = [
+                dataset_id
+                for dataset_id, entry in self.manifest.items()
+                if entry["bids_subject_id"] == bids_subject_id
+                and tuple(entry["bids_key"]) == bids_key
+                and dataset_id not in dataset_ids
+            ]
+            if len(removed) > 0 or not all(
+                self.is_converted(bids_subject_id, seq_dict, item) for seq_dict, item in datasets
+            ):
+                datasets_to_convert += datasets
+        return datasets_to_convert
+
+    def update_manifest(self, converted_datasets):
+        """
+        Record the converted datasets in the manifest, replacing the previous entries of the converted BIDS keys,
+        and remove the files of the previous conversions of these keys which were not produced again (e.g. a run
+        of a dataset removed from Shanoir) (single writer: the main process)
+        :param converted_datasets: dict, manifest entries by dataset id (returned by download_subject)
+        """
+        if not converted_datasets:
+            return
+        bids_keys = set(
+            (entry["bids_subject_id"], tuple(entry["bids_key"])) for entry in converted_datasets.values()
+        )
+        previous_files = set()
+        for dataset_id in list(self.manifest.keys()):
+            entry = self.manifest[dataset_id]
+            if (entry["bids_subject_id"], tuple(entry["bids_key"])) in bids_keys:
+                previous_files.update(entry["files"])
+                del self.manifest[dataset_id]
+        converted_files = set(f for entry in converted_datasets.values() for f in entry["files"])
+        remove_bids_files(self.dl_dir, sorted(previous_files - converted_files))
+        self.manifest.update(converted_datasets)
+        write_manifest(opj(self.dl_dir, MANIFEST_FILENAME), self.manifest)
+
+    def download_subject(self, subject_to_search, bids_dir=None):
         """
         For a single subject
-        1. Downloads the Shanoir datasets
-        2. Reorganises the Shanoir dataset as BIDS format as defined in the json configuration file provided by user
+        1. Searches the Shanoir datasets and skips those which are already converted (see get_datasets_to_convert)
+        2. Downloads the Shanoir datasets
+        3. Reorganises the Shanoir dataset as BIDS format as defined in the json configuration file provided by user
         :param subject_to_search:
-        :return:
+        :param bids_dir: str, BIDS output directory (self.dl_dir by default). When given, the conversion is isolated
+                         in this directory and not saved with datalad: it must be merged afterwards (see merge_bids_directory)
+        :return: dict, the manifest entries of the converted datasets (see update_manifest)
         """
         banner_msg("Downloading subject " + subject_to_search)
+        if self.parser is None:
+            self.configure_parser()
+        outdir = self.dl_dir if bids_dir is None else bids_dir
 
         # Open log file to write the steps of processing (downloading, renaming...)
         fp = open(self.log_fn, "a")
@@ -551,227 +1056,259 @@ class DownloadShanoirDatasetToBIDS:
         for far in self.list_fars:
             bids_subject_id = bids_subject_id.replace(far[K_FIND], far[K_REPLACE])
 
-        bids_seq_session = None
-
-        # Loop on each sequence defined in the dictionary
-        for seq in range(self.n_seq):
-            # Isolate elements that are called many times
-            shanoir_seq_name = self.shanoir2bids_dict[seq][
-                K_DS_NAME
-            ]  # Shanoir sequence name (OLD)
-            bids_seq_subdir = self.shanoir2bids_dict[seq][
-                K_BIDS_DIR
-            ]  # Sequence BIDS subdirectory name (NEW)
-            bids_seq_name = self.shanoir2bids_dict[seq][
-                K_BIDS_NAME
-            ]  # Sequence BIDS nickname (NEW)
-            if self.longitudinal:
-                bids_seq_session = self.shanoir2bids_dict[seq][
-                    K_BIDS_SES
-                ]  # Sequence BIDS nickname (NEW)
-            else:
-                bids_seq_session = None
-
-            # Print message concerning the sequence that is being downloaded
-            print(
-                "\t-",
-                bids_seq_name,
-                subject_to_search,
-                "[" + str(seq + 1) + "/" + str(self.n_seq) + "]",
-            )
-
-            request_terms = [
-                self.shanoir_study_id,
-                shanoir_seq_name,
-                subject_to_search,
-                self.shanoir_session_id,
-                self.date_from,
-                self.date_to,
-            ]
+        converted_datasets = {}
+
+        try:
+            found_datasets = self.search_subject_datasets(subject_to_search, fp)
+            datasets_to_convert = self.get_datasets_to_convert(bids_subject_id, found_datasets)
+
+            if len(found_datasets) > 0 and len(datasets_to_convert) == 0:
+                msg = "  >> Subject " + subject_to_search + " is up to date: all its datasets are already converted\n"
+                print(msg)
+                fp.write(msg)
+                return converted_datasets
+
+            client = self.get_shanoir_client()
+            failed_dataset_ids = set()
+            extractions = []
+            series_dirs = {}  # extraction directories by BIDS key
+            session_dicom_files = {}  # extracted DICOM files by BIDS session
+            # The archives are extracted in a thread while the next archive is downloading
+            with ThreadPoolExecutor(max_workers=1) as extraction_executor:
+                for seq_dict, item in datasets_to_convert:
+                    try:
+                        print("Downloading dataset", item["datasetId"])
+                        dl_archive = client.download_dataset(item["datasetId"], self.shanoir_file_type, tmp_archive)
+                        shanoir_metrics.dataset_done()
+                    except Exception as e:
+                        shanoir_metrics.error("download_error")
+                        logging.error(str(e))
+                        fp.write("- datasetId = " + str(item["datasetId"]) + "\n  >> ERROR : Download failed: " + str(e) + "\n")
+                        failed_dataset_ids.add(str(item["datasetId"]))
+                        continue
+
+                    # correct BIDS mapping of the searched dataset
+                    bids_seq_mapping = {
+                        "datasetName": item["datasetName"],
+                        "bidsDir": seq_dict[K_BIDS_DIR],
+                        "bidsName": seq_dict[K_BIDS_NAME],
+                        "bids_subject_id": bids_subject_id,
+                        "bids_session_id": self.get_bids_session(seq_dict, item),
+                    }
+
+                    bids_mapping.append(bids_seq_mapping)
+
+                    # Write the information on the data in the log file
+                    fp.write("- datasetId = " + str(item["datasetId"]) + "\n")
+                    fp.write("  -- studyName: " + item["studyName"] + "\n")
+                    fp.write("  -- subjectName: " + item["subjectName"] + "\n")
+                    fp.write("  -- session: " + str(item.get("examinationComment")) + "\n")
+                    fp.write("  -- datasetName: " + item["datasetName"] + "\n")
+                    fp.write(
+                        "  -- examinationDate: " + item["examinationDate"] + "\n"
+                    )
+                    fp.write("  >> Downloading archive OK\n")
 
-            def escape_solr_special_characters(s):
-                # List of Solr special characters
-                special_characters = r'\+\-\!\(\)\{\}\[\]\^"~\?:\\'
-                # remove \* from special characters to be able to use wildcards in solr
-                # Add more if needed
-                escape_pattern = re.compile(r'([{}])'.format(special_characters))
-                return escape_pattern.sub(r'\\\1', s)
-
-            escaped_request_terms = {s: escape_solr_special_characters(s) for s in request_terms}
-
-            # Initialize the parser
-            search_txt = (
-                "studyName:"
-                + escaped_request_terms[self.shanoir_study_id].replace(" ", "?")
-                + " AND datasetName:"
-                + escaped_request_terms[shanoir_seq_name].replace(" ", "?")
-                + " AND subjectName:"
-                + escaped_request_terms[subject_to_search].replace(" ", "?")
-                + " AND examinationComment:"
-                + escaped_request_terms[self.shanoir_session_id].replace(" ", "*")
-                + " AND examinationDate:["
-                + self.date_from
-                + " TO "
-                + self.date_to
-                + "]"
-            )
+                    # Extract the downloaded archive in its own series directory
+                    extraction_dir = opj(tmp_dicom, str(item["datasetId"]))
+                    extractions.append(
+                        (seq_dict, item, dl_archive, extraction_dir, extraction_executor.submit(extract_dicoms, dl_archive, extraction_dir))
+                    )
 
-            print(search_txt)
-
-            args = self.parser.parse_args(
-                [
-                    "-u",
-                    self.shanoir_username,
-                    "-d",
-                    self.shanoir_domaine,
-                    "-of",
-                    str(tmp_archive),
-                    "-em",
-                    "-st",
-                    search_txt,
-                    "-s",
-                    "200",
-                    "-f",
-                    self.shanoir_file_type,
-                    "-so",
-                    "id,ASC",
-                    "-t",
-                    "500",
-                ]
-            )  # Increase time out for heavy files
-
-            config = shanoir_downloader.initialize(args)
-            response = shanoir_downloader.solr_search(config, args)
-
-            # From response, process the data
-            # Print the number of items found and a list of these items
-            if response.status_code == 200:
-                # Invoke shanoir_downloader to download all the data
-                shanoir_downloader.download_search_results(config, args, response)
-
-                if len(response.json()["content"]) == 0:
-                    warn_msg = """WARNING ! The Shanoir request returned 0 result. Make sure the following search text returns 
-a result on the website.
-Search Text : "{}" \n""".format(
-                        search_txt
+                for seq_dict, item, dl_archive, extraction_dir, extraction in extractions:
+                    try:
+                        dicom_files = extraction.result()
+                    except Exception as e:
+                        shanoir_metrics.error("extraction_error")
+                        logging.error(str(e))
+                        fp.write("- datasetId = " + str(item["datasetId"]) + "\n  >> ERROR : Extraction failed: " + str(e) + "\n")
+                        failed_dataset_ids.add(str(item["datasetId"]))
+                        continue
+                    series_dirs.setdefault(self.get_bids_key(seq_dict, item), []).append(extraction_dir)
+                    session_dicom_files.setdefault(self.get_bids_session(seq_dict, item), []).extend(dicom_files)
+                    fp.write(
+                        "  >> Extraction of all files from archive '"
+                        + dl_archive
+                        + " into "
+                        + extraction_dir
+                        + "\n"
                     )
-                    print(warn_msg)
-                    fp.write(warn_msg)
-                else:
-                    for item in response.json()["content"]:
-                        # Define subject_id
-                        # su_id = item["subjectName"]
-                        # If the user has defined a list of edits to subject names... then do the find and replace
-                        # weird to do it at the dataset level
-
-                        # ID of the subject (sub-*)
-                        # read_bids_subject_id = su_id
-
-                        # correct BIDS mapping of the searched dataset
-                        bids_seq_mapping = {
-                            "datasetName": item["datasetName"],
-                            "bidsDir": bids_seq_subdir,
-                            "bidsName": bids_seq_name,
-                            "bids_subject_id": bids_subject_id,
-                        }
-
-                        if not self.longitudinal:
-                            bids_seq_session = None
-
-                        bids_seq_mapping["bids_session_id"] = bids_seq_session
-
-                        bids_mapping.append(bids_seq_mapping)
-
-                        # Write the information on the data in the log file
-                        fp.write("- datasetId = " + str(item["datasetId"]) + "\n")
-                        fp.write("  -- studyName: " + item["studyName"] + "\n")
-                        fp.write("  -- subjectName: " + item["subjectName"] + "\n")
-                        fp.write("  -- session: " + item["examinationComment"] + "\n")
-                        fp.write("  -- datasetName: " + item["datasetName"] + "\n")
-                        fp.write(
-                            "  -- examinationDate: " + item["examinationDate"] + "\n"
-                        )
-                        fp.write("  >> Downloading archive OK\n")
-
-                        # Extract the downloaded archive
-                        dl_archive = glob(opj(tmp_archive, "*" + item["id"] + "*.zip"))[
-                            0
-                        ]
-                        with zipfile.ZipFile(dl_archive, "r") as zip_ref:
-                            extraction_dir = opj(tmp_dicom, item["id"])
-                            zip_ref.extractall(extraction_dir)
-
-                        fp.write(
-                            "  >> Extraction of all files from archive '"
-                            + dl_archive
-                            + " into "
-                            + extraction_dir
-                            + "\n"
-                        )
 
-            elif response.status_code == 204:
-                banner_msg("ERROR : No file found!")
-                fp.write("  >> ERROR : No file found!\n")
-            else:
-                banner_msg(
-                    "ERROR : Returned by the request: status of the response = "
-                    + response.status_code
-                )
-                fp.write(
-                    "  >> ERROR : Returned by the request: status of the response = "
-                    + str(response.status_code)
-                    + "\n"
-                )
+            # Files of the subject before the conversion, to find the files produced by the conversion
+            files_before = list_subject_files(outdir, bids_subject_id)
 
-        # Launch DICOM to BIDS conversion using heudiconv + heuristic file + dcm2niix options
-        with tempfile.NamedTemporaryFile(
-            mode="r+", encoding="utf-8", dir=self.dl_dir, suffix=".py"
-        ) as heuristic_file:
-            # Generate Heudiconv heuristic file from configuration.json mapping
-            generate_bids_heuristic_file(
-                bids_mapping, heuristic_file.name, output_type=self.output_file_type
-            )
+            # Launch DICOM to BIDS conversion using heudiconv + heuristic file + dcm2niix options
             with tempfile.NamedTemporaryFile(
                 mode="r+", encoding="utf-8", dir=self.dl_dir, suffix=".json"
             ) as dcm2niix_config_file:
                 self.export_dcm2niix_config_options(dcm2niix_config_file.name)
-                workflow_params = {
-                    "files": glob(opj(tmp_dicom, "*", "*.dcm"), recursive=True),
-                    "outdir": self.dl_dir,
-                    "subjs": [bids_subject_id],
-                    "converter": "dcm2niix",
-                    "heuristic": heuristic_file.name,
-                    "bids_options": "--bids",
-                    # "with_prov": True,
-                    "debug": self.debug_mode,
-                    "dcmconfig": dcm2niix_config_file.name,
-                    "datalad": self.datalad,
-                    "minmeta": True,
-                    "grouping": "all",  # other options are too restrictive (tested on EMISEP)
-                    "overwrite": True,
-
-                }
-
-                if self.longitudinal and bids_seq_session is not None:
-                    workflow_params["session"] = bids_seq_session
                 try:
-                    workflow(**workflow_params)
+                    if self.convert_jobs > 1:
+                        failed_bids_keys = self.convert_bids_keys(
+                            subject_to_search, bids_subject_id, bids_mapping, series_dirs, outdir, dcm2niix_config_file.name, fp
+                        )
+                        failed_dataset_ids.update(
+                            str(item["datasetId"])
+                            for seq_dict, item in datasets_to_convert
+                            if self.get_bids_key(seq_dict, item) in failed_bids_keys
+                        )
+                        # heudiconv is not called on outdir: save the subject as it would have done
+                        if self.is_saved_by_heudiconv(bids_dir):
+                            datalad_save(outdir, "Converted subject " + subject_to_search)
+                    else:
+                        # One heudiconv call per session (a single one when the data is not longitudinal)
+                        if len(session_dicom_files) == 0:
+                            raise AssertionError("No DICOM file available for conversion")
+                        for bids_session in sorted(session_dicom_files, key=str):
+                            self.convert_session(
+                                bids_subject_id,
+                                bids_session,
+                                [m for m in bids_mapping if m["bids_session_id"] == bids_session],
+                                session_dicom_files[bids_session],
+                                outdir,
+                                dcm2niix_config_file.name,
+                                bids_dir,
+                            )
                 except AssertionError:
+                    shanoir_metrics.error("no_dicom")
                     error = (
                         f" \n >> WARNING : No DICOM file available for conversion for subject {subject_to_search} \n "
                         f"If some datasets are to be downloaded check log file and your configuration file syntax \n "
                     )
                     print(error)
                     fp.write(error)
-                finally:
-                    if not self.debug_mode:
-                        shutil.rmtree(tmp_archive, ignore_errors=True)
-                        shutil.rmtree(tmp_dicom, ignore_errors=True)
-                        # beware of side effects
-                        shutil.rmtree(tmp_archive.parent, ignore_errors=True)
-                        shutil.rmtree(tmp_dicom.parent, ignore_errors=True)
-
-                    fp.close()
+                    return converted_datasets
+
+            # Record the files produced by the conversion of each dataset
+            files_after = list_subject_files(outdir, bids_subject_id)
+            produced_files = [f for f, mtime in files_after.items() if files_before.get(f) != mtime]
+            for seq_dict, item in datasets_to_convert:
+                if str(item["datasetId"]) in failed_dataset_ids:
+                    continue
+                converted_datasets[str(item["datasetId"])] = {
+                    "subject": subject_to_search,
+                    "bids_subject_id": bids_subject_id,
+                    "bids_key": self.get_bids_key(seq_dict, item),
+                    "fingerprint": self.get_fingerprint(bids_subject_id, seq_dict, item),
+                    "files": match_bids_files(
+                        produced_files, seq_dict[K_BIDS_DIR], seq_dict[K_BIDS_NAME], self.get_bids_session(seq_dict, item)
+                    ),
+                    "converted": datetime.datetime.now().isoformat(timespec="seconds"),
+                }
+            return converted_datasets
+        finally:
+            if not self.debug_mode:
+                shutil.rmtree(tmp_archive, ignore_errors=True)
+                shutil.rmtree(tmp_dicom, ignore_errors=True)
+                # only remove the parent directories once empty: other subjects might be processed in parallel
+                for tmp_parent in [tmp_archive.parent, tmp_dicom.parent]:
+                    try:
+                        tmp_parent.rmdir()
+                    except OSError:
+                        pass
+
+            fp.close()
+
+    def convert_session(self, bids_subject_id, bids_session, bids_mapping, dicom_files, outdir, dcm2niix_config, bids_dir=None):
+        """
+        Convert the DICOM files of a session of a subject with heudiconv (in outdir/sub-*/ses-*)
+        :param bids_session: str, BIDS session label, None when the data is not longitudinal
+        :param bids_mapping: list, BIDS mapping of the datasets of the session
+        :param dicom_files: list, DICOM files of the session
+        :param dcm2niix_config: str, path of the dcm2niix configuration file
+        """
+        with tempfile.NamedTemporaryFile(
+            mode="r+", encoding="utf-8", dir=self.dl_dir, suffix=".py"
+        ) as heuristic_file:
+            # Generate Heudiconv heuristic file from configuration.json mapping
+            generate_bids_heuristic_file(
+                bids_mapping, heuristic_file.name, output_type=self.output_file_type
+            )
+            workflow_params = {
+                "files": dicom_files,
+                "outdir": outdir,
+                "subjs": [bids_subject_id],
+                "converter": "dcm2niix",
+                "heuristic": heuristic_file.name,
+                "bids_options": "--bids",
+                # "with_prov": True,
+                "debug": self.debug_mode,
+                "dcmconfig": dcm2niix_config,
+                "datalad": self.is_saved_by_heudiconv(bids_dir),
+                "minmeta": True,
+                "grouping": "all",  # other options are too restrictive (tested on EMISEP)
+                "overwrite": True,
+            }
+
+            if self.longitudinal and bids_session is not None:
+                workflow_params["session"] = bids_session
+            with shanoir_metrics.stage("convert"):
+                workflow(**workflow_params)
+
+    def convert_bids_keys(self, subject_to_search, bids_subject_id, bids_mapping, series_dirs, outdir, dcm2niix_config, fp):
+        """
+        Convert the series of a subject with one heudiconv (dcm2niix) process per BIDS key (bidsDir, bidsName, session),
+        at most self.convert_jobs at a time, each in its own staging directory. The staging directories are then merged
+        into outdir in the order of the BIDS keys (*_scans.tsv rows are merged and sorted), so that the result
+        does not depend on the order in which the conversions end.
+        The run numbers are computed per BIDS key by the heuristic, they are the same as with a single heudiconv call.
+        :param series_dirs: dict, extraction directories of the series by BIDS key
+        :param dcm2niix_config: str, path of the dcm2niix configuration file
+        :return: list of the BIDS keys which could not be converted
+        """
+        if len(series_dirs) == 0:
+            raise AssertionError("No DICOM file available for conversion")
+        staging_dir = Path(self.dl_dir).joinpath("tmp_convert", subject_to_search)
+        create_tmp_directory(staging_dir)
+        bids_keys = sorted(series_dirs, key=str)
+
+        def convert(key_index):
+            bids_key = bids_keys[key_index]
+            key_dir = staging_dir / str(key_index)
+            key_dir.mkdir()
+            heuristic_file = str(key_dir / "heuristic.py")
+            generate_bids_heuristic_file(
+                [m for m in bids_mapping if (m["bidsDir"], m["bidsName"], m["bids_session_id"]) == bids_key],
+                heuristic_file,
+                output_type=self.output_file_type,
+            )
+            command = get_heudiconv_command() + ["--files"] + series_dirs[bids_key]
+            command += ["-o", str(key_dir / "bids"), "-s", bids_subject_id, "-f", heuristic_file, "-c", "dcm2niix"]
+            command += ["--bids", "--minmeta", "-g", "all", "--overwrite", "--dcmconfig", dcm2niix_config]
+            if self.longitudinal and bids_key[2] is not None:
+                command += ["-ss", bids_key[2]]
+            if self.debug_mode:
+                command.append("--dbg")
+            with shanoir_metrics.stage("convert"):
+                return subprocess.run(command, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, universal_newlines=True)
+
+        try:
+            # The conversions are external processes: threads are enough to run them concurrently
+            with ThreadPoolExecutor(max_workers=self.convert_jobs) as executor:
+                results = list(executor.map(convert, range(len(bids_keys))))
+
+            failed_bids_keys = []
+            outdir = Path(outdir)
+            outdir.mkdir(parents=True, exist_ok=True)
+            for key_index, (bids_key, result) in enumerate(zip(bids_keys, results)):
+                if result.returncode != 0:
+                    shanoir_metrics.error("conversion_error")
+                    error = "  >> ERROR : Conversion of {} failed:\n{}\n".format("_".join(k for k in bids_key if k), result.stdout[-2000:])
+                    print(error)
+                    fp.write(error)
+                    failed_bids_keys.append(bids_key)
+                    continue
+                merge_bids_directory(staging_dir / str(key_index) / "bids", outdir)
+            if len(failed_bids_keys) == len(bids_keys):
+                raise AssertionError("No BIDS key could be converted")
+            return failed_bids_keys
+        finally:
+            if not self.debug_mode:
+                shutil.rmtree(staging_dir, ignore_errors=True)
+                try:
+                    staging_dir.parent.rmdir()
+                except OSError:
+                    pass
 
     def download(self):
         """
@@ -780,21 +1317,82 @@ Search Text : "{}" \n""".format(
         """
         self.set_log_filename()
         self.configure_parser()  # Configure the shanoir_downloader parser
-        fp = open(self.log_fn, "w")
-        if self.shanoir_subjects is not None:
-            for subject_to_search in self.shanoir_subjects:
-                t_start_subject = time()
-                self.download_subject(subject_to_search=subject_to_search)
-                dur_min = int((time() - t_start_subject) // 60)
-                dur_sec = int((time() - t_start_subject) % 60)
-                end_msg = (
-                    "Downloaded dataset for subject "
-                    + subject_to_search
-                    + " in {}m{}s".format(dur_min, dur_sec)
+        self.manifest = read_manifest(opj(self.dl_dir, MANIFEST_FILENAME))
+        if self.shanoir_subjects is None:
+            print("No Shanoir Subjects to Download")
+            return
+        try:
+            if self.jobs > 1:
+                self.download_parallel()
+            else:
+                for i, subject_to_search in enumerate(self.shanoir_subjects):
+                    shanoir_metrics.set_queue_depth("subjects", len(self.shanoir_subjects) - i)
+                    t_start_subject = time()
+                    converted_datasets = self.download_subject(subject_to_search=subject_to_search)
+                    self.update_manifest(converted_datasets)
+                    # Even when heudiconv saved the converted subject, the manifest and the removed files are saved by the batch
+                    if converted_datasets:
+                        self.add_to_datalad_batch(subject_to_search)
+                    shanoir_metrics.inc("shanoir_subjects_total")
+                    dur_min = int((time() - t_start_subject) // 60)
+                    dur_sec = int((time() - t_start_subject) % 60)
+                    end_msg = (
+                        "Downloaded dataset for subject "
+                        + subject_to_search
+                        + " in {}m{}s".format(dur_min, dur_sec)
+                    )
+                    banner_msg(end_msg)
+        finally:
+            # Save the last (incomplete) batch, even after an error: the converted subjects are recorded in the manifest
+            self.save_datalad_batch()
+
+    def download_parallel(self):
+        """
+        Process the Shanoir subjects in self.jobs worker processes.
+        Each worker downloads, extracts and converts its subject in isolated temporary directories;
+        the main process is the single writer which merges the converted subjects
+        into the BIDS directory (participants.tsv, top level files) and saves them with datalad.
+        """
+        # Authenticate once: the workers receive a copy of the client (with its tokens)
+        self.get_shanoir_client().authenticate()
+        tmp_bids = Path(self.dl_dir).joinpath("tmp_bids")
+        t_start = time()
+        n_done = 0
+        with ProcessPoolExecutor(max_workers=self.jobs) as executor:
+            futures = {
+                executor.submit(
+                    shanoir_metrics.collect, self.download_subject, subject_to_search, str(tmp_bids / subject_to_search)
+                ): subject_to_search
+                for subject_to_search in self.shanoir_subjects
+            }
+            for future in as_completed(futures):
+                subject_to_search = futures[future]
+                n_done += 1
+                shanoir_metrics.set_queue_depth("subjects", len(futures) - n_done)
+                try:
+                    # The metrics recorded by the worker process are added to the registry of the main process
+                    converted_datasets, worker_metrics = future.result()
+                    shanoir_metrics.merge(worker_metrics)
+                except Exception as e:
+                    shanoir_metrics.merge(getattr(e, "metrics", None))
+                    banner_msg("ERROR : subject " + subject_to_search + " failed: " + str(e))
+                    shanoir_metrics.error("subject_failed")
+                    continue
+                # Single writer: merge the converted subject, record it in the manifest and save it (by batches)
+                merge_bids_directory(tmp_bids / subject_to_search, self.dl_dir)
+                self.update_manifest(converted_datasets)
+                if converted_datasets:
+                    self.add_to_datalad_batch(subject_to_search)
+                shanoir_metrics.inc("shanoir_subjects_total")
+                banner_msg(
+                    "Downloaded dataset for subject {} ({}/{}), {}m elapsed".format(
+                        subject_to_search, n_done, len(futures), int((time() - t_start) // 60)
+                    )
                 )
-                banner_msg(end_msg)
-        else:
-            print(f"No Shanoir Subjects to Download")
+        try:
+            tmp_bids.rmdir()
+        except OSError:
+            pass
 
 
 def main():
@@ -837,11 +1435,44 @@ def main():
         action="store_true",
         help="Toggle debug mode (keep temporary directories)",
     )
+    parser.add_argument(
+        "--full",
+        required=False,
+        action="store_true",
+        help="Download and convert all datasets, even those which are already converted "
+        "(listed with the same configuration in the " + MANIFEST_FILENAME + " manifest of the output folder).",
+    )
+    parser.add_argument(
+        "-nj",
+        "--jobs",
+        type=int,
+        default=1,
+        help="Number of subjects processed in parallel (downloads, extraction and conversion run in separate processes ; "
+        "the datalad save and the updates of the shared BIDS files are serialised).",
+    )
+    parser.add_argument(
+        "-cj",
+        "--convert_jobs",
+        type=int,
+        default=1,
+        help="Number of BIDS keys (bidsDir, bidsName, session) of a subject converted in parallel, one heudiconv/dcm2niix "
+        "process each (0: one per CPU). 1 converts all the series of a subject with a single heudiconv call. "
+        "With --jobs, up to jobs x convert_jobs conversions run at the same time.",
+    )
     group = parser.add_mutually_exclusive_group()
     group.add_argument("--activate-datalad", action="store_true", dest="datalad", help="Store outputs as datalad dataset")
     group.add_argument("--deactivate-datalad", action="store_false", dest="datalad", help="Store outputs as regular directory")
     # by default save as datalad dataset
     parser.set_defaults(datalad=True)
+    parser.add_argument(
+        "-dbs",
+        "--datalad_batch_size",
+        type=int,
+        default=1,
+        help="Number of converted subjects saved together in a single datalad save (one annex add and one commit). "
+        "1 saves each subject, 0 saves all subjects once at the end.",
+    )
+    shanoir_metrics.add_metrics_arguments(parser)
 
     args = parser.parse_args()
 
@@ -861,10 +1492,16 @@ def main():
         stb.debug_mode = True
 
     stb.datalad = args.datalad
+    stb.set_datalad_batch_size(args.datalad_batch_size)
+    stb.set_jobs(args.jobs)
+    stb.set_convert_jobs(args.convert_jobs)
+    stb.incremental = not args.full
 
     if args.longitudinal:
         stb.toggle_longitudinal_version()
 
+    shanoir_metrics.start(args)
+
     if not stb.is_correct_dcm2niix():
         print(
             f"WARNING!: Current dcm2niix path {stb.actual_dcm2niix_path} is different from dcm2niix configured path {stb.dcm2niix_path}"
@@ -874,7 +1511,10 @@ def main():
             print(
                 f" WARNING !: Provided BIDS keys {stb.is_mapping_bids()[1]} are not BIDS compliant check syntax in provided configuration file {args.config_file}"
             )
-        stb.download()
+        try:
+            stb.download()
+        except ConnectionError as e:
+            sys.exit(f"Error: {e}")
 
 
 if __name__ == "__main__":
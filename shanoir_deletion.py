@@ -0,0 +1,172 @@
+import os
+import json
+import time
+import logging
+import threading
+from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+import requests
+import shanoir_util
+
+# Bulk deletion engine used by delete_datasets.py, delete_exams.py and delete_subjects.py:
+# the deletions run in a bounded pool of threads (sharing the client), at a limited rate, and each result is appended to a journal (jsonl)
+# so that an interrupted deletion resumes exactly where it stopped
+
+SHANOIR_SHUTDOWN_HOUR = 2
+SHANOIR_AVAILABLE_HOUR = 5
+
+# Statuses of the deletions in the journal
+DELETED = 'deleted'
+NOT_FOUND = 'not_found'
+FAILED = 'failed'
+
+# Responses retried (with an exponential backoff): server errors and throttling; the other errors (403...) are not retried
+RETRIED_STATUS_CODES = [429, 500, 502, 503, 504]
+
+def add_engine_arguments(parser):
+    parser.add_argument('-j', '--jobs', type=int, default=4, help='Number of deletions sent at the same time.')
+    parser.add_argument('-r', '--rate', type=float, default=4, help='Maximum number of deletions per second (0 for no limit).')
+    parser.add_argument('-mr', '--max_retries', type=int, default=5, help='Number of retries of a deletion which failed with a server error (5xx, 429) or a connection error.')
+    parser.add_argument('-jo', '--journal', default=None, help='Path to the journal of the deletions (jsonl). The ids already deleted (or not found) in the journal are skipped, so an interrupted deletion can be resumed by running the same command. Defaults to the ids file with the .journal.jsonl extension.')
+    parser.add_argument('-rf', '--retry_failed', default=False, action='store_true', help='Also retry the ids which failed in the previous runs with an error which is not retried (403...).')
+    return parser
+
+def read_ids(ids_path):
+    with open(ids_path) as file:
+        return [line.strip() for line in file if line.strip() != '']
+
+def get_journal_path(ids_path, journal=None):
+    return Path(journal) if journal else Path(ids_path).with_suffix('.journal.jsonl')
+
+class DeletionJournal:
+    """
+    Append-only record of the deletions ({ kind, id, status, status_code, time } per line), written and synced after each deletion.
+    The last entry of each id is loaded when the journal is opened.
+    """
+
+    def __init__(self, path):
+        self.path = Path(path)
+        self.lock = threading.Lock()
+        self.entries = {}
+        if self.path.exists():
+            with open(self.path) as file:
+                for line in file:
+                    try:
+                        entry = json.loads(line)
+                    except json.JSONDecodeError:
+                        # Last line of an interrupted write
+                        continue
+                    self.entries[(entry['kind'], str(entry['id']))] = entry
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.file = open(self.path, 'a')
+
+    # An id is deleted again unless it was deleted or not found, or failed with an error which is not retried (unless retry_failed)
+    def is_pending(self, kind, id, retry_failed=False):
+        entry = self.entries.get((kind, str(id)))
+        if entry is None or retry_failed and entry['status'] == FAILED:
+            return True
+        return entry['status'] == FAILED and (entry['status_code'] is None or entry['status_code'] in RETRIED_STATUS_CODES)
+
+    def add(self, kind, id, status, status_code=None, message=None):
+        entry = { 'kind': kind, 'id': str(id), 'status': status, 'status_code': status_code, 'time': datetime.now().isoformat(timespec='seconds') }
+        if message is not None:
+            entry['message'] = message
+        with self.lock:
+            self.entries[(kind, str(id))] = entry
+            self.file.write(json.dumps(entry) + '\n')
+            self.file.flush()
+            os.fsync(self.file.fileno())
+
+    def close(self):
+        self.file.close()
+
+class RateLimiter:
+    """
+    Spaces the requests of all the threads by at least 1/rate seconds, and waits during the nightly shutdown of Shanoir
+    """
+
+    def __init__(self, rate):
+        self.interval = 1.0 / rate if rate and rate > 0 else 0
+        self.lock = threading.Lock()
+        self.next_time = time.monotonic()
+
+    def wait(self):
+        wait_for_shanoir()
+        with self.lock:
+            now = time.monotonic()
+            start = max(now, self.next_time)
+            self.next_time = start + self.interval
+        time.sleep(max(0, start - now))
+
+def wait_for_shanoir():
+    now = datetime.now()
+    if now.hour >= SHANOIR_SHUTDOWN_HOUR and now.hour < SHANOIR_AVAILABLE_HOUR:
+        future = datetime(now.year, now.month, now.day, SHANOIR_AVAILABLE_HOUR, 0)
+        logging.info(f'Shanoir is unavailable, waiting until {future}...')
+        time.sleep((future-now).total_seconds())
+
+def get_delete_function(client, kind, service=None):
+    if kind == 'dataset':
+        return client.delete_dataset
+    if kind == 'examination':
+        return client.delete_examination
+    if kind == 'subject':
+        return lambda subject_id: client.delete_subject(subject_id, service)
+    raise ValueError(f'Unknown kind of deletion: {kind}')
+
+# Delete one id, retrying the server and connection errors; returns the status and the status code of the last response
+def delete_with_retries(delete, id, rate_limiter, max_retries):
+    for n_try in range(max_retries + 1):
+        rate_limiter.wait()
+        try:
+            status_code = delete(id)
+        except requests.RequestException as e:
+            status_code, message = None, str(e)
+        else:
+            message = None
+            if status_code in [200, 204]:
+                return DELETED, status_code, None
+            if status_code == 404:
+                return NOT_FOUND, status_code, None
+            if status_code not in RETRIED_STATUS_CODES:
+                return FAILED, status_code, None
+        if n_try < max_retries:
+            time.sleep(min(60, 2 ** n_try))
+    return FAILED, status_code, message
+
+def delete_ids(config, kind, ids, journal_path, jobs=4, rate=4, max_retries=5, retry_failed=False, service=None):
+    journal = DeletionJournal(journal_path)
+    # The subjects are deleted in each service (studies, datasets) separately
+    journal_kind = kind if service is None else f'{kind}:{service}'
+    ids_to_delete = [id for id in dict.fromkeys(ids) if journal.is_pending(journal_kind, id, retry_failed)]
+    logging.info(f'{len(ids_to_delete)} {kind}s to delete ({len(ids) - len(ids_to_delete)} already processed according to {journal_path}).')
+
+    delete = get_delete_function(shanoir_util.get_client(config), kind, service)
+    rate_limiter = RateLimiter(rate)
+    counts = { DELETED: 0, NOT_FOUND: 0, FAILED: 0 }
+    counts_lock = threading.Lock()
+    start = time.perf_counter()
+
+    def delete_id(id):
+        status, status_code, message = delete_with_retries(delete, id, rate_limiter, max_retries)
+        journal.add(journal_kind, id, status, status_code, message)
+        if status == DELETED:
+            logging.info(f'{kind.capitalize()} {id} deleted with success.')
+        elif status == NOT_FOUND:
+            logging.info(f'{kind.capitalize()} {id} not found (already deleted).')
+        else:
+            logging.error(f'{kind.capitalize()} {id}: Error during deletion {status_code} {message or ""}')
+        with counts_lock:
+            counts[status] += 1
+
+    try:
+        with ThreadPoolExecutor(max_workers=jobs) as executor:
+            for _ in executor.map(delete_id, ids_to_delete):
+                pass
+    finally:
+        journal.close()
+        duration = time.perf_counter() - start
+        logging.info(f'{counts[DELETED]} {kind}s deleted, {counts[NOT_FOUND]} not found, {counts[FAILED]} failed in {duration:.1f} seconds.')
+    return counts
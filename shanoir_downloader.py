@@ -1,15 +1,20 @@
 import datetime
 import os
+import io
 import requests
+from requests.adapters import HTTPAdapter
 import json
 import getpass
 import re
 import sys
 import argparse
 import logging
+import time
+import threading
 import http.client as http_client
 from http.client import responses
 from pathlib import Path
+import shanoir_metrics
 Path.ls = lambda x: sorted(list(x.iterdir()))
 
 def create_arg_parser(description="""Shanoir downloader"""):
@@ -23,7 +28,7 @@ def add_output_folder_argument(parser, required=True):
 	parser.add_argument('-of', '--output_folder', required=required, help='The destination folder where files will be downloaded.')
 
 def add_domain_argument(parser):
-	parser.add_argument('-d', '--domain', default='shanoir.irisa.fr', help='The shanoir domain to query.')
+	parser.add_argument('-d', '--domain', default='shanoir.irisa.fr', help='The shanoir domain to query (a url such as http://127.0.0.1:8080 for a local server, see shanoir_mock_server.py).')
 
 def add_common_arguments(parser):
 	add_username_argument(parser)
@@ -79,17 +84,7 @@ def init_logging(args):
 		requests_log.propagate = True
 
 
-def initialize(args):
-
-	server_domain = args.domain
-	username = args.username
-
-	output_folder = Path(args.output_folder)
-	output_folder.mkdir(parents=True, exist_ok=True)
-
-	init_logging(args)
-	
-	verify = args.certificate if hasattr(args, 'certificate') and args.certificate != '' else True
+def get_proxies(args):
 
 	proxy_url = None # 'user:pass@host:port'
 
@@ -140,45 +135,33 @@ def initialize(args):
 			# 'https': 'https://' + proxy_url,
 		}
 	
-	return { 'domain': server_domain, 'username': username, 'verify': verify, 'proxies': proxies, 'output_folder': output_folder, 'timeout': args.timeout }
+	return proxies
 
+DEFAULT_POOL_SIZE = 10
 
-access_token = None
-refresh_token = None
+# Size of the connection pool of the client: at least one connection per thread sending requests (--jobs, --plan_workers)
+def get_pool_size(args):
+	return max([DEFAULT_POOL_SIZE] + [getattr(args, name) for name in ['jobs', 'plan_workers'] if isinstance(getattr(args, name, None), int)])
 
-# using user's password, get the first access token and the refresh token
-def ask_access_token(config):
-	try:
-		password = os.environ['shanoir_password'] if 'shanoir_password' in os.environ else getpass.getpass(prompt='Password for Shanoir user ' + config['username'] + ': ', stream=None)
-		otp = os.environ['shanoir_otp'] if 'shanoir_otp' in os.environ else input(
-			'One-time 2FA code for Shanoir user ' + config['username'] + ': ')
-	except:
-		sys.exit(0)
-	url = 'https://' + config['domain'] + '/auth/realms/shanoir-ng/protocol/openid-connect/token'
-	payload = {
-		'client_id' : 'shanoir-uploader', 
-		'grant_type' : 'password', 
-		'username' : config['username'], 
-		'password' : password,
-		'totp': otp,
-		'scope' : 'offline_access'
-	}
-	# curl -d '{"client_id":"shanoir-uploader", "grant_type":"password", "username": "amasson", "password": "", "scope": "offline_access" }' -H "Content-Type: application/json" -X POST 
-
-	headers = {'content-type': 'application/x-www-form-urlencoded'}
-	print('get keycloak token...', end=' ')
-	response = requests.post(url, data=payload, headers=headers, proxies=config['proxies'], verify=config['verify'], timeout=config['timeout'])
-	if not hasattr(response, 'status_code') or response.status_code != 200:
-		print('Failed to connect, make sur you have a certified IP or are connected on a valid VPN.')
-		sys.exit(1)
+def initialize(args):
+
+	server_domain = args.domain
+	username = args.username
+
+	output_folder = Path(args.output_folder)
+	output_folder.mkdir(parents=True, exist_ok=True)
+
+	init_logging(args)
 	
-	response_json = json.loads(response.text)
-	if 'error_description' in response_json and response_json['error_description'] == 'Invalid user credentials':
-		print('bad username or password')
-		sys.exit(1)
-	global refresh_token 
-	refresh_token = response_json['refresh_token']
-	return response_json['access_token']
+	verify = args.certificate if hasattr(args, 'certificate') and args.certificate != '' else True
+
+	proxies = get_proxies(args)
+
+	config = { 'domain': server_domain, 'username': username, 'verify': verify, 'proxies': proxies, 'output_folder': output_folder, 'timeout': args.timeout, 'pool_size': get_pool_size(args) }
+	# The client (http session and tokens) is built once and shared by all the requests made with this config
+	config['client'] = ShanoirClient.from_config(config)
+	return config
+
 
 def get_filename_from_response(output_folder, response):
 	filename = None
@@ -206,61 +189,246 @@ try:
 			for data in response.iter_content(chunk_size=1024):
 				size = file.write(data)
 				bar.update(size)
+				shanoir_metrics.add_downloaded_bytes(size)
+		return filename
 
 except ImportError as e:
 
 	def download_file(output_folder, response):
 		filename = get_filename_from_response(output_folder, response)
 		if not filename: return
-		open(filename, 'wb').write(response.content)
-		return
+		size = open(filename, 'wb').write(response.content)
+		shanoir_metrics.add_downloaded_bytes(size)
+		return filename
+
+class ShanoirClient:
+	"""
+	Connection to a Shanoir server: holds the http session (connection pool), the proxy settings and the keycloak tokens.
+	Build it once per process (with initialize() or ShanoirClient.from_config()) and share it between the scripts and threads.
+	"""
+
+	def __init__(self, domain, username, verify=True, proxies=None, timeout=60*4, pool_size=DEFAULT_POOL_SIZE):
+		self.domain = domain
+		self.username = username
+		self.verify = verify
+		self.proxies = proxies
+		self.timeout = timeout
+		self.pool_size = pool_size
+		self.access_token = None
+		self.refresh_token = None
+		self.token_lock = threading.Lock()
+		self.session = self.create_session()
+
+	@classmethod
+	def from_config(cls, config):
+		return cls(config['domain'], config['username'], config['verify'], config['proxies'], config['timeout'], config.get('pool_size', DEFAULT_POOL_SIZE))
+
+	# requests keeps 10 connections per host by default: the other threads would open (and close) a new connection for each request
+	def create_session(self):
+		session = requests.Session()
+		adapter = HTTPAdapter(pool_maxsize=self.pool_size)
+		session.mount('https://', adapter)
+		session.mount('http://', adapter)
+		return session
+
+	# The session and the lock cannot be sent to other processes: they are created again, the tokens are kept
+	def __getstate__(self):
+		state = self.__dict__.copy()
+		del state['token_lock']
+		del state['session']
+		return state
+
+	def __setstate__(self, state):
+		self.__dict__.update(state)
+		self.token_lock = threading.Lock()
+		self.session = self.create_session()
+
+	# the domain can include the scheme (http://localhost:8080 for a local server), https is used otherwise
+	def url(self, path):
+		if self.domain.startswith('http://') or self.domain.startswith('https://'):
+			return self.domain.rstrip('/') + path
+		return 'https://' + self.domain + path
+
+	# using user's password, get the first access token and the refresh token
+	# raises ConnectionError when the authentication fails or is cancelled: the scripts exit in their __main__ block, the library callers and workers can handle it
+	def ask_access_token(self):
+		try:
+			password = os.environ['shanoir_password'] if 'shanoir_password' in os.environ else getpass.getpass(prompt='Password for Shanoir user ' + self.username + ': ', stream=None)
+			otp = os.environ['shanoir_otp'] if 'shanoir_otp' in os.environ else input(
+				'One-time 2FA code for Shanoir user ' + self.username + ': ')
+		except (KeyboardInterrupt, EOFError) as e:
+			raise ConnectionError('Authentication cancelled: no password or 2FA code given.') from e
+		url = self.url('/auth/realms/shanoir-ng/protocol/openid-connect/token')
+		payload = {
+			'client_id' : 'shanoir-uploader', 
+			'grant_type' : 'password', 
+			'username' : self.username, 
+			'password' : password,
+			'totp': otp,
+			'scope' : 'offline_access'
+		}
+		# curl -d '{"client_id":"shanoir-uploader", "grant_type":"password", "username": "amasson", "password": "", "scope": "offline_access" }' -H "Content-Type: application/json" -X POST 
+
+		headers = {'content-type': 'application/x-www-form-urlencoded'}
+		print('get keycloak token...', end=' ')
+		response = self.session.post(url, data=payload, headers=headers, proxies=self.proxies, verify=self.verify, timeout=self.timeout)
+		response_json = response.json() if response.headers.get('content-type', '').startswith('application/json') else {}
+		if response_json.get('error_description') == 'Invalid user credentials':
+			raise ConnectionError('Bad username or password.')
+		if response.status_code != 200:
+			raise ConnectionError(f'Failed to connect (status {response.status_code}), make sure you have a certified IP or are connected on a valid VPN.')
+		self.refresh_token = response_json['refresh_token']
+		self.access_token = response_json['access_token']
+		return self.access_token
+
+	# get a new acess token using the refresh token
+	def refresh_access_token(self):
+		url = self.url('/auth/realms/shanoir-ng/protocol/openid-connect/token')
+		payload = {
+			'grant_type' : 'refresh_token',
+			'refresh_token' : self.refresh_token,
+			'client_id' : 'shanoir-uploader'
+		}
+		headers = {'content-type': 'application/x-www-form-urlencoded'}
+		print('refresh keycloak token...')
+		response = self.session.post(url, data=payload, headers=headers, proxies=self.proxies, verify=self.verify, timeout=self.timeout)
+		if response.status_code != 200:
+			logging.error(f'response status : {response.status_code}, {responses[response.status_code]}')
+		response_json = response.json()
+		self.access_token = response_json['access_token']
+		return self.access_token
+
+	# ask the password (and 2FA code) once, even when several threads start at the same time
+	def authenticate(self):
+		with self.token_lock:
+			if self.access_token is None:
+				self.ask_access_token()
+		return self.access_token
+
+	def perform_request(self, rtype, url, **kwargs):
+		if rtype not in ['get', 'post', 'delete', 'put']:
+			print('Error: unimplemented request type')
+			return None
+		start = time.perf_counter()
+		response = self.session.request(rtype.upper(), url, proxies=self.proxies, verify=self.verify, timeout=self.timeout, **kwargs)
+		shanoir_metrics.observe(shanoir_metrics.REQUEST_DURATION, time.perf_counter() - start, method=rtype)
+		shanoir_metrics.inc(shanoir_metrics.REQUESTS, method=rtype, status=response.status_code)
+		return response
+
+	# perform a request on the given url (or path on the server), asks for a new access token if the current one is outdated
+	def request(self, rtype, url, raise_for_status=True, extra_headers=None, **kwargs):
+		url = self.url(url) if url.startswith('/') else url
+		access_token = self.authenticate()
+		headers = { 
+			'Authorization' : 'Bearer ' + access_token,
+			'content-type' : 'application/json'
+		}
+		if extra_headers:
+			headers.update(extra_headers)
+		response = self.perform_request(rtype, url, headers=headers, **kwargs)
+		# if token is outdated, refresh it (once for all the threads) and try again
+		if response.status_code == 401:
+			shanoir_metrics.retry('token_expired')
+			with self.token_lock:
+				if self.access_token == access_token:
+					self.refresh_access_token()
+			headers['Authorization'] = 'Bearer ' + self.access_token
+			response = self.perform_request(rtype, url, headers=headers, **kwargs)
+		if raise_for_status:
+			response.raise_for_status()
+		return response
+
+	def get(self, url, params=None, stream=None, headers=None, raise_for_status=True):
+		return self.request('get', url, raise_for_status, extra_headers=headers, params=params, stream=stream)
+
+	def post(self, url, params=None, files=None, stream=None, json=None, data=None, raise_for_status=True):
+		return self.request('post', url, raise_for_status, params=params, files=files, stream=stream, json=json, data=data)
+
+	def delete(self, url, params=None, raise_for_status=True):
+		return self.request('delete', url, raise_for_status, params=params)
+
+	def search(self, search_text, expert_mode=False, page=0, size=50, sort='id,DESC'):
+		data = {
+			'expertMode': expert_mode,
+			'searchText': search_text
+		}
+		params = dict(page=page, size=size, sort=sort)
+		with shanoir_metrics.stage('search'):
+			return self.post('/shanoir-ng/datasets/solr', params=params, data=json.dumps(data))
+
+	# download a dataset archive in output_folder, returns the path of the downloaded archive
+	def download_dataset(self, dataset_id, file_format, output_folder):
+		file_format = 'nii' if file_format == 'nifti' else 'dcm'
+		with shanoir_metrics.stage('download'):
+			response = self.get('/shanoir-ng/datasets/datasets/download/' + str(dataset_id), params={ 'format': file_format }, stream=True)
+			return download_file(Path(output_folder), response)
+
+	def download_datasets(self, dataset_ids, file_format, output_folder):
+		file_format = 'nii' if file_format == 'nifti' else 'dcm'
+		params = dict(datasetIds=','.join([str(dataset_id) for dataset_id in dataset_ids]), format=file_format)
+		with shanoir_metrics.stage('download'):
+			response = self.post('/shanoir-ng/datasets/datasets/massiveDownload', params=params, files=params, stream=True)
+			return download_file(Path(output_folder), response)
+
+	def download_study(self, study_id, file_format, output_folder):
+		file_format = 'nii' if file_format == 'nifti' else 'dcm'
+		with shanoir_metrics.stage('download'):
+			response = self.get('/shanoir-ng/datasets/datasets/massiveDownloadByStudy', params={ 'studyId': study_id, 'format': file_format }, stream=True)
+			return download_file(Path(output_folder), response)
+
+	# examinations of a subject in a study (list of examination dicts)
+	def get_subject_examinations(self, subject_id, study_id):
+		response = self.get('/shanoir-ng/datasets/examinations/subject/' + str(subject_id) + '/study/' + str(study_id))
+		return response.json() if response.status_code != 204 else []
+
+	# dataset acquisitions of an examination, with their datasets (list of acquisition dicts)
+	def get_examination_acquisitions(self, examination_id):
+		response = self.get('/shanoir-ng/datasets/datasetacquisition/examination/' + str(examination_id))
+		return response.json() if response.status_code != 204 else []
+
+	# deletions return the status code of the response (204 on success)
+	def delete_dataset(self, dataset_id):
+		return self.delete('/shanoir-ng/datasets/datasets/' + str(dataset_id), raise_for_status=False).status_code
+
+	def delete_examination(self, examination_id):
+		return self.delete('/shanoir-ng/datasets/examinations/' + str(examination_id), raise_for_status=False).status_code
+
+	def delete_subject(self, subject_id, service='studies'):
+		return self.delete('/shanoir-ng/' + service + '/subjects/' + str(subject_id), raise_for_status=False).status_code
+
+	def create_execution(self, execution):
+		self.authenticate()
+		execution['refreshToken'] = self.refresh_token
+		response = self.post('/shanoir-ng/datasets/carmin-data/createExecution', {}, data=json.dumps(execution), raise_for_status=False)
+		if response.status_code == 401:
+			return '401'
+		return response.json()
+
+	def get_execution_status(self, identifier):
+		return self.get('/shanoir-ng/datasets/carmin-data/execution/' + identifier).content
+
+def get_client(config):
+	if 'client' not in config:
+		config['client'] = ShanoirClient.from_config(config)
+	return config['client']
+
+# The functions below are kept for the scripts using a config dict (see initialize()), they use the client of the config
 
-# get a new acess token using the refresh token
-def refresh_access_token(config):
-	url = 'https://' + config['domain'] + '/auth/realms/shanoir-ng/protocol/openid-connect/token'
-	payload = {
-		'grant_type' : 'refresh_token',
-		'refresh_token' : refresh_token,
-		'client_id' : 'shanoir-uploader'
-	}
-	headers = {'content-type': 'application/x-www-form-urlencoded'}
-	print('refresh keycloak token...')
-	response = requests.post(url, data=payload, headers=headers, proxies=config['proxies'], verify=config['verify'], timeout=config['timeout'])
-	if response.status_code != 200:
-		logging.error(f'response status : {response.status_code}, {responses[response.status_code]}')
-	response_json = response.json()
-	return response_json['access_token']
+def ask_access_token(config):
+	return get_client(config).ask_access_token()
 
-def perform_rest_request(config, rtype, url, **kwargs):
-	response = None
-	if rtype == 'get':
-		response = requests.get(url, proxies=config['proxies'], verify=config['verify'], timeout=config['timeout'], **kwargs)
-	elif rtype == 'post':
-		response = requests.post(url, proxies=config['proxies'], verify=config['verify'], timeout=config['timeout'], **kwargs)
-	else:
-		print('Error: unimplemented request type')
+def refresh_access_token(config):
+	return get_client(config).refresh_access_token()
 
-	return response
+def authenticate(config):
+	return get_client(config).authenticate()
 
+def perform_rest_request(config, rtype, url, **kwargs):
+	return get_client(config).perform_request(rtype, url, **kwargs)
 
 # perform a request on the given url, asks for a new access token if the current one is outdated
-def rest_request(config, rtype, url, raise_for_status=True, **kwargs):
-	global access_token
-	if access_token is None:
-		access_token = ask_access_token(config)
-	headers = { 
-		'Authorization' : 'Bearer ' + access_token,
-		'content-type' : 'application/json'
-	}
-	response = perform_rest_request(config, rtype, url, headers=headers, **kwargs)
-	# if token is outdated, refresh it and try again
-	if response.status_code == 401:
-		access_token = refresh_access_token(config)
-		headers['Authorization'] = 'Bearer ' + access_token
-		response = perform_rest_request(config, rtype, url, headers=headers, **kwargs)
-	if raise_for_status:
-		response.raise_for_status()
-	return response
+def rest_request(config, rtype, url, raise_for_status=True, extra_headers=None, **kwargs):
+	return get_client(config).request(rtype, url, raise_for_status, extra_headers, **kwargs)
 
 def log_response(e):
 	logging.error(f'Response status code: {e.response.status_code}')
@@ -271,12 +439,12 @@ def log_response(e):
 	return
 
 # perform a GET request on the given url, asks for a new access token if the current one is outdated
-def rest_get(config, url, params=None, stream=None):
-	return rest_request(config, 'get', url, params=params, stream=stream)
+def rest_get(config, url, params=None, stream=None, headers=None, raise_for_status=True):
+	return get_client(config).get(url, params, stream, headers, raise_for_status)
 
 # perform a POST request on the given url, asks for a new access token if the current one is outdated
 def rest_post(config, url, params=None, files=None, stream=None, json=None, data=None):
-	return rest_request(config, 'post', url, params=params, files=files, stream=stream, json=json, data=data)
+	return get_client(config).post(url, params=params, files=files, stream=stream, json=json, data=data)
 
 # # get every acquisition equipment from shanoir
 # url = 'https://' + config['domain'] + '/shanoir-ng/studies/acquisitionequipments'
@@ -293,46 +461,130 @@ def rest_post(config, url, params=None, files=None, stream=None, json=None, data
 # filename = re.findall('filename=(.+)', response.headers.get('Content-Disposition'))[0]
 # open(filename, 'wb').write(response.content)
 
+# download a dataset in config['output_folder'], returns the path of the downloaded archive
 def download_dataset(config, dataset_id, file_format, silent=False):
 	if not silent:
 		print('Downloading dataset', dataset_id)
+	return get_client(config).download_dataset(dataset_id, file_format, config['output_folder'])
+
+# get the size (in bytes) of a dataset archive without downloading it, with a zero-length range request ; returns None if the server does not tell
+def get_dataset_size(config, dataset_id, file_format):
 	file_format = 'nii' if file_format == 'nifti' else 'dcm'
-	url = 'https://' + config['domain'] + '/shanoir-ng/datasets/datasets/download/' + str(dataset_id)
-	response = rest_get(config, url, params={ 'format': file_format })
-	download_file(config['output_folder'], response)
-	return
+	url = '/shanoir-ng/datasets/datasets/download/' + str(dataset_id)
+	response = rest_get(config, url, params={ 'format': file_format }, stream=True, headers={ 'Range': 'bytes=0-0' })
+	response.close()
+	content_range = re.findall(r'/(\d+)$', response.headers.get('Content-Range', ''))
+	if response.status_code == 206 and len(content_range) > 0:
+		return int(content_range[0])
+	if 'Content-Length' in response.headers and response.headers.get('Content-Encoding') is None:
+		return int(response.headers['Content-Length'])
+	return None
+
+# measure the download bandwidth (in bytes per second) by reading (at most) the first max_bytes of a dataset archive
+def measure_bandwidth(config, dataset_id, file_format, max_bytes=8*1024*1024):
+	file_format = 'nii' if file_format == 'nifti' else 'dcm'
+	url = '/shanoir-ng/datasets/datasets/download/' + str(dataset_id)
+	start = time.perf_counter()
+	response = rest_get(config, url, params={ 'format': file_format }, stream=True, headers={ 'Range': f'bytes=0-{max_bytes-1}' })
+	n_bytes = 0
+	for data in response.iter_content(chunk_size=64*1024):
+		n_bytes += len(data)
+		if n_bytes >= max_bytes: break
+	response.close()
+	duration = time.perf_counter() - start
+	return n_bytes / duration if n_bytes > 0 and duration > 0 else None
+
+class RangesNotSupported(Exception):
+	pass
+
+class RemoteFile(io.RawIOBase):
+	"""
+	Read-only, seekable file reading a file of the server with HTTP range requests, by blocks of block_size bytes (kept in memory).
+	Enables to read a few members of a remote zip archive (with zipfile) without downloading it.
+	"""
+
+	def __init__(self, client, url, params, size, block_size=64*1024):
+		self.client = client
+		self.url = url
+		self.params = params
+		self.size = size
+		self.block_size = block_size
+		self.blocks = {}
+		self.position = 0
+
+	def readable(self):
+		return True
+
+	def seekable(self):
+		return True
+
+	def tell(self):
+		return self.position
+
+	def seek(self, offset, whence=io.SEEK_SET):
+		if whence == io.SEEK_SET:
+			self.position = offset
+		elif whence == io.SEEK_CUR:
+			self.position += offset
+		elif whence == io.SEEK_END:
+			self.position = self.size + offset
+		self.position = max(0, self.position)
+		return self.position
+
+	def get_block(self, index):
+		if index not in self.blocks:
+			start = index * self.block_size
+			end = min(start + self.block_size, self.size) - 1
+			response = self.client.get(self.url, params=self.params, stream=True, headers={ 'Range': f'bytes={start}-{end}' })
+			if response.status_code != 206:
+				response.close()
+				raise RangesNotSupported(f'the server answered {response.status_code} to a range request')
+			self.blocks[index] = response.content
+			shanoir_metrics.add_downloaded_bytes(len(self.blocks[index]))
+		return self.blocks[index]
+
+	def readinto(self, buffer):
+		n_bytes = max(0, min(len(buffer), self.size - self.position))
+		n_read = 0
+		while n_read < n_bytes:
+			index, offset = divmod(self.position, self.block_size)
+			data = self.get_block(index)[offset:offset + n_bytes - n_read]
+			if len(data) == 0: break
+			buffer[n_read:n_read + len(data)] = data
+			n_read += len(data)
+			self.position += len(data)
+		return n_read
+
+# open a dataset archive of the server as a file (see RemoteFile) without downloading it, raises RangesNotSupported if the server does not support range requests
+def open_remote_dataset(config, dataset_id, file_format, block_size=64*1024):
+	file_format = 'nii' if file_format == 'nifti' else 'dcm'
+	url = '/shanoir-ng/datasets/datasets/download/' + str(dataset_id)
+	response = rest_get(config, url, params={ 'format': file_format }, stream=True, headers={ 'Range': 'bytes=0-0' })
+	response.close()
+	content_range = re.findall(r'/(\d+)$', response.headers.get('Content-Range', ''))
+	if response.status_code != 206 or len(content_range) == 0:
+		raise RangesNotSupported(f'the server answered {response.status_code} to a range request')
+	return RemoteFile(get_client(config), url, { 'format': file_format }, int(content_range[0]), block_size)
 
 def download_datasets(config, dataset_ids, file_format):
 	if len(dataset_ids) > 50:
 		logging.warning('Cannot download more than 50 datasets at once. Please use the --search_text option instead to download the datasets one by one.')
 		return
 	print('Downloading datasets', dataset_ids)
-	file_format = 'nii' if file_format == 'nifti' else 'dcm'
-	dataset_ids = ','.join([str(dataset_id) for dataset_id in dataset_ids])
-	url = 'https://' + config['domain'] + '/shanoir-ng/datasets/datasets/massiveDownload'
-	params = dict(datasetIds=dataset_ids, format=file_format)
-	response = rest_post(config, url, params=params, files=params, stream=True)
-	download_file(config['output_folder'], response)
-	return
+	return get_client(config).download_datasets(dataset_ids, file_format, config['output_folder'])
 
 def download_dataset_by_study(config, study_id, file_format):
 	print('Downloading datasets from study', study_id)
-	file_format = 'nii' if file_format == 'nifti' else 'dcm'
-	url = 'https://' + config['domain'] + '/shanoir-ng/datasets/datasets/massiveDownloadByStudy'
-	response = rest_get(config, url, params={ 'studyId': study_id, 'format': file_format })
-	download_file(config['output_folder'], response)
-	return
+	return get_client(config).download_study(study_id, file_format, config['output_folder'])
 
 def find_dataset_ids_by_subject_id(config, subject_id):
 	print('Getting datasets from subject', subject_id)
-	url = 'https://' + config['domain'] + '/shanoir-ng/datasets/datasets/subject/' + subject_id
-	response = rest_get(config, url)
+	response = rest_get(config, '/shanoir-ng/datasets/datasets/subject/' + subject_id)
 	return response.json()
 
 def find_dataset_ids_by_subject_id_study_id(config, subject_id, study_id):
 	print('Getting datasets from subject', subject_id, 'and study', study_id)
-	url = 'https://' + config['domain'] + '/shanoir-ng/datasets/datasets/subject/' + subject_id + '/study/' + study_id
-	response = rest_get(config, url)
+	response = rest_get(config, '/shanoir-ng/datasets/datasets/subject/' + subject_id + '/study/' + study_id)
 	return response.json()
 
 def download_dataset_by_subject(config, subject_id, file_format):
@@ -383,6 +635,9 @@ def download_datasets_from_ids(args):
 		log_response(e)
 	except requests.RequestException as e:
 		logging.error(str(e))
+	# authentication failed: stop the script
+	except ConnectionError:
+		raise
 	except Exception as e:
 		logging.error(str(e))
 	
@@ -424,31 +679,27 @@ def solr_search(config, args):
 	#   "subjectName": {}
 	# }
 
-	url = 'https://' + config['domain'] + '/shanoir-ng/datasets/solr'
-	data = {
-		# 'subjectName': ['01001'],
-		'expertMode': args.expert_mode,
-		'searchText': args.search_text
-	}
-
-	params = dict(page=args.page, size=args.size, sort=args.sort)
-	response = rest_post(config, url, params=params, data=json.dumps(data))
-
-	return response
+	return get_client(config).search(args.search_text, args.expert_mode, page=args.page, size=args.size, sort=args.sort)
 	
 def download_search_results(config, args, response):
 
 	if response.status_code == 200:
 		json_content = response.json()['content']
-		for item in json_content:
+		for i, item in enumerate(json_content):
+			shanoir_metrics.set_queue_depth('to_download', len(json_content) - i)
 			try:
 				download_dataset(config, item['datasetId'], args.format, False)
+				shanoir_metrics.dataset_done()
 			except requests.HTTPError as e:
+				shanoir_metrics.error('status_code_' + str(e.response.status_code))
 				log_response(e)
 			except requests.RequestException as e:
+				shanoir_metrics.error('request_error')
 				logging.error(str(e))
 			except Exception as e:
+				shanoir_metrics.error('unknown_error')
 				logging.error(str(e))
+		shanoir_metrics.set_queue_depth('to_download', 0)
 	return
 
 
@@ -458,12 +709,17 @@ if __name__ == '__main__':
 	add_search_arguments(parser)
 	add_ids_arguments(parser)
 	add_configuration_arguments(parser)
+	shanoir_metrics.add_metrics_arguments(parser)
 	args = parser.parse_args()
 	config = initialize(args)
-	if args.search_text:
-		response = solr_search(config, args)
-		download_search_results(config, args, response)
-	elif any([getattr(args, arg_name) is not None for arg_name in ['dataset_id', 'dataset_ids', 'study_id', 'subject_id']]):
-		download_datasets_from_ids(args)
-	else:
-		print('You must either provide the search_text argument, or an argument in the list [dataset_id, dataset_ids, study_id, subject_id].')
\ No newline at end of file
+	shanoir_metrics.start(args)
+	try:
+		if args.search_text:
+			response = solr_search(config, args)
+			download_search_results(config, args, response)
+		elif any([getattr(args, arg_name) is not None for arg_name in ['dataset_id', 'dataset_ids', 'study_id', 'subject_id']]):
+			download_datasets_from_ids(args)
+		else:
+			print('You must either provide the search_text argument, or an argument in the list [dataset_id, dataset_ids, study_id, subject_id].')
+	except ConnectionError as e:
+		sys.exit(f'Error: {e}')
\ No newline at end of file
@@ -1,4 +1,4 @@
-from datetime import datetime
+from datetime import datetime, timedelta
 import time
 import os
 import sys
@@ -9,6 +9,7 @@ import shutil
 import subprocess
 import requests
 import zipfile
+from concurrent.futures import ThreadPoolExecutor
 from dotenv import load_dotenv
 import pydicom
 import pandas
@@ -16,6 +17,7 @@ import numpy as np
 from pydicom import Dataset
 
 import shanoir_downloader
+import shanoir_metrics
 from py7zr import pack_7zarchive, unpack_7zarchive
 
 # register 7zip file format
@@ -25,6 +27,9 @@ shutil.register_unpack_format('7zip', ['.7z'], unpack_7zarchive)
 SHANOIR_SHUTDOWN_HOUR = 2
 SHANOIR_AVAILABLE_HOUR = 5
 
+# Estimated size of the extracted dicoms relatively to the downloaded zip archive (used to plan the required disk space)
+EXTRACTION_RATIO = 2
+
 Path.ls = lambda x: sorted(list(x.iterdir()))
 
 datasets_dtype = {'sequence_id': str, 'shanoir_name': str, 'series_description': str, 'patient_name_in_dicom': str, 'series_description_in_dicom': str}
@@ -40,6 +45,8 @@ def append_row(df, row):
 
 def add_missing_dataset(missing_datasets, sequence_id, reason, message, raw_folder, unrecoverable_errors, missing_datasets_path):
 	logging.error(f'For dataset {sequence_id}: {message}')
+	shanoir_metrics.error(reason)
+	shanoir_metrics.dataset_done('missing')
 	if sequence_id in missing_datasets.index:
 		missing_datasets.loc[sequence_id, 'n_tries'] += 1
 		missing_datasets.loc[sequence_id, 'reason'] = reason
@@ -68,6 +75,7 @@ def add_downloaded_dataset(all_datasets, downloaded_datasets, missing_datasets,
 	downloaded_datasets.to_csv(str(downloaded_datasets_path), sep='\t')
 	missing_datasets.drop(sequence_id, inplace=True, errors='ignore')
 	missing_datasets.to_csv(str(missing_datasets_path), sep='\t')
+	shanoir_metrics.dataset_done('downloaded')
 	return downloaded_datasets
 
 def rename_path(old_path, new_path):
@@ -118,10 +126,14 @@ def create_arg_parser():
 	parser.add_argument('-dids', '--downloaded_datasets', default=None, help='Path to a tsv file containing the already downloaded datasets (generated by this script). Creates the file "downloaded_datasets.tsv" in the given output_folder by default. If the file already exists, it will be taken into account and updated with the new downloads.')
 	parser.add_argument('-mids', '--missing_datasets', default=None, help='Path to a tsv file containing the missing datasets (generated by this script). Creates the file "missings_datasets.tsv" in the given output_folder by default. If the file already exists, it will be taken into account and updated with the new errors.')
 	parser.add_argument('-vids', '--verified_datasets', default=None, help='Path to a tsv file containing the verified datasets (the file could be downloaded_datasets.tsv generated by this script). Datasets listed in this file will be marked as verified.')
+	parser.add_argument('-pl', '--plan', action='store_true', help='Do not download anything: compute the datasets to download (from the input file and the existing downloaded_datasets and missing_datasets files), get their sizes and estimate the download duration and the required disk space.')
+	parser.add_argument('-plw', '--plan_workers', type=int, default=8, help='Number of parallel requests used to get the dataset sizes with --plan.')
+	parser.add_argument('-plb', '--plan_bandwidth', type=float, default=None, help='Bandwidth in MiB/s used to estimate the download duration with --plan (measured by downloading a part of the biggest dataset by default).')
 	parser.add_argument('-af', '--anonymization_fields', default=None, help='Path to a tsv file containing the fields to overwrite. Default is anonymization_fields.tsv beside in shanoir_downloader_check.py.')
 
 	shanoir_downloader.add_configuration_arguments(parser)
 	shanoir_downloader.add_search_arguments(parser)
+	shanoir_metrics.add_metrics_arguments(parser)
 	return parser
 
 def download_datasets_from_dict(arg_dict, config=None, all_datasets=None):
@@ -133,28 +145,126 @@ def download_datasets_from_dict(arg_dict, config=None, all_datasets=None):
 	download_datasets(args, config, all_datasets)
 	return
 
+def load_all_datasets(args, config):
+	all_datasets = None
+	if args.search_text and not args.dataset_ids:
+		response = shanoir_downloader.solr_search(config, args)
+
+		if response.status_code == 200:
+			json_content = response.json()['content']
+			# convert to pandas dataframe
+			all_datasets = pandas.DataFrame(json_content)
+			all_datasets.rename(columns={'id': 'sequence_id'}, inplace=True)
+			if len(all_datasets) == 0:
+				sys.exit(f'No datasets found for the search text "{args.search_text}".')
+	elif args.dataset_ids:
+		if args.dataset_ids.endswith('.csv') or args.dataset_ids.endswith('.tsv') or args.dataset_ids.endswith('.txt'):
+			all_datasets = pandas.read_csv(args.dataset_ids, sep=',' if args.dataset_ids.endswith('.csv') else '\t', dtype=datasets_dtype)
+		else:
+			all_datasets = pandas.read_excel(args.dataset_ids, dtype=datasets_dtype)
+	return all_datasets
+
+def filter_datasets(all_datasets, skip_columns):
+	all_datasets.set_index('sequence_id', inplace=True)
+	# Drop duplicates
+	all_datasets = all_datasets[~all_datasets.index.duplicated(keep='first')]
+	# Drop datasets to ignore from skip_columns
+	if skip_columns and len(skip_columns) > 0:
+		for skip_column in skip_columns:
+			try:
+				column_name, value = skip_column.split(':')
+				if column_name in all_datasets.columns:
+					all_datasets = all_datasets[all_datasets[column_name] != value]
+			except Exception as e:
+				sys.exit(f'Error while parsing skip_columns argument: {skip_column}\n {e}')
+	return all_datasets
+
+def get_state_paths(args, output_folder):
+	missing_datasets_path = output_folder / f'missing_datasets.tsv' if args.missing_datasets is None else Path(args.missing_datasets)
+	downloaded_datasets_path = output_folder / f'downloaded_datasets.tsv' if args.downloaded_datasets is None else Path(args.downloaded_datasets)
+	return missing_datasets_path, downloaded_datasets_path
+
+def load_state(missing_datasets_path, downloaded_datasets_path):
+	missing_datasets = pandas.DataFrame(columns=['sequence_id', 'reason', 'message', 'n_tries']) if not missing_datasets_path.exists() else pandas.read_csv(str(missing_datasets_path), sep='\t', dtype=missing_datasets_dtype)
+	missing_datasets.set_index('sequence_id', inplace=True)
+
+	downloaded_datasets = pandas.DataFrame(columns=['sequence_id']) if not downloaded_datasets_path.exists() else pandas.read_csv(str(downloaded_datasets_path), sep='\t', dtype=datasets_dtype)
+	downloaded_datasets.set_index('sequence_id', inplace=True)
+	return missing_datasets, downloaded_datasets
+
+# datasets_to_download is all_datasets except those already downloaded and those missing which are unrecoverable or tried more than max_tries times
+def get_datasets_to_download(all_datasets, downloaded_datasets, missing_datasets, max_tries, unrecoverable_errors):
+	datasets_to_download = all_datasets[~all_datasets.index.isin(downloaded_datasets.index)]
+	datasets_max_tries = missing_datasets[missing_datasets['n_tries'] >= max_tries].index
+	datasets_unrecoverable = missing_datasets[missing_datasets['reason'].isin(unrecoverable_errors)].index
+	return datasets_to_download.drop(datasets_max_tries.union(datasets_unrecoverable), errors='ignore')
+
+def format_size(n_bytes):
+	for unit in ['B', 'KiB', 'MiB', 'GiB', 'TiB']:
+		if abs(n_bytes) < 1024 or unit == 'TiB':
+			return f'{n_bytes:.1f} {unit}'
+		n_bytes /= 1024
+
+def plan_downloads(args, config, datasets_to_download):
+	output_folder = Path(config['output_folder'])
+	sequence_ids = list(datasets_to_download.index)
+	logging.info(f'Planning the download of {len(sequence_ids)} datasets...')
+	if len(sequence_ids) == 0: return None
+
+	# Authenticate once before sending the requests in parallel
+	shanoir_downloader.authenticate(config)
+
+	def get_size(sequence_id):
+		try:
+			return shanoir_downloader.get_dataset_size(config, sequence_id, 'dicom')
+		except Exception as e:
+			logging.error(f'Could not get the size of dataset {sequence_id}: {e}')
+			return None
+
+	with ThreadPoolExecutor(max_workers=args.plan_workers) as executor:
+		sizes = list(executor.map(get_size, sequence_ids))
+
+	plan = pandas.DataFrame({'sequence_id': sequence_ids, 'size': sizes}).set_index('sequence_id')
+	plan_path = output_folder / 'download_plan.tsv'
+	plan.to_csv(str(plan_path), sep='\t')
+
+	known_sizes = plan['size'].dropna()
+	total_size = known_sizes.sum()
+	largest_size = known_sizes.max() if len(known_sizes) > 0 else 0
+	n_unknown = len(plan) - len(known_sizes)
+	
+	bandwidth = args.plan_bandwidth * 1024 * 1024 if args.plan_bandwidth else None
+	if bandwidth is None and len(known_sizes) > 0:
+		bandwidth = shanoir_downloader.measure_bandwidth(config, known_sizes.idxmax(), 'dicom')
+
+	# Disk space: downloaded zips are kept in raw/, the final outputs (7z or gpg) in processed/,
+	# and the largest dataset needs its extracted (and anonymized) dicoms, 7z and gpg files at the same time
+	encrypt = not args.skip_encryption and (args.gpg_recipient or 'gpg_recipient' in os.environ)
+	n_dicom_copies = 1 if args.skip_anonymization else 2
+	output_ratio = 1 + (1 if not args.skip_anonymization or encrypt else 0)
+	if args.keep_intermediate_files:
+		output_ratio += EXTRACTION_RATIO * n_dicom_copies + (1 if not args.skip_anonymization and encrypt else 0)
+	scratch_ratio = EXTRACTION_RATIO * n_dicom_copies + (0 if args.skip_anonymization else 1) + (1 if encrypt else 0)
+	required_space = total_size * output_ratio + largest_size * scratch_ratio
+
+	logging.info(f'Plan written in {plan_path}')
+	logging.info(f'    {len(plan)} datasets to download, {format_size(total_size)} in total' + (f' ({n_unknown} datasets of unknown size)' if n_unknown > 0 else ''))
+	if bandwidth:
+		logging.info(f'    Bandwidth: {format_size(bandwidth)}/s, expected download duration: {timedelta(seconds=int(total_size / bandwidth))}')
+	else:
+		logging.info('    Could not measure the bandwidth, expected download duration unknown')
+	logging.info(f'    Required disk space in {output_folder}: {format_size(required_space)} (including {format_size(largest_size * scratch_ratio)} of scratch space)')
+	return plan
+
 def download_datasets(args, config=None, all_datasets=None):
 
 	if config is None:
 		config = shanoir_downloader.initialize(args)
 
-	if all_datasets is None:
+	shanoir_metrics.start(args)
 
-		if args.search_text and not args.dataset_ids:
-			response = shanoir_downloader.solr_search(config, args)
-
-			if response.status_code == 200:
-				json_content = response.json()['content']
-				# convert to pandas dataframe
-				all_datasets = pandas.DataFrame(json_content)
-				all_datasets.rename(columns={'id': 'sequence_id'}, inplace=True)
-				if len(all_datasets) == 0:
-					sys.exit(f'No datasets found for the search text "{args.search_text}".')
-		elif args.dataset_ids:
-			if args.dataset_ids.endswith('.csv') or args.dataset_ids.endswith('.tsv') or args.dataset_ids.endswith('.txt'):
-				all_datasets = pandas.read_csv(args.dataset_ids, sep=',' if args.dataset_ids.endswith('.csv') else '\t', dtype=datasets_dtype)
-			else:
-				all_datasets = pandas.read_excel(args.dataset_ids, dtype=datasets_dtype)
+	if all_datasets is None:
+		all_datasets = load_all_datasets(args, config)
 
 	gpg_recipient = args.gpg_recipient or (os.environ['gpg_recipient'] if 'gpg_recipient' in os.environ else None)
 
@@ -163,30 +273,18 @@ def download_datasets(args, config=None, all_datasets=None):
 
 	output_folder = Path(config['output_folder'])
 
-	all_datasets.set_index('sequence_id', inplace=True)
-	# Drop duplicates
-	all_datasets = all_datasets[~all_datasets.index.duplicated(keep='first')]
-	# Drop datasets to ignore from skip_columns
-	if args.skip_columns and len(args.skip_columns) > 0:
-		for skip_column in args.skip_columns:
-			try:
-				column_name, value = skip_column.split(':')
-				if column_name in all_datasets.columns:
-					all_datasets = all_datasets[all_datasets[column_name] != value]
-			except Exception as e:
-				sys.exit(f'Error while parsing skip_columns argument: {skip_column}\n {e}')
+	all_datasets = filter_datasets(all_datasets, args.skip_columns)
 
 	# Create missing_datasets and downloaded_datasets tsv files
-	missing_datasets_path = output_folder / f'missing_datasets.tsv' if args.missing_datasets is None else Path(args.missing_datasets)
-	downloaded_datasets_path = output_folder / f'downloaded_datasets.tsv' if args.downloaded_datasets is None else Path(args.downloaded_datasets)
+	missing_datasets_path, downloaded_datasets_path = get_state_paths(args, output_folder)
 
 	verified_datasets = pandas.read_csv(args.verified_datasets, index_col='sequence_id', sep=',' if args.verified_datasets.endswith('.csv') else '\t', dtype=datasets_dtype) if args.verified_datasets else None
 
-	missing_datasets = pandas.DataFrame(columns=['sequence_id', 'reason', 'message', 'n_tries']) if not missing_datasets_path.exists() else pandas.read_csv(str(missing_datasets_path), sep='\t', dtype=missing_datasets_dtype)
-	missing_datasets.set_index('sequence_id', inplace=True)
+	missing_datasets, downloaded_datasets = load_state(missing_datasets_path, downloaded_datasets_path)
 
-	downloaded_datasets = pandas.DataFrame(columns=['sequence_id']) if not downloaded_datasets_path.exists() else pandas.read_csv(str(downloaded_datasets_path), sep='\t', dtype=datasets_dtype)
-	downloaded_datasets.set_index('sequence_id', inplace=True)
+	if getattr(args, 'plan', False):
+		plan_downloads(args, config, get_datasets_to_download(all_datasets, downloaded_datasets, missing_datasets, args.max_tries, args.unrecoverable_errors))
+		return
 
 	anonymization_fields_path = Path(args.anonymization_fields) if args.anonymization_fields else Path(__file__).parent / 'anonymization_fields.tsv'
 
@@ -204,11 +302,7 @@ def download_datasets(args, config=None, all_datasets=None):
 	# (all the missing datasets are unrecoverable or tried more than args.max_tries times)
 	while len(datasets_to_download) > 0:
 
-		# datasets_to_download is all_datasets except those already downloaded and those missing which are unrecoverable
-		datasets_to_download = all_datasets[~all_datasets.index.isin(downloaded_datasets.index)]
-		datasets_max_tries = missing_datasets[missing_datasets['n_tries'] >= args.max_tries].index
-		datasets_unrecoverable = missing_datasets[missing_datasets['reason'].isin(args.unrecoverable_errors)].index
-		datasets_to_download = datasets_to_download.drop(datasets_max_tries.union(datasets_unrecoverable))
+		datasets_to_download = get_datasets_to_download(all_datasets, downloaded_datasets, missing_datasets, args.max_tries, args.unrecoverable_errors)
 
 		logging.info(f'There are {len(datasets_to_download)} remaining datasets to download.')
 
@@ -230,8 +324,12 @@ def download_datasets(args, config=None, all_datasets=None):
 			patient_id = row['patient_id'] if 'patient_id' in row else None
 
 			logging.info(f'Downloading dataset {sequence_id} ({n}/{len(datasets_to_download)}), shanoir name: {shanoir_name}, series description: {series_description}, patient id: {patient_id}')
+			shanoir_metrics.set_queue_depth('to_download', len(datasets_to_download) - n + 1)
 			n += 1
 
+			if sequence_id in missing_datasets.index:
+				shanoir_metrics.retry(missing_datasets.at[sequence_id, 'reason'])
+
 			# Create the destination folder for this dataset
 			destination_folder = raw_folder / sequence_id / 'downloaded_archive'
 			destination_folder.mkdir(exist_ok=True, parents=True)
@@ -269,7 +367,7 @@ def download_datasets(args, config=None, all_datasets=None):
 			dicom_folder.mkdir(exist_ok=True)
 			# shutil.unpack_archive(str(dicom_zip), str(dicom_folder))
 
-			with zipfile.ZipFile(str(dicom_zip), 'r') as zip_ref:
+			with shanoir_metrics.stage('extract'), zipfile.ZipFile(str(dicom_zip), 'r') as zip_ref:
 				zip_ref.extractall(str(dicom_folder))
 
 			dicom_files = list(dicom_folder.glob('*.dcm'))
@@ -289,7 +387,8 @@ def download_datasets(args, config=None, all_datasets=None):
 				logging.info(f'    Verifying file {dicom_file}...')
 				ds = None
 				try:
-					ds = pydicom.dcmread(str(dicom_file))
+					with shanoir_metrics.stage('verify'):
+						ds = pydicom.dcmread(str(dicom_file))
 					patient_name_in_dicom = str(ds.PatientName)
 					series_description_in_dicom = str(ds.SeriesDescription)
 
@@ -328,7 +427,8 @@ def download_datasets(args, config=None, all_datasets=None):
 					anonymized_dicom_folder.mkdir(exist_ok=True)
 					# import dicomanonymizer
 					# dicomanonymizer.anonymize(str(dicom_folder), str(anonymized_dicom_folder), extraAnonymizationRules, True)
-					anonymize_fields(anonymization_fields, dicom_files, anonymized_dicom_folder, str(sequence_id), str(patient_id), str(shanoir_name))
+					with shanoir_metrics.stage('anonymize'):
+						anonymize_fields(anonymization_fields, dicom_files, anonymized_dicom_folder, str(sequence_id), str(patient_id), str(shanoir_name))
 				except Exception as e:
 					missing_datasets = add_missing_dataset(missing_datasets, sequence_id, 'anonymization_error', str(e), raw_folder, args.unrecoverable_errors, missing_datasets_path)
 					continue
@@ -337,7 +437,8 @@ def download_datasets(args, config=None, all_datasets=None):
 				dicom_zip_to_encrypt = anonymized_dicom_folder.parent / f'{anonymized_dicom_folder.name}.7z'
 				logging.info(f'    Compressing dataset to {dicom_zip_to_encrypt}...')
 				try:
-					shutil.make_archive(str(anonymized_dicom_folder), '7zip', str(anonymized_dicom_folder))
+					with shanoir_metrics.stage('compress'):
+						shutil.make_archive(str(anonymized_dicom_folder), '7zip', str(anonymized_dicom_folder))
 				except Exception as e:
 					missing_datasets = add_missing_dataset(missing_datasets, sequence_id, 'zip_compression_error', str(e), raw_folder, args.unrecoverable_errors, missing_datasets_path)
 					continue
@@ -351,7 +452,8 @@ def download_datasets(args, config=None, all_datasets=None):
 				logging.info(f'    Encrypting dataset to {encrypted_dicom_zip}...')
 				command = ['gpg', '--output', str(encrypted_dicom_zip), '--encrypt', '--recipient', gpg_recipient, '--trust-model', 'always', str(dicom_zip)]
 				try:
-					return_code = subprocess.call(command)
+					with shanoir_metrics.stage('encrypt'):
+						return_code = subprocess.call(command)
 				except Exception as e:
 					missing_datasets = add_missing_dataset(missing_datasets, sequence_id, 'encryption_error', str(e), raw_folder, args.unrecoverable_errors, missing_datasets_path)
 					continue
@@ -410,4 +512,7 @@ if __name__ == '__main__':
 	if args.dataset_ids and args.search_text:
 		print('Both --dataset_ids and --search_text arguments were provided. The --search_text argument will be ignored.')
 
-	download_datasets(args)
\ No newline at end of file
+	try:
+		download_datasets(args)
+	except ConnectionError as e:
+		sys.exit(f'Error: {e}')
\ No newline at end of file
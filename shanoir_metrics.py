@@ -0,0 +1,275 @@
+import os
+import copy
+import json
+import time
+import atexit
+import logging
+import threading
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+
+# Live metrics for the shanoir scripts (shanoir_downloader, shanoir_downloader_check, shanoir2bids).
+# Metrics are kept in memory by the process-wide registry below and exposed either as a Prometheus text endpoint on localhost (--metrics_port),
+# or as a JSON file periodically rewritten (--metrics_file).
+
+# Module logger (not the root logger) so that starting the exporters does not configure logging before init_logging()
+logger = logging.getLogger(__name__)
+
+DEFAULT_BUCKETS = (0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1800)
+
+BYTES_DOWNLOADED = 'shanoir_downloaded_bytes_total'
+DATASETS = 'shanoir_datasets_total'
+STAGE_DURATION = 'shanoir_stage_duration_seconds'
+REQUEST_DURATION = 'shanoir_request_duration_seconds'
+REQUESTS = 'shanoir_requests_total'
+QUEUE_DEPTH = 'shanoir_queue_depth'
+RETRIES = 'shanoir_retries_total'
+ERRORS = 'shanoir_errors_total'
+
+HELP = {
+    BYTES_DOWNLOADED: 'Number of bytes downloaded from shanoir.',
+    DATASETS: 'Number of processed datasets, by status.',
+    STAGE_DURATION: 'Duration of each processing stage (download, extract, verify, anonymize, compress, encrypt, convert...).',
+    REQUEST_DURATION: 'Duration of the REST requests until the response headers are received.',
+    REQUESTS: 'Number of REST requests, by method and status code.',
+    QUEUE_DEPTH: 'Number of items waiting to be processed, by queue.',
+    RETRIES: 'Number of retries, by reason.',
+    ERRORS: 'Number of errors, by reason.',
+}
+
+# Label values can contain any character (dataset names, error messages): backslashes, double quotes and line feeds must be escaped in the text format
+def escape_label_value(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+class Registry:
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.start_time = time.time()
+        self.kinds = {}
+        self.values = {}
+
+    def _key(self, name, kind, labels):
+        if self.kinds.setdefault(name, kind) != kind:
+            raise ValueError(f'Metric {name} is a {self.kinds[name]}, not a {kind}.')
+        return tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+    def inc(self, name, value=1, **labels):
+        with self.lock:
+            values = self.values.setdefault(name, {})
+            key = self._key(name, 'counter', labels)
+            values[key] = values.get(key, 0) + value
+
+    def set(self, name, value, **labels):
+        with self.lock:
+            self.values.setdefault(name, {})[self._key(name, 'gauge', labels)] = value
+
+    def observe(self, name, value, buckets=DEFAULT_BUCKETS, **labels):
+        with self.lock:
+            values = self.values.setdefault(name, {})
+            key = self._key(name, 'histogram', labels)
+            histogram = values.setdefault(key, {'buckets': list(buckets), 'counts': [0] * len(buckets), 'sum': 0.0, 'count': 0})
+            for i, bound in enumerate(histogram['buckets']):
+                if value <= bound:
+                    histogram['counts'][i] += 1
+            histogram['sum'] += value
+            histogram['count'] += 1
+
+    def clear(self):
+        with self.lock:
+            self.kinds = {}
+            self.values = {}
+
+    def export(self):
+        with self.lock:
+            return {name: (self.kinds[name], copy.deepcopy(values)) for name, values in self.values.items()}
+
+    # Add the metrics exported by another registry (a worker process): counters and histograms are summed, gauges are replaced
+    def merge(self, exported):
+        with self.lock:
+            for name, (kind, values) in exported.items():
+                for key, value in values.items():
+                    if self.kinds.setdefault(name, kind) != kind:
+                        raise ValueError(f'Metric {name} is a {self.kinds[name]}, not a {kind}.')
+                    current = self.values.setdefault(name, {}).get(key)
+                    if current is None or kind == 'gauge':
+                        self.values[name][key] = copy.deepcopy(value)
+                    elif kind == 'counter':
+                        self.values[name][key] = current + value
+                    else:
+                        current['counts'] = [a + b for a, b in zip(current['counts'], value['counts'])]
+                        current['sum'] += value['sum']
+                        current['count'] += value['count']
+
+    def total(self, name):
+        with self.lock:
+            return sum(self.values.get(name, {}).values()) if self.kinds.get(name) == 'counter' else 0
+
+    def derived(self):
+        # Rates computed since the process started, useful to see at a glance if we are bound by network, CPU or disk
+        elapsed = max(time.time() - self.start_time, 1e-6)
+        times = os.times()
+        return {
+            'shanoir_uptime_seconds': elapsed,
+            'shanoir_process_cpu_seconds_total': times.user + times.system + times.children_user + times.children_system,
+            'shanoir_datasets_per_minute': 60 * self.total(DATASETS) / elapsed,
+            'shanoir_download_bytes_per_second': self.total(BYTES_DOWNLOADED) / elapsed,
+        }
+
+    def to_dict(self):
+        with self.lock:
+            metrics = {}
+            for name, values in self.values.items():
+                samples = []
+                for key, value in values.items():
+                    sample = {'labels': dict(key)}
+                    if self.kinds[name] == 'histogram':
+                        sample.update({'sum': value['sum'], 'count': value['count'], 'buckets': dict(zip([str(b) for b in value['buckets']], value['counts']))})
+                    else:
+                        sample['value'] = value
+                    samples.append(sample)
+                metrics[name] = {'type': self.kinds[name], 'samples': samples}
+        metrics.update({name: {'type': 'gauge', 'samples': [{'labels': {}, 'value': value}]} for name, value in self.derived().items()})
+        return {'timestamp': time.time(), 'metrics': metrics}
+
+    def to_prometheus(self):
+        lines = []
+        def format_labels(labels):
+            return '{' + ','.join(f'{k}="{escape_label_value(v)}"' for k, v in labels) + '}' if len(labels) > 0 else ''
+        with self.lock:
+            for name, values in sorted(self.values.items()):
+                kind = self.kinds[name]
+                if name in HELP:
+                    lines.append(f'# HELP {name} {HELP[name]}')
+                lines.append(f'# TYPE {name} {kind}')
+                for key, value in values.items():
+                    if kind == 'histogram':
+                        for bound, count in zip(value['buckets'], value['counts']):
+                            lines.append(f'{name}_bucket{format_labels(key + (("le", str(bound)),))} {count}')
+                        lines.append(f'{name}_bucket{format_labels(key + (("le", "+Inf"),))} {value["count"]}')
+                        lines.append(f'{name}_sum{format_labels(key)} {value["sum"]}')
+                        lines.append(f'{name}_count{format_labels(key)} {value["count"]}')
+                    else:
+                        lines.append(f'{name}{format_labels(key)} {value}')
+        for name, value in self.derived().items():
+            lines.append(f'# TYPE {name} {"counter" if name.endswith("_total") else "gauge"}')
+            lines.append(f'{name} {value}')
+        return '\n'.join(lines) + '\n'
+
+registry = Registry()
+
+def inc(name, value=1, **labels):
+    registry.inc(name, value, **labels)
+
+def set_gauge(name, value, **labels):
+    registry.set(name, value, **labels)
+
+def observe(name, value, **labels):
+    registry.observe(name, value, **labels)
+
+def add_downloaded_bytes(n_bytes):
+    registry.inc(BYTES_DOWNLOADED, n_bytes)
+
+def dataset_done(status='downloaded'):
+    registry.inc(DATASETS, status=status)
+
+# The reasons can come from pandas (NaN when missing): they are always recorded as strings
+def error(reason):
+    registry.inc(ERRORS, reason=str(reason))
+
+def retry(reason):
+    registry.inc(RETRIES, reason=str(reason))
+
+def set_queue_depth(queue, depth):
+    registry.set(QUEUE_DEPTH, depth, queue=queue)
+
+# The registry is per process: the metrics recorded in a worker process (ProcessPoolExecutor) are lost unless the worker runs
+# its task with collect() and the parent merges them: executor.submit(shanoir_metrics.collect, function, *args), then
+# result, metrics = future.result() and shanoir_metrics.merge(metrics) (the metrics of a failed task are in the metrics attribute of the exception)
+def collect(function, *args):
+    # The registry of a forked worker is a copy of the parent registry, and the worker may have run other tasks: only the metrics of this task are returned
+    registry.clear()
+    try:
+        return function(*args), registry.export()
+    except Exception as e:
+        e.metrics = registry.export()
+        raise
+
+def merge(metrics):
+    if metrics is not None:
+        registry.merge(metrics)
+
+# Measure the duration of a processing stage: with shanoir_metrics.stage('extract'): ...
+@contextmanager
+def stage(name):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        registry.observe(STAGE_DURATION, time.perf_counter() - start, stage=name)
+
+class MetricsHandler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        if self.path.split('?')[0] not in ['/', '/metrics']:
+            self.send_error(404)
+            return
+        body = registry.to_prometheus().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        return
+
+http_server = None
+json_writer = None
+
+def start_http_server(port, host='127.0.0.1'):
+    global http_server
+    if http_server is not None: return http_server
+    http_server = ThreadingHTTPServer((host, port), MetricsHandler)
+    http_server.daemon_threads = True
+    threading.Thread(target=http_server.serve_forever, name='shanoir-metrics-http', daemon=True).start()
+    logger.info(f'Serving metrics on http://{host}:{http_server.server_port}/metrics')
+    return http_server
+
+def write_json(path):
+    path = Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = path.with_name(path.name + '.tmp')
+    with open(tmp_path, 'w') as file:
+        json.dump(registry.to_dict(), file, indent=1)
+    # Atomic replace so that readers never see a partial file
+    os.replace(tmp_path, path)
+
+def start_json_writer(path, interval=10):
+    global json_writer
+    if json_writer is not None: return json_writer
+    def write_periodically():
+        while True:
+            time.sleep(interval)
+            try:
+                write_json(path)
+            except Exception as e:
+                logger.warning(f'Could not write metrics to {path}: {e}')
+    json_writer = threading.Thread(target=write_periodically, name='shanoir-metrics-json', daemon=True)
+    json_writer.start()
+    atexit.register(write_json, path)
+    logger.info(f'Writing metrics to {path} every {interval} seconds')
+    return json_writer
+
+def add_metrics_arguments(parser):
+    parser.add_argument('-mp', '--metrics_port', type=int, default=None, help='Expose live metrics as a Prometheus text endpoint on http://127.0.0.1:METRICS_PORT/metrics.')
+    parser.add_argument('-mf', '--metrics_file', default=None, help='Periodically write live metrics as json in the given file.')
+    parser.add_argument('-mi', '--metrics_interval', type=float, default=10, help='Interval in seconds between two writes of the --metrics_file.')
+    return parser
+
+def start(args):
+    if getattr(args, 'metrics_port', None) is not None:
+        start_http_server(args.metrics_port)
+    if getattr(args, 'metrics_file', None):
+        start_json_writer(args.metrics_file, getattr(args, 'metrics_interval', 10))
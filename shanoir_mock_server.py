@@ -0,0 +1,702 @@
+import io
+import re
+import sys
+import json
+import time
+import uuid
+import random
+import logging
+import zipfile
+import argparse
+import tempfile
+import threading
+from datetime import datetime, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from urllib.parse import urlsplit, parse_qs
+
+import numpy as np
+import synthetic_dicom
+
+try:
+    import SimpleITK as sitk
+except ImportError:
+    sitk = None
+
+# Local stand-in for a Shanoir server, to benchmark and test the scripts offline:
+# serves the keycloak token endpoint, the solr search, the downloads (synthetic dicom series generated on the fly), the subject and study lookups,
+# the deletions and the CARMIN executions of a synthetic database, with configurable latency, bandwidth, errors, token expiry and nightly downtime.
+# The scripts use it with --domain http://127.0.0.1:<port> (see start_server() for the tests)
+
+TOKEN_PATH = '/auth/realms/shanoir-ng/protocol/openid-connect/token'
+MAX_MASSIVE_DOWNLOAD = 50
+SEQUENCES = ['t1_mprage', 't2_flair', 'dwi_30dir', 'rs_fmri']
+
+class MockSettings:
+    """
+    Behaviour of the mock server: latency (seconds before each response), bandwidth (bytes per second of each response, None for no limit),
+    error_rate (probability that a request fails with one of error_statuses), token_lifetime (seconds before an access token expires, None for never),
+    downtime ((start_hour, end_hour) during which the server answers 503), ranges (support of range requests), execution_duration (seconds of a CARMIN execution).
+    clock returns the current time (seconds since the epoch): replace it to simulate the expiry of the tokens or the downtime.
+    """
+
+    def __init__(self, latency=0, bandwidth=None, error_rate=0, error_statuses=(503,), token_lifetime=300, refresh_token_lifetime=None,
+                 downtime=None, ranges=True, password=None, execution_duration=5, seed=0, clock=time.time):
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.error_rate = error_rate
+        self.error_statuses = list(error_statuses)
+        self.token_lifetime = token_lifetime
+        self.refresh_token_lifetime = refresh_token_lifetime
+        self.downtime = downtime
+        self.ranges = ranges
+        self.password = password
+        self.execution_duration = execution_duration
+        self.seed = seed
+        self.clock = clock
+
+    def is_down(self):
+        if self.downtime is None: return False
+        start_hour, end_hour = self.downtime
+        return start_hour <= datetime.fromtimestamp(self.clock()).hour < end_hour
+
+class MockDatabase:
+    """
+    Synthetic Shanoir database: studies > subjects > examinations > datasets (one acquisition per dataset), with deterministic ids and names.
+    The archives of the datasets are generated on first download and kept in memory (at most cache_size archives).
+    """
+
+    def __init__(self, n_studies=1, n_subjects=10, n_examinations=1, sequences=SEQUENCES, n_slices=32, rows=128, columns=128, start_date='2020-01-06', cache_size=64):
+        self.n_slices = n_slices
+        self.rows = rows
+        self.columns = columns
+        self.cache_size = cache_size
+        self.lock = threading.Lock()
+        self.archives = {}
+        self.studies, self.subjects, self.examinations, self.datasets = {}, {}, {}, {}
+        # subject id: services (studies, datasets) in which the subject was deleted
+        self.deleted_subjects = {}
+        date = datetime.strptime(start_date, '%Y-%m-%d')
+        for i in range(n_studies):
+            study_id = i + 1
+            self.studies[study_id] = { 'id': study_id, 'name': f'MOCK_STUDY_{study_id}' }
+            for j in range(n_subjects):
+                subject_id = 100 * study_id + j + 1
+                self.subjects[subject_id] = { 'id': subject_id, 'name': f'{study_id:02d}{j + 1:03d}', 'study_id': study_id }
+                for k in range(n_examinations):
+                    examination_id = 1000 + len(self.examinations) + 1
+                    examination_date = date + timedelta(days=7 * j + 30 * k)
+                    self.examinations[examination_id] = { 'id': examination_id, 'subject_id': subject_id, 'study_id': study_id, 'comment': f'session {k + 1}', 'date': examination_date.strftime('%Y-%m-%dT00:00:00Z') }
+                    for sequence in sequences:
+                        dataset_id = 10000 + len(self.datasets) + 1
+                        self.datasets[dataset_id] = { 'id': dataset_id, 'name': sequence, 'examination_id': examination_id, 'subject_id': subject_id, 'study_id': study_id }
+
+    def solr_item(self, dataset):
+        examination = self.examinations[dataset['examination_id']]
+        return {
+            'id': str(dataset['id']),
+            'datasetId': dataset['id'],
+            'datasetName': dataset['name'],
+            'datasetType': 'Mr',
+            'datasetNature': None,
+            'datasetCreationDate': examination['date'],
+            'examinationId': examination['id'],
+            'examinationComment': examination['comment'],
+            'examinationDate': examination['date'],
+            'subjectId': dataset['subject_id'],
+            'subjectName': self.subjects[dataset['subject_id']]['name'],
+            'studyId': dataset['study_id'],
+            'studyName': self.studies[dataset['study_id']]['name'],
+            'centerName': 'MOCK_CENTER',
+            'sliceThickness': 3.0,
+            'pixelBandwidth': None,
+            'magneticFieldStrength': 3.0,
+        }
+
+    def get_items(self):
+        with self.lock:
+            return [self.solr_item(dataset) for dataset in self.datasets.values()]
+
+    def get_archive_name(self, dataset_id, file_format):
+        dataset = self.datasets[dataset_id]
+        return f'{self.subjects[dataset["subject_id"]]["name"]}_{dataset["name"]}_{dataset_id}_{file_format}.zip'
+
+    # The archive (zip bytes) of a dataset, None if the dataset does not exist
+    def get_archive(self, dataset_id, file_format):
+        with self.lock:
+            dataset = self.datasets.get(dataset_id)
+            archive = self.archives.get((dataset_id, file_format))
+        if dataset is None or archive is not None:
+            return archive
+        datasets = synthetic_dicom.create_series(self.n_slices, self.rows, self.columns, patient_name=self.subjects[dataset['subject_id']]['name'], series_description=dataset['name'], seed=dataset_id)
+        archive = create_nifti_zip_bytes(datasets, dataset['name']) if file_format == 'nii' else create_dicom_zip_bytes(datasets)
+        with self.lock:
+            if len(self.archives) >= self.cache_size:
+                del self.archives[next(iter(self.archives))]
+            self.archives[(dataset_id, file_format)] = archive
+        return archive
+
+    def get_subject_dataset_ids(self, subject_id, study_id=None):
+        with self.lock:
+            return [dataset['id'] for dataset in self.datasets.values() if dataset['subject_id'] == subject_id and (study_id is None or dataset['study_id'] == study_id)]
+
+    def get_study_dataset_ids(self, study_id):
+        with self.lock:
+            return [dataset['id'] for dataset in self.datasets.values() if dataset['study_id'] == study_id]
+
+    def get_subject_examinations(self, subject_id, study_id):
+        with self.lock:
+            subject = self.subjects.get(subject_id)
+            return [{ 'id': examination['id'], 'comment': examination['comment'], 'examinationDate': examination['date'], 'studyId': examination['study_id'], 'subject': { 'id': subject_id, 'name': subject['name'] } }
+                    for examination in self.examinations.values() if examination['subject_id'] == subject_id and examination['study_id'] == study_id]
+
+    def get_examination_acquisitions(self, examination_id):
+        with self.lock:
+            return [{ 'id': dataset['id'], 'examination': { 'id': examination_id }, 'datasets': [{ 'id': dataset['id'], 'name': dataset['name'] }] }
+                    for dataset in self.datasets.values() if dataset['examination_id'] == examination_id]
+
+    # The deletions cascade to the children, and return False if the entity does not exist
+    def delete_dataset(self, dataset_id):
+        with self.lock:
+            return self.datasets.pop(dataset_id, None) is not None
+
+    def delete_examination(self, examination_id):
+        with self.lock:
+            if self.examinations.pop(examination_id, None) is None:
+                return False
+            self.datasets = { id: dataset for id, dataset in self.datasets.items() if dataset['examination_id'] != examination_id }
+            return True
+
+    def delete_subject(self, subject_id, service):
+        with self.lock:
+            if subject_id not in self.subjects and subject_id not in self.deleted_subjects or service in self.deleted_subjects.get(subject_id, []):
+                return False
+            self.subjects.pop(subject_id, None)
+            self.deleted_subjects.setdefault(subject_id, []).append(service)
+            self.examinations = { id: examination for id, examination in self.examinations.items() if examination['subject_id'] != subject_id }
+            self.datasets = { id: dataset for id, dataset in self.datasets.items() if dataset['subject_id'] != subject_id }
+            return True
+
+def create_dicom_zip_bytes(datasets):
+    buffer = io.BytesIO()
+    synthetic_dicom.write_series_zip(buffer, datasets)
+    return buffer.getvalue()
+
+def create_nifti_zip_bytes(datasets, name):
+    if sitk is None:
+        raise Exception('SimpleITK is required to serve nifti archives')
+    array = np.stack([np.frombuffer(dataset.PixelData, dtype=np.uint16).reshape(dataset.Rows, dataset.Columns) for dataset in datasets])
+    image = sitk.GetImageFromArray(array)
+    image.SetSpacing([float(datasets[0].PixelSpacing[1]), float(datasets[0].PixelSpacing[0]), float(datasets[0].SliceThickness)])
+    with tempfile.TemporaryDirectory() as temporary_folder:
+        nifti_path = Path(temporary_folder) / f'{name}.nii.gz'
+        sitk.WriteImage(image, str(nifti_path))
+        buffer = io.BytesIO()
+        with zipfile.ZipFile(buffer, 'w') as zip_ref:
+            zip_ref.write(str(nifti_path), nifti_path.name)
+    return buffer.getvalue()
+
+# Archive of several datasets (massive downloads): the files of each dataset in a folder
+def create_massive_zip_bytes(database, dataset_ids, file_format):
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, 'w') as zip_ref:
+        for dataset_id in dataset_ids:
+            archive = database.get_archive(dataset_id, file_format)
+            if archive is None: continue
+            folder = Path(database.get_archive_name(dataset_id, file_format)).stem
+            with zipfile.ZipFile(io.BytesIO(archive)) as dataset_zip:
+                for name in dataset_zip.namelist():
+                    zip_ref.writestr(f'{folder}/{name}', dataset_zip.read(name))
+    return buffer.getvalue()
+
+# Solr queries (expert mode): field:value clauses (with * and ? wildcards, case insensitive), field:[low TO high] ranges, AND, OR, NOT and parentheses.
+# Backslash escaped characters are literals, as in solr (escape_solr_special_characters() of shanoir2bids escapes ( ) [ ] ? and the other special characters).
+# Differences with solr: the fields are not tokenized (a pattern must match the whole value, solr matches the terms of a text field),
+# the case folding is str.lower() instead of the analyzer of the field, and the fuzzy (~), boost (^) and phrase ("...") syntaxes are not supported.
+
+TOKEN_PATTERN = re.compile(r'\s*(?:(?P<open>\()|(?P<close>\))|(?P<range>(?P<field>\w+):\[(?P<low>\S+) TO (?P<high>\S+)\])|(?P<term>(?:\\.|[^\s()\\])+))')
+
+def tokenize_query(query):
+    tokens = []
+    position = 0
+    query = query.strip()
+    while position < len(query):
+        match = TOKEN_PATTERN.match(query, position)
+        if match is None or match.end() == position:
+            raise ValueError(f'Invalid query at position {position}: {query}')
+        position = match.end()
+        if match.group('open'):
+            tokens.append(('(', None))
+        elif match.group('close'):
+            tokens.append((')', None))
+        elif match.group('range'):
+            tokens.append(('range', (match.group('field'), match.group('low'), match.group('high'))))
+        elif match.group('term') in ['AND', 'OR', 'NOT']:
+            tokens.append((match.group('term'), None))
+        else:
+            field, value = split_term(match.group('term'))
+            tokens.append(('term', (field, value)))
+    return tokens
+
+# The value is kept escaped: compile_pattern() distinguishes the wildcards from the escaped * and ?
+def split_term(term):
+    match = re.match(r'^(\w+):(.*)$', term)
+    return (match.group(1), match.group(2)) if match else (None, term)
+
+def compile_pattern(pattern):
+    parts = []
+    for escaped, character in re.findall(r'(\\.)|(.)', pattern, re.DOTALL):
+        if escaped:
+            parts.append(re.escape(escaped[1]))
+        elif character == '*':
+            parts.append('.*')
+        elif character == '?':
+            parts.append('.')
+        else:
+            parts.append(re.escape(character))
+    return re.compile(''.join(parts), re.IGNORECASE | re.DOTALL)
+
+def match_value(value, pattern):
+    return value is not None and pattern.fullmatch(str(value)) is not None
+
+def match_range(value, low, high):
+    if value is None: return False
+    def compare(a, b):
+        try:
+            return (float(a) > float(b)) - (float(a) < float(b))
+        except ValueError:
+            return (str(a) > str(b)) - (str(a) < str(b))
+    return (low == '*' or compare(value, low) >= 0) and (high == '*' or compare(value, high) <= 0)
+
+class QueryParser:
+    """
+    Recursive descent parser of the solr queries, returns a predicate on the solr items (adjacent clauses are combined with OR as in solr)
+    """
+
+    def __init__(self, query):
+        self.tokens = tokenize_query(query)
+        self.position = 0
+
+    def parse(self):
+        if len(self.tokens) == 0:
+            return lambda item: True
+        predicate = self.parse_or()
+        if self.position < len(self.tokens):
+            raise ValueError(f'Unexpected token {self.tokens[self.position]}')
+        return predicate
+
+    def peek(self):
+        return self.tokens[self.position][0] if self.position < len(self.tokens) else None
+
+    def parse_or(self):
+        predicates = [self.parse_and()]
+        while self.peek() not in [None, ')']:
+            if self.peek() == 'OR':
+                self.position += 1
+            predicates.append(self.parse_and())
+        return predicates[0] if len(predicates) == 1 else lambda item: any(predicate(item) for predicate in predicates)
+
+    def parse_and(self):
+        predicates = [self.parse_not()]
+        while self.peek() == 'AND':
+            self.position += 1
+            predicates.append(self.parse_not())
+        return predicates[0] if len(predicates) == 1 else lambda item: all(predicate(item) for predicate in predicates)
+
+    def parse_not(self):
+        if self.peek() == 'NOT':
+            self.position += 1
+            predicate = self.parse_not()
+            return lambda item: not predicate(item)
+        return self.parse_clause()
+
+    def parse_clause(self):
+        if self.position >= len(self.tokens):
+            raise ValueError('Unexpected end of query')
+        kind, value = self.tokens[self.position]
+        self.position += 1
+        if kind == '(':
+            predicate = self.parse_or()
+            if self.peek() != ')':
+                raise ValueError('Missing closing parenthesis')
+            self.position += 1
+            return predicate
+        if kind == 'range':
+            field, low, high = value
+            return lambda item: match_range(item.get(field), low, high)
+        if kind == 'term':
+            field, pattern = value
+            pattern = compile_pattern(pattern)
+            if field is None:
+                return lambda item: any(match_value(item_value, pattern) for item_value in item.values() if isinstance(item_value, str))
+            return lambda item: match_value(item.get(field), pattern)
+        raise ValueError(f'Unexpected token {kind}')
+
+# Simple mode: every word must appear in one of the text fields
+def get_simple_predicate(search_text):
+    words = [word.lower() for word in search_text.split()]
+    return lambda item: all(any(word in item_value.lower() for item_value in item.values() if isinstance(item_value, str)) for word in words)
+
+def search(items, search_text, expert_mode, page, size, sort):
+    predicate = QueryParser(search_text).parse() if expert_mode else get_simple_predicate(search_text or '')
+    items = [item for item in items if predicate(item)]
+    field, _, direction = sort.partition(',')
+    field = 'datasetId' if field == 'id' else field
+    items.sort(key=lambda item: (item.get(field) is None, item.get(field) if item.get(field) is not None else 0), reverse=direction.upper() == 'DESC')
+    content = items[page * size:(page + 1) * size]
+    n_pages = (len(items) + size - 1) // size if size > 0 else 0
+    return { 'content': content, 'totalElements': len(items), 'totalPages': n_pages, 'number': page, 'size': size, 'numberOfElements': len(content), 'first': page == 0, 'last': page >= n_pages - 1 }
+
+class MockRequestHandler(BaseHTTPRequestHandler):
+
+    protocol_version = 'HTTP/1.1'
+
+    routes = [
+        ('POST', re.compile(r'^/shanoir-ng/datasets/solr$'), 'handle_search'),
+        ('GET', re.compile(r'^/shanoir-ng/datasets/datasets/download/(\d+)$'), 'handle_download'),
+        ('POST', re.compile(r'^/shanoir-ng/datasets/datasets/massiveDownload$'), 'handle_massive_download'),
+        ('GET', re.compile(r'^/shanoir-ng/datasets/datasets/massiveDownloadByStudy$'), 'handle_study_download'),
+        ('GET', re.compile(r'^/shanoir-ng/datasets/datasets/subject/(\d+)(?:/study/(\d+))?$'), 'handle_subject_datasets'),
+        ('GET', re.compile(r'^/shanoir-ng/datasets/examinations/subject/(\d+)/study/(\d+)$'), 'handle_subject_examinations'),
+        ('GET', re.compile(r'^/shanoir-ng/datasets/datasetacquisition/examination/(\d+)$'), 'handle_examination_acquisitions'),
+        ('GET', re.compile(r'^/shanoir-ng/studies/studies$'), 'handle_studies'),
+        ('GET', re.compile(r'^/shanoir-ng/studies/studies/(\d+)$'), 'handle_study'),
+        ('GET', re.compile(r'^/shanoir-ng/studies/subjects/(\d+)$'), 'handle_subject'),
+        ('DELETE', re.compile(r'^/shanoir-ng/datasets/datasets/(\d+)$'), 'handle_delete_dataset'),
+        ('DELETE', re.compile(r'^/shanoir-ng/datasets/examinations/(\d+)$'), 'handle_delete_examination'),
+        ('DELETE', re.compile(r'^/shanoir-ng/(studies|datasets)/subjects/(\d+)$'), 'handle_delete_subject'),
+        ('POST', re.compile(r'^/shanoir-ng/datasets/carmin-data/createExecution$'), 'handle_create_execution'),
+        ('GET', re.compile(r'^/shanoir-ng/datasets/carmin-data/execution/([\w-]+)$'), 'handle_execution_status'),
+    ]
+
+    def log_message(self, format, *args):
+        logging.debug('%s - %s', self.address_string(), format % args)
+
+    def do_GET(self):
+        self.dispatch('GET')
+
+    def do_POST(self):
+        self.dispatch('POST')
+
+    def do_DELETE(self):
+        self.dispatch('DELETE')
+
+    def dispatch(self, method):
+        server = self.server
+        settings = server.settings
+        url = urlsplit(self.path)
+        self.query = { key: values[-1] for key, values in parse_qs(url.query).items() }
+        # The body is always read: the connection is kept alive
+        length = int(self.headers.get('Content-Length', 0))
+        self.body = self.rfile.read(length) if length > 0 else b''
+        server.count('requests')
+        if settings.latency > 0:
+            time.sleep(settings.latency)
+        if settings.is_down():
+            return self.send_json(503, { 'error': 'Shanoir is down for maintenance' })
+        if url.path == TOKEN_PATH and method == 'POST':
+            return self.handle_token()
+        if not server.is_authorized(self.headers.get('Authorization')):
+            return self.send_json(401, { 'error': 'invalid_token' })
+        if server.should_fail():
+            return self.send_json(server.random_error_status(), { 'error': 'simulated error' })
+        for route_method, pattern, handler in self.routes:
+            match = pattern.match(url.path)
+            if match and route_method == method:
+                return getattr(self, handler)(*match.groups())
+        self.send_json(404, { 'error': f'Unknown endpoint {method} {url.path}' })
+
+    def send_body(self, status, body, content_type, headers=None):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.server.count('status_' + str(status))
+        bandwidth = self.server.settings.bandwidth
+        chunk_size = 64 * 1024
+        n_sent = 0
+        try:
+            for start in range(0, len(body), chunk_size):
+                chunk = body[start:start + chunk_size]
+                self.wfile.write(chunk)
+                n_sent += len(chunk)
+                if bandwidth:
+                    time.sleep(len(chunk) / bandwidth)
+        except (BrokenPipeError, ConnectionResetError):
+            # The client stopped reading (e.g. to measure the bandwidth on the first bytes)
+            self.close_connection = True
+        self.server.count('bytes_sent', n_sent)
+
+    def send_json(self, status, content):
+        self.send_body(status, json.dumps(content).encode(), 'application/json')
+
+    def send_empty(self, status):
+        self.send_body(status, b'', 'application/json')
+
+    def send_archive(self, archive, filename):
+        headers = { 'Content-Disposition': f'attachment; filename={filename}', 'Accept-Ranges': 'bytes' if self.server.settings.ranges else 'none' }
+        range_header = self.headers.get('Range')
+        match = re.match(r'^bytes=(\d*)-(\d*)$', range_header or '')
+        if not self.server.settings.ranges or match is None or match.group(1) == match.group(2) == '':
+            return self.send_body(200, archive, 'application/zip', headers)
+        size = len(archive)
+        if match.group(1) == '':
+            start, end = max(0, size - int(match.group(2))), size - 1
+        else:
+            start, end = int(match.group(1)), min(int(match.group(2)), size - 1) if match.group(2) else size - 1
+        if start >= size or start > end:
+            return self.send_body(416, b'', 'application/zip', { 'Content-Range': f'bytes */{size}' })
+        headers['Content-Range'] = f'bytes {start}-{end}/{size}'
+        self.send_body(206, archive[start:end + 1], 'application/zip', headers)
+
+    def read_form(self):
+        return { key: values[-1] for key, values in parse_qs(self.body.decode()).items() }
+
+    def read_json(self):
+        try:
+            return json.loads(self.body or b'{}')
+        except json.JSONDecodeError:
+            return None
+
+    def handle_token(self):
+        form = self.read_form()
+        server = self.server
+        if form.get('grant_type') == 'password':
+            if not form.get('username') or server.settings.password is not None and form.get('password') != server.settings.password:
+                return self.send_json(401, { 'error': 'invalid_grant', 'error_description': 'Invalid user credentials' })
+            return self.send_json(200, server.create_tokens())
+        if form.get('grant_type') == 'refresh_token':
+            tokens = server.refresh_tokens(form.get('refresh_token'))
+            if tokens is None:
+                return self.send_json(400, { 'error': 'invalid_grant', 'error_description': 'Invalid refresh token' })
+            return self.send_json(200, tokens)
+        self.send_json(400, { 'error': 'unsupported_grant_type' })
+
+    def handle_search(self):
+        data = self.read_json()
+        if data is None:
+            return self.send_json(400, { 'error': 'Invalid json body' })
+        try:
+            page = search(self.server.database.get_items(), data.get('searchText') or '', data.get('expertMode', False), int(self.query.get('page', 0)), int(self.query.get('size', 20)), self.query.get('sort', 'id,DESC'))
+        except ValueError as e:
+            return self.send_json(400, { 'error': str(e) })
+        if page['totalElements'] == 0:
+            return self.send_empty(204)
+        self.send_json(200, page)
+
+    def get_format(self):
+        return 'nii' if self.query.get('format') in ['nii', 'nifti'] else 'dcm'
+
+    def handle_download(self, dataset_id):
+        database = self.server.database
+        file_format = self.get_format()
+        archive = database.get_archive(int(dataset_id), file_format)
+        if archive is None:
+            return self.send_json(404, { 'error': f'Dataset {dataset_id} not found' })
+        self.send_archive(archive, database.get_archive_name(int(dataset_id), file_format))
+
+    def handle_massive_download(self):
+        dataset_ids = [int(dataset_id) for dataset_id in self.query.get('datasetIds', '').split(',') if dataset_id.strip() != '']
+        if len(dataset_ids) == 0 or len(dataset_ids) > MAX_MASSIVE_DOWNLOAD:
+            return self.send_json(400, { 'error': f'Between 1 and {MAX_MASSIVE_DOWNLOAD} datasets can be downloaded at once' })
+        self.send_archive(create_massive_zip_bytes(self.server.database, dataset_ids, self.get_format()), f'Datasets_{len(dataset_ids)}.zip')
+
+    def handle_study_download(self):
+        study_id = int(self.query.get('studyId', 0))
+        if study_id not in self.server.database.studies:
+            return self.send_json(404, { 'error': f'Study {study_id} not found' })
+        dataset_ids = self.server.database.get_study_dataset_ids(study_id)
+        self.send_archive(create_massive_zip_bytes(self.server.database, dataset_ids, self.get_format()), f'Study_{study_id}.zip')
+
+    def handle_subject_datasets(self, subject_id, study_id=None):
+        self.send_json(200, self.server.database.get_subject_dataset_ids(int(subject_id), int(study_id) if study_id else None))
+
+    def handle_subject_examinations(self, subject_id, study_id):
+        examinations = self.server.database.get_subject_examinations(int(subject_id), int(study_id))
+        self.send_json(200, examinations) if len(examinations) > 0 else self.send_empty(204)
+
+    def handle_examination_acquisitions(self, examination_id):
+        acquisitions = self.server.database.get_examination_acquisitions(int(examination_id))
+        self.send_json(200, acquisitions) if len(acquisitions) > 0 else self.send_empty(204)
+
+    def handle_studies(self):
+        self.send_json(200, list(self.server.database.studies.values()))
+
+    def handle_study(self, study_id):
+        study = self.server.database.studies.get(int(study_id))
+        self.send_json(200, study) if study else self.send_json(404, { 'error': f'Study {study_id} not found' })
+
+    def handle_subject(self, subject_id):
+        subject = self.server.database.subjects.get(int(subject_id))
+        self.send_json(200, subject) if subject else self.send_json(404, { 'error': f'Subject {subject_id} not found' })
+
+    def handle_delete_dataset(self, dataset_id):
+        self.send_empty(204 if self.server.database.delete_dataset(int(dataset_id)) else 404)
+
+    def handle_delete_examination(self, examination_id):
+        self.send_empty(204 if self.server.database.delete_examination(int(examination_id)) else 404)
+
+    def handle_delete_subject(self, service, subject_id):
+        self.send_empty(204 if self.server.database.delete_subject(int(subject_id), service) else 404)
+
+    def handle_create_execution(self):
+        execution = self.read_json()
+        if not execution or not execution.get('name') or not execution.get('pipelineIdentifier'):
+            return self.send_json(400, { 'error': 'name and pipelineIdentifier are required' })
+        self.send_json(200, self.server.create_execution(execution))
+
+    def handle_execution_status(self, identifier):
+        execution = self.server.get_execution(identifier)
+        self.send_json(200, execution) if execution else self.send_json(404, { 'error': f'Execution {identifier} not found' })
+
+class MockShanoirServer(ThreadingHTTPServer):
+    """
+    The mock server (one thread per connection): use start() and stop(), or a with statement
+    """
+
+    daemon_threads = True
+
+    def __init__(self, host='127.0.0.1', port=0, database=None, settings=None):
+        super().__init__((host, port), MockRequestHandler)
+        self.database = database if database is not None else MockDatabase()
+        self.settings = settings if settings is not None else MockSettings()
+        self.lock = threading.Lock()
+        self.random = random.Random(self.settings.seed)
+        self.access_tokens = {}
+        self.refresh_tokens_expiry = {}
+        self.executions = {}
+        self.counts = {}
+        self.thread = None
+
+    # The clients closing their connections (streamed downloads not read until the end) are not errors
+    def handle_error(self, request, client_address):
+        if isinstance(sys.exc_info()[1], (BrokenPipeError, ConnectionResetError)):
+            return
+        super().handle_error(request, client_address)
+
+    @property
+    def url(self):
+        host, port = self.server_address[:2]
+        return f'http://{host}:{port}'
+
+    # Starting a running server does nothing (e.g. with start_server() as server:)
+    def start(self):
+        if self.thread is not None: return self
+        self.thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        # shutdown() waits for serve_forever() to end: it would block if the server was never started
+        if self.thread is not None:
+            self.shutdown()
+            self.thread.join()
+        self.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *args):
+        self.stop()
+
+    def count(self, name, value=1):
+        with self.lock:
+            self.counts[name] = self.counts.get(name, 0) + value
+
+    def get_counts(self):
+        with self.lock:
+            return dict(self.counts)
+
+    def should_fail(self):
+        with self.lock:
+            return self.settings.error_rate > 0 and self.random.random() < self.settings.error_rate
+
+    def random_error_status(self):
+        with self.lock:
+            return self.random.choice(self.settings.error_statuses)
+
+    def get_expiry(self, lifetime):
+        return self.settings.clock() + lifetime if lifetime is not None else None
+
+    def create_tokens(self, refresh_token=None):
+        access_token = uuid.uuid4().hex
+        with self.lock:
+            self.access_tokens[access_token] = self.get_expiry(self.settings.token_lifetime)
+            if refresh_token is None:
+                refresh_token = uuid.uuid4().hex
+                self.refresh_tokens_expiry[refresh_token] = self.get_expiry(self.settings.refresh_token_lifetime)
+        return { 'access_token': access_token, 'expires_in': self.settings.token_lifetime, 'refresh_token': refresh_token, 'refresh_expires_in': self.settings.refresh_token_lifetime, 'token_type': 'Bearer' }
+
+    def refresh_tokens(self, refresh_token):
+        with self.lock:
+            valid = refresh_token in self.refresh_tokens_expiry and not self.is_expired(self.refresh_tokens_expiry[refresh_token])
+        return self.create_tokens(refresh_token) if valid else None
+
+    def is_expired(self, expiry):
+        return expiry is not None and self.settings.clock() >= expiry
+
+    def is_authorized(self, authorization):
+        if not authorization or not authorization.startswith('Bearer '):
+            return False
+        with self.lock:
+            access_token = authorization[len('Bearer '):]
+            return access_token in self.access_tokens and not self.is_expired(self.access_tokens[access_token])
+
+    def create_execution(self, execution):
+        with self.lock:
+            identifier = f'mock-execution-{len(self.executions) + 1}'
+            self.executions[identifier] = { 'identifier': identifier, 'name': execution['name'], 'pipelineIdentifier': execution['pipelineIdentifier'], 'startDate': self.settings.clock() }
+        return self.get_execution(identifier)
+
+    # The executions run for execution_duration seconds (according to the clock of the settings)
+    def get_execution(self, identifier):
+        with self.lock:
+            execution = self.executions.get(identifier)
+            if execution is None: return None
+            finished = self.settings.clock() - execution['startDate'] >= self.settings.execution_duration
+            return dict(execution, status='Finished' if finished else 'Running')
+
+def start_server(host='127.0.0.1', port=0, database=None, **settings):
+    """
+    Start a mock server in a background thread (on a free port by default), returns the server: give server.url as the domain of the scripts
+    """
+    return MockShanoirServer(host, port, database, MockSettings(**settings)).start()
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Local stand-in for a Shanoir server (synthetic data), use it with --domain http://HOST:PORT', formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('-H', '--host', default='127.0.0.1', help='The address of the server.')
+    parser.add_argument('-p', '--port', type=int, default=8080, help='The port of the server.')
+    parser.add_argument('-nst', '--n_studies', type=int, default=1, help='Number of studies of the synthetic database.')
+    parser.add_argument('-nsu', '--n_subjects', type=int, default=10, help='Number of subjects per study.')
+    parser.add_argument('-ne', '--n_examinations', type=int, default=1, help='Number of examinations per subject.')
+    parser.add_argument('-sq', '--sequences', nargs='+', default=SEQUENCES, help='Names of the datasets of each examination.')
+    parser.add_argument('-ns', '--n_slices', type=int, default=32, help='Number of slices of the synthetic series.')
+    parser.add_argument('-sz', '--slice_size', type=int, default=128, help='Number of rows and columns of the synthetic slices.')
+    parser.add_argument('-l', '--latency', type=float, default=0, help='Latency in seconds added to each response.')
+    parser.add_argument('-b', '--bandwidth', type=float, default=None, help='Bandwidth of each response in bytes per second (no limit by default).')
+    parser.add_argument('-er', '--error_rate', type=float, default=0, help='Probability that a request fails with one of the --error_statuses.')
+    parser.add_argument('-es', '--error_statuses', type=int, nargs='+', default=[503], help='Status codes of the simulated errors.')
+    parser.add_argument('-tl', '--token_lifetime', type=float, default=300, help='Lifetime of the access tokens in seconds (the requests with an expired token get 401).')
+    parser.add_argument('-dt', '--downtime', type=int, nargs=2, default=None, metavar=('START_HOUR', 'END_HOUR'), help='Hours during which the server answers 503 (e.g. 2 5 for the nightly shutdown of Shanoir).')
+    parser.add_argument('-nr', '--no_ranges', default=False, action='store_true', help='Do not support range requests.')
+    parser.add_argument('-pw', '--password', default=None, help='The password of the users (any password is accepted by default).')
+    parser.add_argument('-ed', '--execution_duration', type=float, default=5, help='Duration of the CARMIN executions in seconds.')
+    parser.add_argument('-v', '--verbose', default=False, action='store_true', help='Log every request.')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.DEBUG if args.verbose else logging.INFO, format='%(asctime)s %(message)s')
+    database = MockDatabase(args.n_studies, args.n_subjects, args.n_examinations, args.sequences, args.n_slices, args.slice_size, args.slice_size)
+    settings = MockSettings(args.latency, args.bandwidth, args.error_rate, args.error_statuses, args.token_lifetime, None, args.downtime, not args.no_ranges, args.password, args.execution_duration)
+    server = MockShanoirServer(args.host, args.port, database, settings)
+    logging.info(f'Mock Shanoir server with {len(database.datasets)} datasets listening on {server.url}, use --domain {server.url}')
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    server.server_close()
+
+#python3 ./shanoir_mock_server.py -p 8080 -nsu 20 -l 0.05 -b 10000000 -er 0.01 -tl 60
+#shanoir_password=x shanoir_otp=0 python3 ./shanoir_downloader.py -u test -d http://127.0.0.1:8080 -of /tmp/downloads -st "subjectName:01001" -em
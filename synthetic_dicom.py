@@ -0,0 +1,192 @@
+import io
+import zipfile
+from pathlib import Path
+import numpy as np
+from pydicom.dataset import Dataset, FileMetaDataset
+from pydicom.sequence import Sequence
+from pydicom.uid import ExplicitVRLittleEndian
+
+try:
+    import SimpleITK as sitk
+except ImportError:
+    sitk = None
+
+# Synthetic DICOM series and NIfTI volumes for the tests and benchmarks (no patient data is needed): an ellipsoid phantom with noise,
+# as single-frame 2D slices (optionally repeated over time as an fMRI series), as an enhanced multi-frame series, or as a NIfTI volume.
+# The series are deterministic for a given seed (the same series can be generated again)
+
+MR_IMAGE_STORAGE = '1.2.840.10008.5.1.4.1.1.4'
+ENHANCED_MR_IMAGE_STORAGE = '1.2.840.10008.5.1.4.1.1.4.1'
+UID_ROOT = '1.2.826.0.1.3680043.8.498'
+
+def get_uid(seed, *parts):
+    return '.'.join([UID_ROOT, str(seed % 10**8)] + [str(part) for part in parts])
+
+# pixel_spacing is a number or a (row spacing, column spacing) pair
+def get_pixel_spacing(pixel_spacing):
+    return [float(pixel_spacing), float(pixel_spacing)] if np.isscalar(pixel_spacing) else [float(s) for s in pixel_spacing]
+
+# Slice of the phantom at z (between -1 and 1 across the volume), 12 bits intensities; volume_index adds a small signal change over time
+def create_phantom_slice(rng, rows, columns, z, volume_index=0):
+    y, x = np.ogrid[-1:1:rows * 1j, -1:1:columns * 1j]
+    r2 = (x / 0.8) ** 2 + (y / 0.9) ** 2 + z ** 2
+    image = np.where(r2 < 1, 1500 - 500 * r2 + 20 * np.sin(volume_index / 3), 0) + rng.normal(0, 30, (rows, columns))
+    return np.clip(image, 0, 4095).astype(np.uint16)
+
+def get_slice_z(index, n_slices):
+    return 2 * index / max(n_slices - 1, 1) - 1
+
+def create_base_dataset(sop_class_uid, sop_instance_uid, seed, rows, columns, patient_name, series_description, modality, manufacturer):
+    file_meta = FileMetaDataset()
+    file_meta.MediaStorageSOPClassUID = sop_class_uid
+    file_meta.MediaStorageSOPInstanceUID = sop_instance_uid
+    file_meta.TransferSyntaxUID = ExplicitVRLittleEndian
+    dataset = Dataset()
+    dataset.file_meta = file_meta
+    dataset.is_little_endian = True
+    dataset.is_implicit_VR = False
+    dataset.SOPClassUID = sop_class_uid
+    dataset.SOPInstanceUID = sop_instance_uid
+    dataset.StudyInstanceUID = get_uid(seed, 1)
+    dataset.SeriesInstanceUID = get_uid(seed, 2)
+    dataset.FrameOfReferenceUID = get_uid(seed, 4)
+    dataset.Modality = modality
+    dataset.Manufacturer = manufacturer
+    dataset.PatientName = patient_name
+    dataset.PatientID = patient_name
+    dataset.SeriesDescription = series_description
+    dataset.SeriesNumber = 1
+    dataset.Rows = rows
+    dataset.Columns = columns
+    dataset.SamplesPerPixel = 1
+    dataset.PhotometricInterpretation = 'MONOCHROME2'
+    dataset.BitsAllocated = 16
+    dataset.BitsStored = 12
+    dataset.HighBit = 11
+    dataset.PixelRepresentation = 0
+    return dataset
+
+def get_position(rows, columns, pixel_spacing, slice_spacing, index):
+    return [-columns * pixel_spacing[1] / 2, -rows * pixel_spacing[0] / 2, index * slice_spacing]
+
+# Single-frame 2D series: one dataset per slice, and per volume if n_volumes > 1 (fMRI-like series, the volumes are ordered in time)
+def create_series(n_slices=60, rows=256, columns=256, slice_spacing=3.0, pixel_spacing=0.9, patient_name='synthetic', series_description='t1_synthetic', modality='MR', manufacturer='Synthetic', n_volumes=1, repetition_time=None, echo_time=10.0, seed=0):
+    rng = np.random.default_rng(seed)
+    pixel_spacing = get_pixel_spacing(pixel_spacing)
+    datasets = []
+    for volume_index in range(n_volumes):
+        for i in range(n_slices):
+            instance_number = volume_index * n_slices + i + 1
+            dataset = create_base_dataset(MR_IMAGE_STORAGE, get_uid(seed, 3, instance_number), seed, rows, columns, patient_name, series_description, modality, manufacturer)
+            dataset.InstanceNumber = instance_number
+            dataset.ImageOrientationPatient = [1, 0, 0, 0, 1, 0]
+            dataset.ImagePositionPatient = get_position(rows, columns, pixel_spacing, slice_spacing, i)
+            dataset.PixelSpacing = pixel_spacing
+            dataset.SliceThickness = slice_spacing
+            if n_volumes > 1:
+                dataset.AcquisitionNumber = volume_index + 1
+                dataset.TemporalPositionIdentifier = volume_index + 1
+                dataset.NumberOfTemporalPositions = n_volumes
+            if repetition_time is not None:
+                dataset.RepetitionTime = repetition_time
+            dataset.EchoTime = echo_time
+            dataset.PixelData = create_phantom_slice(rng, rows, columns, get_slice_z(i, n_slices), volume_index).tobytes()
+            datasets.append(dataset)
+    return datasets
+
+# fMRI-sized series (single-frame 2D slices of n_volumes volumes)
+def create_fmri_series(n_volumes=100, n_slices=36, rows=64, columns=64, slice_spacing=3.5, pixel_spacing=3.5, repetition_time=2000, echo_time=30.0, series_description='rs_fmri_synthetic', **kwargs):
+    return create_series(n_slices, rows, columns, slice_spacing, pixel_spacing, series_description=series_description, n_volumes=n_volumes, repetition_time=repetition_time, echo_time=echo_time, **kwargs)
+
+# Enhanced multi-frame series: a single dataset containing all the frames (slices, and volumes if n_volumes > 1) with their per-frame positions
+def create_enhanced_series(n_slices=60, rows=256, columns=256, slice_spacing=3.0, pixel_spacing=0.9, patient_name='synthetic', series_description='t1_enhanced_synthetic', modality='MR', manufacturer='Synthetic', n_volumes=1, repetition_time=None, seed=0):
+    rng = np.random.default_rng(seed)
+    pixel_spacing = get_pixel_spacing(pixel_spacing)
+    dataset = create_base_dataset(ENHANCED_MR_IMAGE_STORAGE, get_uid(seed, 3, 1), seed, rows, columns, patient_name, series_description, modality, manufacturer)
+    dataset.InstanceNumber = 1
+    dataset.ImageType = ['ORIGINAL', 'PRIMARY', 'M', 'NONE']
+    dataset.NumberOfFrames = n_slices * n_volumes
+
+    pixel_measures = Dataset()
+    pixel_measures.PixelSpacing = pixel_spacing
+    pixel_measures.SliceThickness = slice_spacing
+    pixel_measures.SpacingBetweenSlices = slice_spacing
+    plane_orientation = Dataset()
+    plane_orientation.ImageOrientationPatient = [1, 0, 0, 0, 1, 0]
+    shared_groups = Dataset()
+    shared_groups.PixelMeasuresSequence = Sequence([pixel_measures])
+    shared_groups.PlaneOrientationSequence = Sequence([plane_orientation])
+    if repetition_time is not None:
+        timing = Dataset()
+        timing.RepetitionTime = repetition_time
+        shared_groups.MRTimingAndRelatedParametersSequence = Sequence([timing])
+    dataset.SharedFunctionalGroupsSequence = Sequence([shared_groups])
+
+    frame_groups = []
+    frames = []
+    for volume_index in range(n_volumes):
+        for i in range(n_slices):
+            plane_position = Dataset()
+            plane_position.ImagePositionPatient = get_position(rows, columns, pixel_spacing, slice_spacing, i)
+            frame_content = Dataset()
+            frame_content.StackID = '1'
+            frame_content.InStackPositionNumber = i + 1
+            frame_content.TemporalPositionIndex = volume_index + 1
+            frame_content.DimensionIndexValues = [1, volume_index + 1, i + 1]
+            frame_group = Dataset()
+            frame_group.PlanePositionSequence = Sequence([plane_position])
+            frame_group.FrameContentSequence = Sequence([frame_content])
+            frame_groups.append(frame_group)
+            frames.append(create_phantom_slice(rng, rows, columns, get_slice_z(i, n_slices), volume_index))
+    dataset.PerFrameFunctionalGroupsSequence = Sequence(frame_groups)
+    dataset.PixelData = np.stack(frames).tobytes()
+    return [dataset]
+
+def dataset_to_bytes(dataset):
+    buffer = io.BytesIO()
+    dataset.save_as(buffer, write_like_original=False)
+    return buffer.getvalue()
+
+# Write the series in a folder (one file per dataset), returns the paths of the files
+def write_series(folder, datasets, prefix=''):
+    folder = Path(folder)
+    folder.mkdir(parents=True, exist_ok=True)
+    paths = []
+    for i, dataset in enumerate(datasets):
+        paths.append(folder / f'{prefix}{i:05d}.dcm')
+        dataset.save_as(str(paths[-1]), write_like_original=False)
+    return paths
+
+# Write the series in a zip archive (path or file), the file names are shuffled: the slices must be sorted by position, not by name
+def write_series_zip(zip_file, datasets, folder=''):
+    with zipfile.ZipFile(zip_file, 'w') as zip_ref:
+        add_series_to_zip(zip_ref, datasets, folder)
+    return zip_file
+
+def add_series_to_zip(zip_ref, datasets, folder=''):
+    n_slices = len(datasets)
+    for i, dataset in enumerate(datasets):
+        zip_ref.writestr(f'{folder}{(i * 7919) % n_slices:04d}_{i}.dcm', dataset_to_bytes(dataset))
+
+def create_series_zip(zip_path, n_slices=60, rows=256, columns=256, **kwargs):
+    Path(zip_path).parent.mkdir(parents=True, exist_ok=True)
+    write_series_zip(str(zip_path), create_series(n_slices, rows, columns, **kwargs))
+    return Path(zip_path)
+
+def create_series_zip_bytes(n_slices=60, rows=256, columns=256, **kwargs):
+    buffer = io.BytesIO()
+    write_series_zip(buffer, create_series(n_slices, rows, columns, **kwargs))
+    return buffer.getvalue()
+
+# NIfTI volume of the phantom: size is (x, y, z) and spacing in mm as in SimpleITK, 4D if n_volumes > 1
+def create_nifti(nifti_path, size=(256, 256, 180), spacing=(1.0, 1.0, 1.0), n_volumes=1, repetition_time=2.0, seed=0):
+    if sitk is None:
+        raise Exception('SimpleITK is required to write synthetic niftis')
+    rng = np.random.default_rng(seed)
+    columns, rows, n_slices = size
+    volumes = [np.stack([create_phantom_slice(rng, rows, columns, get_slice_z(i, n_slices), volume_index) for i in range(n_slices)]).astype(np.int16) for volume_index in range(n_volumes)]
+    image = sitk.GetImageFromArray(volumes[0] if n_volumes == 1 else np.stack(volumes))
+    image.SetSpacing([float(s) for s in spacing] + ([float(repetition_time)] if n_volumes > 1 else []))
+    Path(nifti_path).parent.mkdir(parents=True, exist_ok=True)
+    sitk.WriteImage(image, str(nifti_path))
+    return Path(nifti_path)
@@ -0,0 +1,80 @@
+import sys
+from pathlib import Path
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+np = pytest.importorskip("numpy")
+sitk = pytest.importorskip("SimpleITK")
+Image = pytest.importorskip("PIL.Image")
+import create_previews
+import synthetic_dicom
+
+# resampleSlice must give the slices of the whole volume resampled on create_previews.newSpacing (as the previews were computed before),
+# including for spacings which are not multiples of newSpacing, anisotropic volumes and rotated directions
+
+
+def resample_volume(nifti, resampled_size):
+    resampler = sitk.ResampleImageFilter()
+    resampler.SetSize(resampled_size)
+    resampler.SetOutputSpacing(create_previews.newSpacing)
+    resampler.SetOutputOrigin(nifti.GetOrigin())
+    resampler.SetOutputDirection(nifti.GetDirection())
+    resampler.SetInterpolator(sitk.sitkLinear)
+    return sitk.GetArrayFromImage(resampler.Execute(nifti))
+
+
+@pytest.mark.parametrize(
+    "size, spacing, direction",
+    [
+        ((256, 256, 40), (0.9, 0.9, 4.0), None),
+        ((96, 80, 30), (0.7, 1.3, 3.3), None),
+        ((64, 64, 48), (1.1, 0.95, 2.7), (0, 1, 0, -1, 0, 0, 0, 0, 1)),
+    ],
+)
+def test_resample_slice_parity(tmp_path, size, spacing, direction):
+    nifti = sitk.ReadImage(str(synthetic_dicom.create_nifti(tmp_path / "volume.nii.gz", size, spacing)))
+    if direction is not None:
+        nifti.SetDirection(direction)
+        nifti.SetOrigin((12.3, -4.5, 7.7))
+    resampled_size = create_previews.getResampledSize(nifti)
+    volume = resample_volume(nifti, resampled_size)
+    for axis in range(3):
+        for index in range(0, volume.shape[axis], 5):
+            np.testing.assert_array_equal(create_previews.resampleSlice(nifti, resampled_size, axis, index), np.take(volume, index, axis=axis))
+
+
+@pytest.mark.parametrize(
+    "size, spacing",
+    [
+        ((96, 80, 30), (0.7, 1.3, 3.3)),
+        ((64, 64, 24), (0.9, 0.9, 4.0)),
+    ],
+)
+def test_previews_parity(tmp_path, monkeypatch, size, spacing):
+    # The previews must be those of the whole volume resampled and normalised on its minimum and maximum (the previous pipeline)
+    nifti_path = synthetic_dicom.create_nifti(tmp_path / "volume.nii.gz", size, spacing)
+    create_previews.setOptions(
+        {"slice_spacing": 5, "bounding_box_size": 40, "mosaic_spacing": 5, "intensity_window": "minmax", "output_mode": "png"}
+    )
+    # Several slabs for the minimum and maximum
+    monkeypatch.setattr(create_previews, "minmaxChunkSize", 100000)
+    previews, reference = tmp_path / "previews", tmp_path / "reference"
+    previews.mkdir()
+    reference.mkdir()
+    create_previews.createPreviews(nifti_path, previews)
+
+    nifti = sitk.ReadImage(str(nifti_path))
+    volume = resample_volume(nifti, create_previews.getResampledSize(nifti))
+    min_value, max_value = np.min(volume), np.max(volume)
+    if max_value > min_value:
+        volume = (255.0 * (volume - min_value)) / float(max_value - min_value)
+    prefix = nifti_path.parent.name + nifti_path.name
+    _, preview_images = create_previews.saveSlices(lambda axis, index: np.take(volume, index, axis=axis), volume.shape, reference, prefix=prefix)
+    create_previews.createMosaic(preview_images, reference, prefix=prefix)
+
+    names = sorted(path.name for path in reference.iterdir())
+    assert sorted(path.name for path in previews.iterdir()) == names
+    for name in names:
+        np.testing.assert_array_equal(np.asarray(Image.open(previews / name)), np.asarray(Image.open(reference / name)), err_msg=name)
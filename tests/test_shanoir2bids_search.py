@@ -0,0 +1,90 @@
+import io
+import sys
+from pathlib import Path
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+pytest.importorskip("heudiconv")
+pytest.importorskip("bids_validator")
+import shanoir2bids
+import shanoir_downloader
+import shanoir_mock_server
+
+# The search of shanoir2bids against the mock server (whose solr queries treat the escaped characters as literals):
+# each dataset must be found by the search of its sequence, even when its name contains solr special characters
+
+SEQUENCES = ["T1 [MPRAGE]", "DWI (b1000)", "rs_fmri?", "t2_flair"]
+
+
+@pytest.fixture
+def server(monkeypatch):
+    monkeypatch.setenv("shanoir_password", "password")
+    monkeypatch.setenv("shanoir_otp", "")
+    server = shanoir_mock_server.start_server(
+        database=shanoir_mock_server.MockDatabase(n_subjects=2, n_examinations=2, sequences=SEQUENCES)
+    )
+    yield server
+    server.stop()
+
+
+def create_downloader(server, data_dict, session="*"):
+    stb = shanoir2bids.DownloadShanoirDatasetToBIDS()
+    stb.set_shanoir_study_id("MOCK_STUDY_1")
+    stb.set_shanoir_session_id(session)
+    stb.set_shanoir2bids_dict(data_dict)
+    stb.set_date_from("2000-01-01T00:00:00Z")
+    stb.set_date_to("2100-01-01T00:00:00Z")
+    stb.client = shanoir_downloader.ShanoirClient(server.url, "user")
+    return stb
+
+
+def found_names(found_datasets):
+    return sorted((seq_dict["bidsName"], item["datasetName"], item["examinationComment"]) for seq_dict, item in found_datasets)
+
+
+def test_special_characters(server):
+    data_dict = [
+        {"datasetName": "T1 [MPRAGE]", "bidsDir": "anat", "bidsName": "T1w"},
+        {"datasetName": "DWI (b1000)", "bidsDir": "dwi", "bidsName": "dwi"},
+        {"datasetName": "rs_fmri?", "bidsDir": "func", "bidsName": "task-rest_bold"},
+    ]
+    found_datasets = create_downloader(server, data_dict).search_subject_datasets("01001", io.StringIO())
+    assert found_names(found_datasets) == [
+        ("T1w", "T1 [MPRAGE]", "session 1"),
+        ("T1w", "T1 [MPRAGE]", "session 2"),
+        ("dwi", "DWI (b1000)", "session 1"),
+        ("dwi", "DWI (b1000)", "session 2"),
+        ("task-rest_bold", "rs_fmri?", "session 1"),
+        ("task-rest_bold", "rs_fmri?", "session 2"),
+    ]
+
+
+def test_overlapping_sequences(server):
+    # A dataset found by the searches of two sequences is converted for both
+    data_dict = [
+        {"datasetName": "T1*", "bidsDir": "anat", "bidsName": "T1w"},
+        {"datasetName": "T1 [MPRAGE]", "bidsDir": "anat", "bidsName": "acq-mprage_T1w"},
+    ]
+    found_datasets = create_downloader(server, data_dict, "session 1").search_subject_datasets("01001", io.StringIO())
+    assert found_names(found_datasets) == [
+        ("T1w", "T1 [MPRAGE]", "session 1"),
+        ("acq-mprage_T1w", "T1 [MPRAGE]", "session 1"),
+    ]
+
+
+def test_sessions(server):
+    # Each dataset belongs to the first configured session which found it
+    data_dict = [{"datasetName": "t2_flair", "bidsDir": "anat", "bidsName": "FLAIR"}]
+    sessions = [{"session": "session 2", "bidsSession": "followup"}, {"session": "session*"}]
+    stb = create_downloader(server, data_dict, sessions)
+    found_datasets = stb.search_subject_datasets("01001", io.StringIO())
+    assert sorted(stb.get_bids_session(seq_dict, item) for seq_dict, item in found_datasets) == ["followup", "session1"]
+
+
+def test_empty_configuration(server):
+    # No sequence or no session: nothing is searched
+    assert create_downloader(server, []).search_subject_datasets("01001", io.StringIO()) == []
+    data_dict = [{"datasetName": "t2_flair", "bidsDir": "anat", "bidsName": "FLAIR"}]
+    assert create_downloader(server, data_dict, []).search_subject_datasets("01001", io.StringIO()) == []